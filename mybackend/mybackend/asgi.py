@@ -1,15 +1,34 @@
 import os
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mybackend.settings')
+# Set up Django before importing consumers, they read settings at import time
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from terminal_app.routing import websocket_urlpatterns
+from terminal_app.container_index import get_index
+from terminal_app import jobs, lifecycle, workers
+from terminal_app.views import container_pool
 from channels.security.websocket import AllowedHostsOriginValidator
 
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mybackend.settings')
+# Under runworkers only the primary worker runs these; the others ask the
+# daemon, claim from its warm pool through Docker and hand it their jobs
+if workers.PRIMARY:
+    # Seed the container index at startup rather than on the first connection
+    get_index()
+    # Fill the warm pool now, so the first create_instance already finds a container
+    if container_pool:
+        container_pool.start()
+    jobs.receiver.start()
+# Every process stamps terminal I/O; idle terminals are paused and later
+# stopped by the primary
+if lifecycle.manager:
+    lifecycle.manager.start()
 
 application = ProtocolTypeRouter({
-    'http': get_asgi_application(),
+    'http': django_asgi_app,
     'websocket': AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter(
@@ -17,4 +36,4 @@ application = ProtocolTypeRouter({
             )
         )
     ),
-})
\ No newline at end of file
+})
@@ -137,13 +137,149 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'terminal_app.channel_layer.TerminalChannelLayer',
         'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+            # Several hosts shard groups and channels by consistent hash.
+            # Dict entries take redis ConnectionPool options.
+            "hosts": [{'address': 'redis://127.0.0.1:6379', 'max_connections': 64}],
+            # Group name prefixes that never span processes, delivered without Redis
+            "local_groups": [],
+            # Session routers carry relayed terminal output between nodes
+            "channel_capacity": {"specific.*!router-*": 1000},
         },
     },
 }
 
+# Docker daemon calls made from the consumers and request handlers
+DOCKER_CONTROL = {
+    'MAX_WORKERS': 8,  # threads and kept-alive daemon connections
+    'TIMEOUT': 30,
+    'STREAM_WORKERS': 8,  # threads reading exec output, at least JOB_ENGINE WORKERS
+}
+
+# Container id/name/status cache kept current from the Docker events stream.
+# Off by default: once on, the primary worker keeps an events stream open to the daemon.
+CONTAINER_INDEX = {
+    'ENABLED': False,
+}
+
+# Background jobs (provisioning, exec, stop) run on a fixed set of workers
+JOB_ENGINE = {
+    'WORKERS': 4,
+    'LIMITS': {'provision': 2, 'exec': 2, 'stop': 4, 'cache': 1},  # concurrent jobs per kind
+}
+
+# Idle terminals are paused, then stopped; resumed when a viewer connects or types.
+# Off by default: once on, a terminal left idle is paused, and later stopped.
+CONTAINER_LIFECYCLE = {
+    'ENABLED': False,
+    'PAUSE_AFTER': 15 * 60,  # seconds without terminal I/O
+    'STOP_AFTER': 4 * 60 * 60,
+    'REMOVE_ON_STOP': False,
+    'CHECK_INTERVAL': 30,
+}
+
+# Install output streamed to job-status subscribers
+JOB_PROGRESS = {
+    'MAX_LINES': 50,  # lines kept per message, older ones are counted as dropped
+    'MAX_RATE': 4,  # messages per second per job
+}
+
+# Warm pool of pre-started containers per image used by create_instance.
+# Off by default: once on, MIN_SIZE idle containers per image run from startup.
+CONTAINER_POOL = {
+    'ENABLED': False,
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 3,
+    'IDLE_TIMEOUT': 600,  # seconds a warm container may sit unused above MIN_SIZE
+    'REFILL_INTERVAL': 5,
+}
+
+# Images committed after provisioning, keyed by (system, package set).
+# Off by default: once on, each new package set is built into an image in the background.
+IMAGE_CACHE = {
+    'ENABLED': False,
+    'DISK_BUDGET': 10 * 1024 ** 3,  # bytes, least recently used images are removed past this
+}
+
+# Shared apt download cache for Debian and Ubuntu: through a caching proxy, or one
+# archives volume per system. Off by default: once on, containers mount the volume.
+PACKAGE_CACHE = {
+    'ENABLED': False,
+    'APT_PROXY': '',  # e.g. 'http://apt-cacher-ng:3142'; when set, no volume is shared between containers
+    'MAX_BYTES': 5 * 1024 ** 3,  # archives beyond this are removed, least recently used first
+    'LOCK_TIMEOUT': 900,  # seconds an install waits for another container's apt run
+}
+
+# Output coalescing between the Docker attach socket and the terminal WebSocket
+TERMINAL_STREAMING = {
+    'MAX_FRAME_BYTES': 16384,
+    'FLUSH_INTERVAL': 0.005,  # seconds a burst may wait to fill a frame; small output never waits
+    'HIGH_WATER_MARK': 256 * 1024,  # bytes queued, or sent and unacknowledged with ?ack=1, before the socket reader pauses
+    'COMPRESS_MIN_BYTES': 256,  # smaller frames skip ?compress=deflate, keeps typing echo cheap
+    'COMPRESS_LEVEL': 1,  # zlib level; 6 saves ~25% more bytes for ~3x the CPU on apt output
+    'INPUT_QUEUE_BYTES': 256 * 1024,  # client input queued per session before receive waits
+    'MAX_INPUT_WRITE': 65536,  # queued input joined into one backend write
+    'INPUT_LINGER': 0.002,  # seconds a paste may wait to fill a write; keystrokes never wait
+    'SCREEN_FPS': 30,  # most frames a second sent to ?view=screen clients (needs pyte)
+    'SCREEN_PARSE_BYTES': 8192,  # most output parsed into a session's screen per frame, newest first; bounds pyte's CPU
+}
+
+# Where terminal sessions run besides Docker containers
+TERMINAL_BACKENDS = {
+    'LOCAL_ENABLED': False,  # ws/local/ shells on this host, staff only
+    'LOCAL_SHELL': '/bin/bash',
+    'SSH_ENABLED': False,  # ws/ssh/ shells on other hosts, signed-in users only
+    'SSH_ALLOWED_HOSTS': [],  # 'host' (port 22) or 'host:port' SSH sessions may connect to
+    'SSH_CONNECT_TIMEOUT': 10,
+    'SSH_POOL_ENABLED': True,  # sessions to one host as one user share an authenticated connection
+    'SSH_POOL_IDLE_TIMEOUT': 300,  # seconds a connection with no shells left stays open
+    'SSH_POOL_MAX_CHANNELS': 10,  # shells per connection, OpenSSH's default MaxSessions
+}
+
+# Which node owns each container's attach stream when several Daphne
+# processes serve terminals; needs the shared Redis cache and channel layer
+TERMINAL_REGISTRY = {
+    'ENABLED': False,
+    'LEASE_SECONDS': 15,  # how long a dead owner keeps its sessions
+    'RENEW_INTERVAL': 5,
+    'NODE_URL': '',  # ws:// base URL of this node, returned by api/session-owner/<id>/
+}
+
+# manage.py runworkers: Daphne worker processes sharing one listening socket
+TERMINAL_WORKERS = {
+    'WORKERS': 0,  # 0 starts one per CPU core
+    'DRAIN_TIMEOUT': 600,  # seconds old workers keep open sessions after a reload (SIGHUP)
+    'HEARTBEAT_INTERVAL': 1,
+    'HEARTBEAT_TIMEOUT': 10,  # workers silent this long are killed and replaced
+    'REPORT_INTERVAL': 5,  # seconds between each worker's metrics and stats reports, merged for /metrics/
+    'STATUS_FILE': '',  # JSON worker health report, read by runworkers --status
+    'PERMESSAGE_DEFLATE': False,
+}
+
+# Audit recordings of terminal sessions, exported with manage.py export_recording
+TERMINAL_RECORDING = {
+    'ENABLED': False,
+    'DIRECTORY': BASE_DIR / 'recordings',
+    'BLOCK_BYTES': 64 * 1024,  # events compressed together, each block is a seek point
+    'FLUSH_INTERVAL': 1.0,  # seconds before a partly filled block is written anyway
+    'RECORD_INPUT': True,
+}
+
+# Per-container output history replayed to reconnecting clients
+TERMINAL_SCROLLBACK = {
+    'BUFFER_BYTES': 256 * 1024,
+    'MEMORY_BUDGET': 64 * 1024 * 1024,  # least recently active buffers are dropped past this
+}
+
+# Shared between the HTTP and WebSocket processes, holds the last job status per container
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://127.0.0.1:6379/1',
+    },
+}
+
 
 CSP_CONNECT_SRC = (
     "'self'",
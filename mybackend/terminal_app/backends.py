@@ -0,0 +1,264 @@
+import asyncio
+import errno
+import fcntl
+import logging
+import os
+import signal
+import socket
+import struct
+import termios
+
+from django.conf import settings
+
+from . import docker_control, lifecycle, sessions, ssh_pool
+
+logger = logging.getLogger(__name__)
+
+backend_settings = getattr(settings, 'TERMINAL_BACKENDS', {})
+
+# Longest wait between checks for room in a full SSH send window
+WINDOW_POLL_MAX = 0.05
+
+
+# Shown to the client as-is when a session cannot be opened
+class BackendError(Exception):
+    pass
+
+
+# A terminal session backend provides:
+#   open()              connect or spawn, raising BackendError with a user-facing message
+#   read()              next chunk of output, b'' once the session has ended
+#   write(data)         bytes for the session's stdin, all of them before returning
+#   resize(rows, cols)  new terminal size
+#   close()
+# shared backends are keyed by container and fanned out to every viewer by
+# sessions.subscribe; the others belong to a single connection.
+
+
+# Attach stream of a container started from create-instance
+class DockerBackend:
+    shared = True
+
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.container = None
+        self.socket_docker = None
+
+    async def open(self):
+        self.container = await sessions.start_container(self.container_id)
+        self.socket_docker = await docker_control.run(
+            self.container.attach_socket, params={'stdin': 1, 'stdout': 1, 'stderr': 1, 'stream': 1}
+        )
+        self.socket_docker._sock.setblocking(False)
+        logger.info(f"Attached to container {self.container_id}.")
+
+    async def read(self):
+        output = await sessions.read_from_docker(self.socket_docker)
+        if output and lifecycle.manager:
+            lifecycle.manager.touch(self.container_id, output=True)
+        return output
+
+    async def write(self, data):
+        if lifecycle.manager:
+            await lifecycle.manager.ensure_running(self.container_id)
+        # Waits for room when the daemon is slow to drain a paste
+        await asyncio.get_running_loop().sock_sendall(self.socket_docker._sock, data)
+
+    async def resize(self, rows, cols):
+        await docker_control.run(docker_control.get_client().api.resize, self.container_id, height=rows, width=cols)
+
+    async def close(self):
+        if self.socket_docker:
+            try:
+                self.socket_docker.close()
+            except Exception as e:
+                logger.error(f"Error closing attach socket for {self.container_id}: {e}")
+        logger.info(f"Detached from container {self.container_id}.")
+
+
+# Interactive shell on a remote host over SSH. paramiko is only needed
+# when this backend is used.
+class SSHBackend:
+    shared = False
+
+    def __init__(self, host, username, password, port=22):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.transport = None
+        self.channel = None
+
+    async def open(self):
+        try:
+            import paramiko
+        except ImportError:
+            raise BackendError("SSH sessions are not available on this server.")
+
+        try:
+            # A new channel on a pooled connection when there is one; the
+            # handshake and authentication otherwise, off the event loop
+            self.transport, self.channel = await ssh_pool.pool.open_shell(self.host, self.port, self.username, self.password)
+        except paramiko.AuthenticationException:
+            raise BackendError("Authentication failed: Incorrect username or password.")
+        except paramiko.SSHException as e:
+            raise BackendError(f"SSH error: {str(e)}")
+        except socket.gaierror:
+            raise BackendError("Host not found: Check the hostname or network.")
+        except socket.timeout:
+            raise BackendError("Connection timed out: The server took too long to respond.")
+        except OSError as e:
+            raise BackendError(f"Connection failed: {str(e)}")
+        self.channel.setblocking(0)
+
+    # The channel's fileno() is a pipe paramiko signals when data arrives
+    async def read(self):
+        while True:
+            try:
+                return self.channel.recv(sessions.READ_SIZE)
+            except socket.timeout:
+                await _readable(self.channel.fileno())
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                sent = self.channel.send(view)
+            except socket.timeout:
+                # Remote window is full. paramiko signals no fd when it
+                # opens again, so poll for it, backing off to WINDOW_POLL_MAX
+                delay = 0.001
+                while not self.channel.send_ready():
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, WINDOW_POLL_MAX)
+                continue
+            if sent == 0:
+                # EOF already sent; send_ready() stays true from here on
+                raise BrokenPipeError("SSH channel is closed for writing")
+            view = view[sent:]
+
+    async def resize(self, rows, cols):
+        self.channel.resize_pty(width=cols, height=rows)
+
+    async def close(self):
+        if self.channel:
+            self.channel.close()
+        if self.transport:
+            ssh_pool.pool.release(self.transport)
+            self.transport = None
+
+
+# SSH_ALLOWED_HOSTS entries are 'host' for port 22 or 'host:port', with
+# IPv6 addresses in brackets. Names are compared as given, not resolved,
+# so list the names clients are expected to use.
+def ssh_destination_allowed(host, port):
+    for entry in backend_settings.get('SSH_ALLOWED_HOSTS', ()):
+        allowed_host, allowed_port = entry, 22
+        name, separator, number = entry.rpartition(':')
+        if separator and number.isdigit() and (':' not in name or name.startswith('[')):
+            allowed_host, allowed_port = name, int(number)
+        if host.lower() == allowed_host.strip('[]').lower() and port == allowed_port:
+            return True
+    return False
+
+
+# Shell spawned on this host behind a pseudo-terminal. Output is read
+# straight off the PTY master on the event loop, with no daemon in between,
+# so it is only offered for trusted local use.
+class LocalPTYBackend:
+    shared = False
+
+    def __init__(self, shell=None, cwd=None):
+        self.shell = shell or backend_settings.get('LOCAL_SHELL', '/bin/bash')
+        self.cwd = cwd or backend_settings.get('LOCAL_CWD') or os.path.expanduser('~')
+        self.master_fd = None
+        self.process = None
+
+    async def open(self):
+        self.master_fd, slave_fd = os.openpty()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                self.shell, '-l',
+                stdin=slave_fd, stdout=slave_fd, stderr=slave_fd,
+                cwd=self.cwd,
+                env={**os.environ, 'TERM': 'xterm-256color'},
+                start_new_session=True,
+                preexec_fn=_take_controlling_tty,
+            )
+        except OSError as e:
+            os.close(self.master_fd)
+            self.master_fd = None
+            raise BackendError(f"Could not start {self.shell}: {e}")
+        finally:
+            os.close(slave_fd)
+        os.set_blocking(self.master_fd, False)
+
+    async def read(self):
+        while True:
+            try:
+                return os.read(self.master_fd, sessions.READ_SIZE)
+            except BlockingIOError:
+                await _readable(self.master_fd)
+            except OSError as e:
+                # EIO once the shell and everything holding the slave side has exited
+                if e.errno == errno.EIO:
+                    return b''
+                raise
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.master_fd, view):]
+            except BlockingIOError:
+                await _writable(self.master_fd)
+
+    async def resize(self, rows, cols):
+        fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+    async def close(self):
+        if self.process and self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+        if self.master_fd is not None:
+            os.close(self.master_fd)
+            self.master_fd = None
+        if self.process:
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                await self.process.wait()
+
+
+# Runs in the child between fork and exec, after setsid
+def _take_controlling_tty():
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+# The fd can fire again before the waiting task runs
+def _wake(ready):
+    if not ready.done():
+        ready.set_result(None)
+
+
+async def _readable(fd):
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(fd, _wake, ready)
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)
+
+
+async def _writable(fd):
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_writer(fd, _wake, ready)
+    try:
+        await ready
+    finally:
+        loop.remove_writer(fd)
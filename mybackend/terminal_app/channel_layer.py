@@ -0,0 +1,247 @@
+import asyncio
+import collections
+import copy
+import hashlib
+import logging
+import time
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# channels_redis' group delivery script: push to every channel key still
+# under capacity and count the ones that are not
+GROUP_SEND_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+# Jump consistent hash: adding an (n+1)th shard moves only 1/(n+1) of the
+# keys, where channels_redis' CRC modulo moves most of them
+def jump_hash(key, buckets):
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+# channels_redis layer for job-status and terminal traffic.
+#
+# Channels of consumers in this process get group messages straight from
+# group_send: they are queued in memory for receive(), which waits on that
+# queue and on the usual Redis receive at once. Redis still holds every
+# group, so senders in other processes reach them the normal way, but a
+# local subscriber costs no push and no pop. Groups matching local_groups
+# are declared never to span processes and skip Redis entirely.
+#
+# The Redis side of group_send is pipelined: group lookup and expiry in
+# one round trip, then one per shard, with shards written concurrently.
+# Groups and channels are spread over the hosts by jump consistent hash.
+# Host entries may be dicts of redis ConnectionPool options, such as
+# max_connections, and each event loop keeps its own pool per host.
+class TerminalChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, local_groups=(), **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        # redis-py 8 times reads out after 5 s by default, as long as the
+        # blocking pop in receive() may wait for an idle channel
+        for host in self.hosts:
+            host.setdefault('socket_timeout', self.brpop_timeout + 5)
+        self.local_groups = tuple(local_groups)
+        # group -> {channel: time added}, for channels of this process only
+        self._groups = collections.defaultdict(dict)
+        self._channel_groups = collections.defaultdict(set)
+        # Event loop each local channel receives on; senders may run in
+        # the job engine's threads
+        self._channel_loops = {}
+        self._local = {}
+        self._waiters = {}
+        self._remote_receives = {}
+
+    def consistent_hash(self, value):
+        if self.ring_size == 1:
+            return 0
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        key = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'little')
+        return jump_hash(key, self.ring_size)
+
+    def _is_local(self, channel):
+        return f".{self.client_prefix}!" in channel
+
+    def _is_local_group(self, group):
+        return group.startswith(self.local_groups) if self.local_groups else False
+
+    async def send(self, channel, message):
+        if channel in self._channel_loops:
+            assert isinstance(message, dict), "message is not a dict"
+            if len(self._local.get(channel, ())) >= self.get_capacity(channel):
+                raise ChannelFull()
+            self._deliver(channel, message)
+            return
+        await super().send(channel, message)
+
+    async def receive(self, channel):
+        if not self._is_local(channel):
+            return await super().receive(channel)
+        loop = asyncio.get_running_loop()
+        self._channel_loops[channel] = loop
+        try:
+            while True:
+                message = self._pop_local(channel)
+                if message is not None:
+                    return message
+                # Left running across calls when local delivery wins, so a
+                # busy local channel does not keep restarting the Redis pop
+                remote = self._remote_receives.get(channel)
+                if remote is None:
+                    remote = self._remote_receives[channel] = asyncio.ensure_future(super().receive(channel))
+                waiter = self._waiters[channel] = loop.create_future()
+                await asyncio.wait((remote, waiter), return_when=asyncio.FIRST_COMPLETED)
+                if remote.done() and not self._local.get(channel):
+                    del self._remote_receives[channel]
+                    return remote.result()
+        except asyncio.CancelledError:
+            # The consumer is going away
+            remote = self._remote_receives.pop(channel, None)
+            if remote:
+                remote.cancel()
+                # It may still fail on its way out, with nobody left to ask
+                remote.add_done_callback(_discard_result)
+            self._forget(channel)
+            raise
+
+    async def group_add(self, group, channel):
+        if self._is_local(channel):
+            assert self.require_valid_group_name(group), "Group name not valid"
+            self._channel_loops.setdefault(channel, asyncio.get_running_loop())
+            self._groups[group][channel] = time.time()
+            self._channel_groups[channel].add(group)
+        if not self._is_local_group(group):
+            await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        members = self._groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self._groups[group]
+        if channel in self._channel_groups:
+            self._channel_groups[channel].discard(group)
+        if not self._is_local_group(group):
+            await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert self.require_valid_group_name(group), "Group name not valid"
+        members = self._groups.get(group)
+        if members:
+            stale = time.time() - self.group_expiry
+            for channel, added in list(members.items()):
+                if added > stale:
+                    self._deliver(channel, message)
+        if self._is_local_group(group):
+            return
+
+        key = self._group_key(group)
+        pipe = self.connection(self.consistent_hash(group)).pipeline(transaction=False)
+        pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+        pipe.zrange(key, 0, -1)
+        _, names = await pipe.execute()
+        # Local members were served above
+        remote = [name.decode('utf8') for name in names if not self._is_local(name.decode('utf8'))]
+        if not remote:
+            return
+
+        connection_to_keys, key_to_message, key_to_capacity = self._map_channel_keys_to_connection(remote, message)
+        await asyncio.gather(*(
+            self._send_to_shard(index, keys, key_to_message, key_to_capacity, group)
+            for index, keys in connection_to_keys.items()
+        ))
+
+    # Expire old messages and deliver to every channel key of one shard in a single round trip
+    async def _send_to_shard(self, index, keys, key_to_message, key_to_capacity, group):
+        now = time.time()
+        pipe = self.connection(index).pipeline(transaction=False)
+        for key in keys:
+            pipe.zremrangebyscore(key, min=0, max=int(now) - int(self.expiry))
+        pipe.eval(
+            GROUP_SEND_LUA, len(keys), *keys,
+            *(key_to_message[key] for key in keys),
+            *(key_to_capacity[key] for key in keys),
+            now, self.expiry,
+        )
+        results = await pipe.execute()
+        if results[-1] > 0:
+            logger.info(f"{results[-1]} of {len(keys)} channel keys over capacity in group {group}")
+
+    # Queue a message for a channel of this process, on its own loop
+    def _deliver(self, channel, message):
+        loop = self._channel_loops.get(channel)
+        if loop is None or loop.is_closed():
+            return
+        # What a Redis round trip would give: the receiver's own copy
+        message = copy.deepcopy(message)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._enqueue(channel, message)
+        else:
+            loop.call_soon_threadsafe(self._enqueue, channel, message)
+
+    def _enqueue(self, channel, message):
+        if channel not in self._channel_loops:
+            return
+        queue = self._local.get(channel)
+        if queue is None:
+            # Oldest messages drop first once full, as in channels_redis' receive buffer
+            queue = self._local[channel] = collections.deque(maxlen=self.get_capacity(channel))
+        queue.append((time.time() + self.expiry, message))
+        waiter = self._waiters.pop(channel, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _pop_local(self, channel):
+        queue = self._local.get(channel)
+        now = time.time()
+        while queue:
+            expires, message = queue.popleft()
+            if expires > now:
+                return message
+        return None
+
+    def _forget(self, channel):
+        for group in self._channel_groups.pop(channel, ()):
+            members = self._groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del self._groups[group]
+        self._channel_loops.pop(channel, None)
+        self._local.pop(channel, None)
+        self._waiters.pop(channel, None)
+
+    async def flush(self):
+        self._groups.clear()
+        self._channel_groups.clear()
+        self._local.clear()
+        await super().flush()
+
+
+def _discard_result(task):
+    if not task.cancelled():
+        task.exception()
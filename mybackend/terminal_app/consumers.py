@@ -1,51 +1,133 @@
-import docker
 import asyncio
+import base64
 from channels.generic.websocket import AsyncWebsocketConsumer
 import json
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 import logging
 import contextlib
+import time
+from urllib.parse import parse_qs
+from django.conf import settings
+from . import backends, job_status, metrics, screen, scrollback, sessions
+from .streaming import ZDICT, FrameEncoder, OutputCoalescer
 
 
 
-client = docker.from_env()
 container_name = "my_terminal_container"
+streaming_settings = getattr(settings, 'TERMINAL_STREAMING', {})
 
-def start_container(container_id):
-    running_containers = client.containers.list(filters={"id": container_id, "status": "running"})
-    if running_containers:
-        print(f"Container {container_id} is already running.")
-        return running_containers[0]
-    else:
-        print(f"Starting container {container_id}")
-        container = client.containers.get(container_id)
-        container.start()
-        return container
-
-async def read_from_docker(socket_docker):
-    loop = asyncio.get_running_loop()
-    while True:
-        try:
-            data = await loop.run_in_executor(None, socket_docker._sock.recv, 1024)
-            if data:
-                return data
-        except BlockingIOError:
-            await asyncio.sleep(0.01)  # Sleep briefly and retry
+TERMINAL_BYTES = metrics.Counter('terminal_bytes_total', 'Terminal bytes, in from clients and out to them', labelnames=('direction',))
+TERMINAL_FRAMES = metrics.Counter('terminal_frames_total', 'Terminal WebSocket frames, in from clients and out to them', labelnames=('direction',))
+BYTES_IN, BYTES_OUT = TERMINAL_BYTES.labels('in'), TERMINAL_BYTES.labels('out')
+FRAMES_IN, FRAMES_OUT = TERMINAL_FRAMES.labels('in'), TERMINAL_FRAMES.labels('out')
+COMPRESSION_BYTES = metrics.Counter('terminal_compression_bytes_total', 'Output of compressing sessions, before and after compression', labelnames=('stage',))
+COMPRESS_RAW, COMPRESS_SENT = COMPRESSION_BYTES.labels('raw'), COMPRESSION_BYTES.labels('sent')
+COMPRESS_SECONDS = metrics.Counter('terminal_compression_seconds_total', 'Time spent compressing output frames')
+ECHO_LATENCY = metrics.Histogram(
+    'terminal_echo_seconds', 'Time from client input to the next output frame sent to that client',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
 
 class TerminalConsumer(AsyncWebsocketConsumer):
+    # Session backend for the route, set with as_asgi(backend=...)
+    backend = 'docker'
+
+    def __init__(self, *args, backend=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if backend:
+            self.backend = backend
+
     async def connect(self):
-        self.container = None
-        self.socket_docker = None
+        self.attach = None
+        self.stream_task = None
+        self.output = None
         self.is_connected = False
-        self.container_id = self.scope['url_route']['kwargs']['container_id']
+        self.input_at = None
+        self.container_id = self.scope['url_route']['kwargs'].get('container_id')
         self.group_name = f"terminal_{self.container_id}"
         self.logger = logging.getLogger(__name__)
 
+        # ?mode=binary opts into raw byte frames, text frames stay the default.
+        # In binary mode text frames carry JSON control messages.
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.binary = query.get('mode', ['text'])[0] == 'binary'
+        # Terminal size from ?rows=&cols=, then from each resize; a session
+        # this client opens is recorded at this size
+        self.rows = _size(query, 'rows', 24)
+        self.cols = _size(query, 'cols', 80)
+        self.resized_early = False
+        # ?compress=deflate (binary mode) for clients without permessage-deflate
+        self.encoder = FrameEncoder(
+            binary=self.binary,
+            compress=query.get('compress', [None])[0] == 'deflate',
+            min_compress=streaming_settings.get('COMPRESS_MIN_BYTES', 256),
+            level=streaming_settings.get('COMPRESS_LEVEL', 1),
+        )
+        self.compress_seconds = 0.0
+        # ?offset=<n> asks for the scrollback after the last byte the client received
+        offset = query.get('offset', [None])[0]
+        self.scrollback_offset = int(offset) if offset and offset.isdigit() else None
+        # ?ack=1 (binary mode) makes the client report {"ack": <output bytes received>}
+        # now and then; output beyond HIGH_WATER_MARK unacknowledged bytes then
+        # waits, which is the only backpressure that reaches past the server.
+        # With ?view=screen, frames are skipped until the client catches up.
+        self.acked = self.binary and query.get('ack', [None])[0] == '1'
+        # ?view=screen sends screen diffs at a capped frame rate instead of raw output
+        self.screen_view = query.get('view', ['raw'])[0] == 'screen'
+        if self.screen_view and not screen.available():
+            self.logger.warning("pyte is not installed, ?view=screen falls back to raw output.")
+            self.screen_view = False
+
+        # Local shells run on this host, so only staff get one
+        if self.backend == 'local':
+            user = self.scope.get('user')
+            if user is None or not user.is_staff:
+                await self.close()
+                return
+        # SSH sessions connect out from this server, so only signed-in users get one
+        if self.backend == 'ssh':
+            user = self.scope.get('user')
+            if user is None or not user.is_authenticated:
+                await self.close()
+                return
+
         try:
             # Retrieve session_id from URL
             await self.accept()
-            asyncio.create_task(self.start_streaming())
+            if self.encoder.compressing:
+                # Ahead of any output, so the client can set up its inflater first
+                await self.send(text_data=json.dumps({'compress': {
+                    'algorithm': 'deflate-raw',
+                    'dictionary': base64.b64encode(ZDICT).decode(),
+                    'minBytes': self.encoder.min_compress,
+                }}))
+            if self.screen_view:
+                self.output = screen.ScreenRenderer(
+                    self.send_output,
+                    rows=self.rows,
+                    cols=self.cols,
+                    fps=streaming_settings.get('SCREEN_FPS', 30),
+                    max_parse=streaming_settings.get('SCREEN_PARSE_BYTES', 8192),
+                    acked=self.acked,
+                )
+            else:
+                self.output = OutputCoalescer(
+                    self.send_output,
+                    max_frame=streaming_settings.get('MAX_FRAME_BYTES', 16384),
+                    flush_interval=streaming_settings.get('FLUSH_INTERVAL', 0.005),
+                    high_water=streaming_settings.get('HIGH_WATER_MARK', 256 * 1024),
+                    acked=self.acked,
+                )
+            if self.backend == 'docker':
+                self.stream_task = asyncio.create_task(
+                    self.start_streaming(self.container_id, lambda: backends.DockerBackend(self.container_id))
+                )
+            elif self.backend == 'local':
+                self.stream_task = asyncio.create_task(
+                    self.start_streaming(f"local:{self.channel_name}", backends.LocalPTYBackend)
+                )
+            # SSH sessions open once the client sends its credentials
 
         except Exception as e:
             print(f"Connection error: {e}")
@@ -71,93 +153,206 @@ class TerminalConsumer(AsyncWebsocketConsumer):
             yield
         finally:
             self.logger.info("Starting terminal session cleanup.")
+            if self.encoder.compressing and self.encoder.sent_bytes:
+                self.logger.info(
+                    f"Compressed {self.encoder.raw_bytes} bytes to {self.encoder.sent_bytes} "
+                    f"({self.encoder.raw_bytes / self.encoder.sent_bytes:.1f}x) in {self.compress_seconds * 1000:.1f} ms."
+                )
+            if self.stream_task and self.stream_task is not asyncio.current_task():
+                self.stream_task.cancel()
+            if self.output:
+                await self.output.close(flush=False)
             if self.is_connected:
                 self.is_connected = False
-                if self.socket_docker:
-                    self.logger.info("Closing WebSocket connection to Docker...")
+                if self.attach:
+                    attach, self.attach = self.attach, None
                     try:
-                        self.socket_docker.close()
-                        self.logger.info("WebSocket connection to Docker closed.")
+                        await sessions.unsubscribe(attach, self)
                     except Exception as e:
-                        self.logger.error(f"Error closing WebSocket connection to Docker: {e}")
+                        self.logger.error(f"Error leaving session stream {attach.key}: {e}")
             await self.close(code=1000)
             self.logger.info("Terminal session cleaned up successfully.")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            if self.socket_docker:
-                self.socket_docker._sock.send(text_data.encode())
+            FRAMES_IN.inc()
+            if bytes_data is None and (self.binary or self.attach is None):
+                await self.receive_control(text_data)
+                return
+            data = bytes_data if bytes_data is not None else text_data.encode()
+            BYTES_IN.inc(len(data))
+            if self.attach:
+                if self.input_at is None:
+                    self.input_at = time.monotonic()
+                await self.attach.write(data)
         except Exception as e:
             print(f"Error in receive: {e}")
 
-    async def start_streaming(self):
-        print("start")
-        if not self.is_connected:
-            self.container = start_container(self.container_id)
-            if self.container:
-                self.socket_docker = self.container.attach_socket(params={'stdin': 1, 'stdout': 1, 'stderr': 1, 'stream': 1})
-                self.socket_docker._sock.setblocking(False)
-                self.is_connected = True
-                self.logger.info("Streaming started.")
+    # {"resize": {"rows": r, "cols": c}}, {"ack": n}, or SSH credentials before the session is open
+    async def receive_control(self, text_data):
+        try:
+            message = json.loads(text_data)
+        except json.JSONDecodeError:
+            return
+        if not isinstance(message, dict):
+            return
+
+        if 'ack' in message:
+            if self.acked and isinstance(message['ack'], int):
+                self.output.ack(message['ack'])
+        elif 'resize' in message:
+            size = message['resize']
+            self.rows = min(max(int(size.get('rows', 24)), 1), 1000)
+            self.cols = min(max(int(size.get('cols', 80)), 1), 1000)
+            if self.screen_view and self.output:
+                self.output.resize(self.rows, self.cols)
+            if self.attach:
+                await self.attach.resize(self.rows, self.cols)
             else:
-                self.logger.error(f"Failed to start container {self.container_id}")
-                await self.close()
+                # Applied once the session is open
+                self.resized_early = True
+        elif self.backend == 'ssh' and self.attach is None and {'host', 'username', 'password'} <= message.keys():
+            if self.stream_task and not self.stream_task.done():
+                return
+            host, port = message['host'], message.get('port', 22)
+            if isinstance(port, str) and port.isdigit():
+                port = int(port)
+            if not isinstance(host, str) or not isinstance(port, int) or not backends.ssh_destination_allowed(host, port):
+                self.logger.warning(f"Refused SSH session to {host!r} port {port!r}: not in SSH_ALLOWED_HOSTS.")
+                await self.send(text_data=json.dumps({"status": "error", "message": "SSH to this host is not allowed."}))
                 return
+            self.stream_task = asyncio.create_task(self.start_streaming(
+                f"ssh:{self.channel_name}",
+                lambda: backends.SSHBackend(host, message['username'], message['password'], port=port),
+            ))
+
+    async def start_streaming(self, key, make_backend):
+        print("start")
+        try:
+            self.attach = await sessions.subscribe(key, self, make_backend)
+        except asyncio.CancelledError:
+            raise
+        except backends.BackendError as e:
+            await self.send(text_data=json.dumps({"status": "error", "message": str(e)}))
+            # SSH clients may retry with other credentials
+            if self.backend != 'ssh':
+                await self.close()
+            return
+        except Exception as e:
+            self.logger.error(f"Failed to open {self.backend} session {key}: {e}")
+            await self.close()
+            return
+        # Before anything awaits, so the screen sees all output from here on
+        if self.screen_view:
+            self.output.attach(self.attach)
+        if self.resized_early:
+            await self.attach.resize(self.rows, self.cols)
+        self.is_connected = True
+        if self.backend == 'ssh':
+            await self.send(text_data=json.dumps({"status": "connected"}))
 
+        # Nothing can reach the stream between subscribing and queuing the
+        # replay, so the replay joins the live output without gaps or repeats
+        if self.scrollback_offset is not None and self.attach.backend.shared:
+            start, replay = scrollback.store.read_from(key, self.scrollback_offset)
+            self.output.prime(replay)
+            await self.send(text_data=json.dumps({'scrollback': {'offset': start}}))
+        self.output.start()
+        self.logger.info("Streaming started.")
 
-        while self.is_connected:
-            try:
-                docker_recv = asyncio.create_task(read_from_docker(self.socket_docker))
+    # Called by the session stream once its output has ended
+    async def stream_ended(self):
+        await self.output.close()
+        frame = self.encoder.encode(b'', final=True)
+        if frame:
+            await self.send(**frame)
+        await self.close()
 
-                done, pending = await asyncio.wait(
-                    [docker_recv],
-                    return_when=asyncio.FIRST_COMPLETED
-                )
+    async def send_output(self, data):
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(len(data))
+        if self.input_at is not None:
+            ECHO_LATENCY.observe(time.monotonic() - self.input_at)
+            self.input_at = None
+        if self.encoder.compressing:
+            started = time.perf_counter()
+            frame = self.encoder.encode(data)
+            elapsed = time.perf_counter() - started
+            self.compress_seconds += elapsed
+            COMPRESS_SECONDS.inc(elapsed)
+            COMPRESS_RAW.inc(len(data))
+            COMPRESS_SENT.inc(len(frame['bytes_data']))
+        else:
+            frame = self.encoder.encode(data)
+        if frame:
+            await self.send(**frame)
 
-                for task in done:
-                    output = task.result()
-                    if output:
-                        await self.send(text_data=output.decode('utf-8', errors='replace'))
 
-                # Cancel any remaining tasks
-                for task in pending:
-                    task.cancel()
+# Terminal rows or columns from the query string, within sane bounds
+def _size(query, name, default):
+    value = query.get(name, [''])[0]
+    return min(max(int(value), 1), 1000) if value.isdigit() else default
 
-            except Exception as e:
-                print(f"Error in streaming: {e}")
-                for task in pending:
-                    task.cancel()
-                await self.close()
-                break
 
+# Most containers one job-status connection may follow
+MAX_SUBSCRIPTIONS = 100
 
 class JobConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_name = "job_status"
-        self.room_group_name = f"status_{self.room_name}"
-
-        await self.channel_layer.group_add(
-            self.room_group_name, self.channel_name
-        )
-        # print(f"group added: {self.channel_layer.groups}")
-
+        self.subscriptions = set()
         await self.accept()
 
-    async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(
-            self.room_group_name, self.channel_name
-        )
+        # Staff may follow every container with ?firehose=1
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        user = self.scope.get('user')
+        if query.get('firehose') == ['1'] and user is not None and user.is_staff:
+            await self._join(job_status.FIREHOSE_GROUP)
 
+    async def disconnect(self, close_code):
+        for group in list(self.subscriptions):
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.subscriptions.clear()
 
+    # {"action": "subscribe" | "unsubscribe", "containerIds": [...]}
     async def receive(self, text_data):
-        # Handle messages from the client if needed
-        pass
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            return
+        if not isinstance(data, dict) or not isinstance(data.get('containerIds'), list):
+            return
+
+        for container_id in data['containerIds']:
+            if not job_status.is_container_id(container_id):
+                continue
+            group = job_status.container_group(container_id)
+            if data.get('action') == 'subscribe':
+                if group in self.subscriptions or len(self.subscriptions) >= MAX_SUBSCRIPTIONS:
+                    continue
+                await self._join(group)
+                last = await job_status.last_status(container_id)
+                if last:
+                    await self.job_status_update(last)
+            elif data.get('action') == 'unsubscribe' and group in self.subscriptions:
+                self.subscriptions.discard(group)
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def _join(self, group):
+        self.subscriptions.add(group)
+        await self.channel_layer.group_add(group, self.channel_name)
 
     async def job_status_update(self, event):
         # Send message to WebSocket
         print(f"Sending message to WebSocket: {event}")
-        await self.send(text_data=json.dumps({
+        message = {
             'containerId': event['containerId'],
             'message': event['message'],
             'status': event['status']
-        }))
\ No newline at end of file
+        }
+        if 'jobId' in event:
+            message['jobId'] = event['jobId']
+        await self.send(text_data=json.dumps(message))
+
+    async def job_progress(self, event):
+        # Batched install output and phase changes, already in wire format
+        await self.send(text_data=json.dumps(event['payload'], separators=(',', ':')))
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from . import docker_control, workers
+
+logger = logging.getLogger(__name__)
+
+# Container status after each event action, None drops the container
+EVENT_STATUS = {
+    'create': 'created',
+    'start': 'running',
+    'restart': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'die': 'exited',
+    'stop': 'exited',
+    'destroy': None,
+}
+
+
+# In-process index of container id/name/status/image. It is seeded with one
+# containers.list and then kept current from the daemon's event stream.
+# While the stream is down the index reports not ready, callers fall back
+# to asking the daemon, and a fresh seed is taken once it reconnects.
+class ContainerIndex:
+    def __init__(self, client, max_backoff=30):
+        self.client = client
+        self.max_backoff = max_backoff
+        self._by_id = {}
+        self._by_name = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._events = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="container-index", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._events is not None:
+            self._events.close()
+
+    # Entry for a full or short container id, None when unknown
+    def get(self, container_id):
+        with self._lock:
+            entry = self._by_id.get(container_id)
+            if entry is None and len(container_id) < 64:
+                entry = next((e for cid, e in self._by_id.items() if cid.startswith(container_id)), None)
+            return dict(entry) if entry else None
+
+    # {id: status} of every container in one of the statuses
+    def with_status(self, *statuses):
+        with self._lock:
+            return {cid: entry['status'] for cid, entry in self._by_id.items() if entry['status'] in statuses}
+
+    def find_running(self, name):
+        with self._lock:
+            entry = self._by_id.get(self._by_name.get(name))
+            return dict(entry) if entry and entry['status'] == 'running' else None
+
+    def _run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                # Events from before the seed are replayed, so nothing falls in the gap
+                since = int(time.time()) - 1
+                self._seed()
+                self._events = self.client.events(decode=True, filters={'type': 'container'}, since=since)
+                self._ready.set()
+                backoff = 1
+                for event in self._events:
+                    self._apply(event)
+                logger.warning("Docker event stream ended, resyncing container index.")
+            except Exception as e:
+                if self._stopped.is_set():
+                    break
+                logger.error(f"Docker event stream failed, resyncing in {backoff}s: {e}")
+                self._ready.clear()
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            self._ready.clear()
+
+    # One list call: sparse skips the inspect per container, and the list
+    # payload already has the name, state and image
+    def _seed(self):
+        containers = self.client.containers.list(all=True, sparse=True)
+        by_id, by_name = {}, {}
+        for container in containers:
+            names = container.attrs.get('Names') or ['']
+            name = names[0].lstrip('/')
+            by_id[container.id] = {
+                'id': container.id,
+                'name': name,
+                'status': container.attrs.get('State'),
+                'image': container.attrs.get('Image'),
+            }
+            by_name[name] = container.id
+        with self._lock:
+            self._by_id, self._by_name = by_id, by_name
+
+    def _apply(self, event):
+        action = event.get('Action', '')
+        if action not in EVENT_STATUS and action != 'rename':
+            return
+        actor = event.get('Actor', {})
+        container_id = actor.get('ID') or event.get('id')
+        attributes = actor.get('Attributes', {})
+        with self._lock:
+            entry = self._by_id.get(container_id)
+            if action == 'destroy':
+                if entry:
+                    self._by_id.pop(container_id, None)
+                    if self._by_name.get(entry['name']) == container_id:
+                        del self._by_name[entry['name']]
+                return
+            if entry is None:
+                entry = self._by_id[container_id] = {'id': container_id, 'name': None, 'status': None, 'image': None}
+            name = attributes.get('name')
+            if name and name != entry['name']:
+                if self._by_name.get(entry['name']) == container_id:
+                    del self._by_name[entry['name']]
+                entry['name'] = name
+                self._by_name[name] = container_id
+            entry['image'] = attributes.get('image', entry['image'])
+            if action != 'rename':
+                entry['status'] = EVENT_STATUS[action]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+# Process-wide index, started on first use; None when disabled in settings
+# or in runworkers workers other than the primary, which ask the daemon
+def get_index():
+    global _index
+    if not getattr(settings, 'CONTAINER_INDEX', {}).get('ENABLED', False) or not workers.PRIMARY:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ContainerIndex(docker_control.get_client())
+                _index.start()
+    return _index
+
+
+def stop_index():
+    if _index is not None:
+        _index.stop()
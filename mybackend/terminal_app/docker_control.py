@@ -0,0 +1,51 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+from django.conf import settings
+
+from . import metrics
+
+docker_settings = getattr(settings, 'DOCKER_CONTROL', {})
+MAX_WORKERS = docker_settings.get('MAX_WORKERS', 8)
+TIMEOUT = docker_settings.get('TIMEOUT', 30)
+STREAM_WORKERS = docker_settings.get('STREAM_WORKERS', 8)
+
+# Dedicated pool for daemon calls, so a slow daemon ties up these workers
+# rather than the event loop or the default executor
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="docker-control")
+# Reads of exec output wait on the container's command, not the daemon, for
+# as long as an install runs. They get threads of their own, so running
+# jobs never hold up attaches, request-path calls or pause and resume.
+stream_executor = ThreadPoolExecutor(max_workers=STREAM_WORKERS, thread_name_prefix="docker-stream")
+
+metrics.Gauge('docker_executor_queue_depth', 'Docker SDK calls waiting for a worker', function=lambda: executor._work_queue.qsize())
+
+_client = None
+_client_lock = threading.Lock()
+
+# Shared Docker client. Its HTTP connection pool to the daemon socket is sized
+# to both worker pools, so each worker reuses a kept-alive connection.
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = docker.from_env(max_pool_size=MAX_WORKERS + STREAM_WORKERS, timeout=TIMEOUT)
+    return _client
+
+# Await a blocking Docker SDK call from async code
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+# Await the next read of a long-lived stream, such as exec output
+async def stream(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(stream_executor, functools.partial(fn, *args, **kwargs))
+
+# Make a Docker SDK call from a request thread through the same bounded pool
+def run_sync(fn, *args, **kwargs):
+    return executor.submit(fn, *args, **kwargs).result(TIMEOUT)
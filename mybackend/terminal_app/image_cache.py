@@ -0,0 +1,157 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CACHE_REPOSITORY = "terminal_app/cache"
+KEY_LABEL = "terminal_app.cache.key"
+BASE_LABEL = "terminal_app.cache.base_id"
+BASE_IMAGE_LABEL = "terminal_app.cache.base_image"
+# Marks the throwaway containers images are built in
+BUILDER_LABEL = "terminal_app.cache.builder"
+
+
+# Derived images keyed by (system, sorted package ids). After the first
+# provision of a combination the same packages are installed again in a
+# builder container no session can reach, which is committed to a local
+# tag; later creates start from it. A user's own container is never
+# committed, anything they typed or left in it would reach every later user.
+# Entries are kept in LRU order and evicted once their combined size passes
+# the disk budget, and dropped when the base image they were built from is
+# no longer the one tagged locally.
+class ImageCache:
+    def __init__(self, client, disk_budget):
+        self.client = client
+        self.disk_budget = disk_budget
+        self._entries = OrderedDict()  # tag -> {'size', 'base_id', 'base_image'}
+        self._building = set()
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @staticmethod
+    def cache_key(system, packages):
+        return f"{system}:{','.join(str(p) for p in sorted(set(packages)))}"
+
+    def tag_for(self, system, packages):
+        digest = hashlib.sha1(self.cache_key(system, packages).encode()).hexdigest()[:16]
+        return f"{CACHE_REPOSITORY}:{system}-{digest}"
+
+    # Return the cached tag for the combination, or None on a miss
+    def lookup(self, system, packages, base_image):
+        self._load()
+        tag = self.tag_for(system, packages)
+        with self._lock:
+            entry = self._entries.get(tag)
+        if entry is None:
+            return None
+        if entry['base_id'] != self._base_id(base_image):
+            logger.info(f"Base image {base_image} changed, invalidating {tag}")
+            self._remove(tag)
+            return None
+        with self._lock:
+            if tag in self._entries:
+                self._entries.move_to_end(tag)
+        return tag
+
+    # Claim the build of a combination, False when it is cached or already being built
+    def begin_build(self, system, packages):
+        self._load()
+        tag = self.tag_for(system, packages)
+        with self._lock:
+            if tag in self._entries or tag in self._building:
+                return False
+            self._building.add(tag)
+            return True
+
+    def end_build(self, system, packages):
+        with self._lock:
+            self._building.discard(self.tag_for(system, packages))
+
+    # Commit a builder container as the image for its combination
+    def store(self, system, packages, base_image, container):
+        self._load()
+        tag = self.tag_for(system, packages)
+        repository, tag_name = tag.split(":", 1)
+        base_id = container.attrs.get('Image') or self._base_id(base_image)
+        image = container.commit(
+            repository=repository,
+            tag=tag_name,
+            conf={'Labels': {
+                KEY_LABEL: self.cache_key(system, packages),
+                BASE_LABEL: base_id,
+                BASE_IMAGE_LABEL: base_image,
+            }},
+        )
+        size = image.attrs.get('Size', 0)
+        with self._lock:
+            self._entries[tag] = {'size': size, 'base_id': base_id, 'base_image': base_image}
+            self._entries.move_to_end(tag)
+        logger.info(f"Cached provisioned image {tag} ({size} bytes)")
+        self._evict()
+        return tag
+
+    # Drop entries built from an older base image, or every entry when no base is given
+    def invalidate(self, base_image=None):
+        self._load()
+        current = self._base_id(base_image) if base_image else None
+        with self._lock:
+            stale = [
+                tag for tag, entry in self._entries.items()
+                if base_image is None
+                or (entry['base_image'] == base_image and entry['base_id'] != current)
+            ]
+        for tag in stale:
+            self._remove(tag)
+        return stale
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(entry['size'] for entry in self._entries.values()),
+                'disk_budget': self.disk_budget,
+            }
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        images = self.client.images.list(filters={'label': KEY_LABEL})
+        images.sort(key=lambda image: image.attrs.get('Created', ''))
+        with self._lock:
+            for image in images:
+                for tag in image.tags:
+                    if tag.startswith(CACHE_REPOSITORY + ":"):
+                        self._entries[tag] = {
+                            'size': image.attrs.get('Size', 0),
+                            'base_id': image.labels.get(BASE_LABEL),
+                            'base_image': image.labels.get(BASE_IMAGE_LABEL),
+                        }
+
+    def _base_id(self, base_image):
+        try:
+            return self.client.images.get(base_image).id
+        except Exception:
+            return None
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                total = sum(entry['size'] for entry in self._entries.values())
+                if total <= self.disk_budget or len(self._entries) <= 1:
+                    return
+                tag = next(iter(self._entries))
+            logger.info(f"Image cache over budget ({total} bytes), evicting {tag}")
+            self._remove(tag)
+
+    def _remove(self, tag):
+        with self._lock:
+            self._entries.pop(tag, None)
+        try:
+            # force only drops the tag while containers still use the image
+            self.client.images.remove(tag, force=True)
+        except Exception as e:
+            logger.error(f"Error removing cached image {tag}: {e}")
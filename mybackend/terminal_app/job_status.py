@@ -0,0 +1,41 @@
+import re
+import time
+
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from . import metrics
+
+# Group every job event is also sent to, for admin dashboards
+FIREHOSE_GROUP = "job_status_all"
+
+# How long the last status of a container is kept for late subscribers
+LAST_STATUS_TTL = 3600
+
+CONTAINER_ID_RE = re.compile(r'[0-9a-f]{12,64}')
+
+CHANNEL_SEND = metrics.Histogram('channel_layer_send_seconds', 'Time for one group_send of a job event')
+
+
+def container_group(container_id):
+    return f"job_status_{container_id}"
+
+
+def is_container_id(value):
+    return isinstance(value, str) and CONTAINER_ID_RE.fullmatch(value) is not None
+
+
+# Send a job event to the container's subscribers and the firehose
+async def publish(container_id, event, channel_layer=None):
+    channel_layer = channel_layer or get_channel_layer()
+    for group in (container_group(container_id), FIREHOSE_GROUP):
+        started = time.perf_counter()
+        await channel_layer.group_send(group, event)
+        CHANNEL_SEND.observe(time.perf_counter() - started)
+    if event['type'] == 'job_status_update':
+        # A client subscribing right after create must not miss a fast completion
+        await cache.aset(f"job_status:last:{container_id}", event, LAST_STATUS_TTL)
+
+
+async def last_status(container_id):
+    return await cache.aget(f"job_status:last:{container_id}")
@@ -0,0 +1,310 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import job_status, metrics, workers
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first, so stops overtake queued installs
+PRIORITIES = {
+    'stop': 0,
+    'exec': 5,
+    'provision': 10,
+    'cache': 20,
+}
+
+# Seconds a worker waits for the primary to answer a cancel
+CANCEL_TIMEOUT = 5
+
+# Job bodies by name, so a job submitted in one process can run in another
+TASKS = {}
+
+
+def task(fn):
+    TASKS[fn.__name__] = fn
+    return fn
+
+
+class Job:
+    def __init__(self, kind, fn, container_id=None, priority=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.kind = kind
+        self.fn = fn
+        self.container_id = container_id
+        self.priority = PRIORITIES.get(kind, 10) if priority is None else priority
+        self.status = 'queued'
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    # Queued jobs are dropped; running jobs see the flag at their next step
+    def cancel(self):
+        self._cancelled.set()
+
+
+# Fixed set of worker threads fed from a priority queue. Each kind of job
+# has its own concurrency cap, so a burst of installs cannot take every
+# worker, and each worker keeps one event loop for the async job bodies
+# instead of a new thread and loop per job.
+class JobEngine:
+    def __init__(self, workers=4, limits=None):
+        self.workers = workers
+        self.limits = limits or {}
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = {}
+        self._jobs = {}
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{number}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, kind, fn, container_id=None, priority=None, job_id=None):
+        self.start()
+        job = Job(kind, fn, container_id, priority, job_id)
+        with self._cond:
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (job.priority, next(self._seq), job))
+            self._cond.notify()
+        return job
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job:
+            self._cancel(job)
+        return job
+
+    # Cancel every pending or running job for a container, optionally only some kinds
+    def cancel_container(self, container_id, kinds=None):
+        with self._cond:
+            jobs = [
+                job for job in self._jobs.values()
+                if job.container_id == container_id and (kinds is None or job.kind in kinds)
+            ]
+        for job in jobs:
+            self._cancel(job)
+        return jobs
+
+    # A queued job leaves the queue and is reported cancelled right away; a
+    # running one sees the flag at its next step and is reported when it ends
+    def _cancel(self, job):
+        job.cancel()
+        with self._cond:
+            if job.status != 'queued':
+                return
+            job.status = 'cancelled'
+            self._jobs.pop(job.id, None)
+            self._queue = [entry for entry in self._queue if entry[2] is not job]
+            heapq.heapify(self._queue)
+        try:
+            async_to_sync(publish_cancelled)(job)
+        except Exception as e:
+            logger.error(f"Publishing cancellation of job {job.id} failed: {e}")
+
+    def idle(self):
+        with self._cond:
+            return not self._queue and not any(self._running.values())
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': len(self._queue),
+                'running': dict(self._running),
+                'workers': self.workers,
+            }
+
+    def _next_job(self):
+        skipped = []
+        job = None
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            candidate = entry[2]
+            if candidate.cancelled:
+                candidate.status = 'cancelled'
+                self._jobs.pop(candidate.id, None)
+                continue
+            limit = self.limits.get(candidate.kind)
+            if limit is not None and self._running.get(candidate.kind, 0) >= limit:
+                skipped.append(entry)
+                continue
+            job = candidate
+            break
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return job
+
+    def _worker(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.kind] = self._running.get(job.kind, 0) + 1
+                job.status = 'running'
+
+            try:
+                loop.run_until_complete(job.fn(job))
+                job.status = 'cancelled' if job.cancelled else 'done'
+            except Exception as e:
+                job.status = 'failed'
+                logger.error(f"Job {job.kind} {job.id} for {job.container_id} failed: {e}")
+            finally:
+                with self._cond:
+                    self._running[job.kind] -= 1
+                    self._jobs.pop(job.id, None)
+                    # A slot for this kind is free, capped jobs may be runnable now
+                    self._cond.notify_all()
+            if job.status == 'cancelled':
+                try:
+                    loop.run_until_complete(publish_cancelled(job))
+                except Exception as e:
+                    logger.error(f"Publishing cancellation of job {job.id} failed: {e}")
+
+
+# Under runworkers only the primary worker runs an engine; the others hand
+# their jobs over on this channel, which keeps them in submission order
+def jobs_channel():
+    return f"terminal-jobs.{workers.GROUP}"
+
+
+# Run TASKS[name](job, **kwargs) as a job of kind on the primary's engine.
+# A job handed over from another worker is returned as a Job carrying only
+# its id, kind and container.
+def submit(kind, name, container_id=None, **kwargs):
+    if workers.PRIMARY:
+        return engine.submit(kind, functools.partial(TASKS[name], **kwargs), container_id)
+    job = Job(kind, None, container_id)
+    async_to_sync(get_channel_layer().send)(jobs_channel(), {
+        'type': 'job.submit', 'id': job.id, 'kind': kind, 'task': name, 'container_id': container_id, 'kwargs': kwargs,
+    })
+    return job
+
+
+# Status of the job after cancelling it, None when no such job is queued or running
+def cancel(job_id):
+    if workers.PRIMARY:
+        job = engine.cancel(job_id)
+        return job.status if job else None
+    return async_to_sync(_ask_primary)({'type': 'job.cancel', 'id': job_id})['status']
+
+
+def cancel_container(container_id, kinds=None):
+    if workers.PRIMARY:
+        engine.cancel_container(container_id, kinds)
+        return
+    async_to_sync(get_channel_layer().send)(jobs_channel(), {
+        'type': 'job.cancel_container', 'container_id': container_id, 'kinds': list(kinds) if kinds else None,
+    })
+
+
+async def _ask_primary(message):
+    channel_layer = get_channel_layer()
+    reply = await channel_layer.new_channel()
+    await channel_layer.send(jobs_channel(), {**message, 'reply': reply})
+    return await asyncio.wait_for(channel_layer.receive(reply), CANCEL_TIMEOUT)
+
+
+# Takes, in the primary worker, the jobs and cancels other workers hand
+# over, on an event loop of its own
+class JobReceiver:
+    def __init__(self):
+        self._thread = None
+        self._loop = None
+        self._task = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is not None or not workers.GROUP:
+            return
+        self._thread = threading.Thread(target=self._run, name="job-receiver", daemon=True)
+        self._thread.start()
+
+    # Jobs handed over from now on wait in the channel for the next primary
+    def stop(self):
+        self._stopped.set()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        self._task = loop.create_task(self._receive())
+        self._loop = loop
+        try:
+            loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+
+    async def _receive(self):
+        channel_layer = get_channel_layer()
+        while not self._stopped.is_set():
+            try:
+                message = await channel_layer.receive(jobs_channel())
+                # The engine publishes cancellations with async_to_sync
+                reply = await asyncio.to_thread(self._handle, message)
+                if message.get('reply'):
+                    await channel_layer.send(message['reply'], {'type': 'job.reply', **reply})
+            except Exception as e:
+                logger.error(f"Handling a job from another worker failed: {e}")
+                await asyncio.sleep(1)
+
+    def _handle(self, message):
+        if message['type'] == 'job.submit':
+            engine.submit(
+                message['kind'], functools.partial(TASKS[message['task']], **message['kwargs']),
+                message['container_id'], job_id=message['id'],
+            )
+        elif message['type'] == 'job.cancel':
+            job = engine.cancel(message['id'])
+            return {'status': job.status if job else None}
+        elif message['type'] == 'job.cancel_container':
+            engine.cancel_container(message['container_id'], kinds=message['kinds'])
+        return {}
+
+
+# Tell the container's job-status subscribers that a job will not run, or stopped early
+async def publish_cancelled(job):
+    if job.container_id is None:
+        return
+    await job_status.publish(job.container_id, {
+        'type': 'job_status_update',
+        'containerId': job.container_id,
+        'jobId': job.id,
+        'message': f"{job.kind.capitalize()} job on container {job.container_id} cancelled.",
+        'status': f"{job.kind} cancelled",
+    })
+
+
+job_settings = getattr(settings, 'JOB_ENGINE', {})
+engine = JobEngine(
+    workers=job_settings.get('WORKERS', 4),
+    limits=job_settings.get('LIMITS', {'provision': 2, 'exec': 2, 'stop': 4, 'cache': 1}),
+)
+receiver = JobReceiver()
+
+metrics.Gauge('jobs_queued', 'Jobs waiting for a worker or a free slot for their kind', function=lambda: len(engine._queue))
+metrics.Gauge(
+    'jobs_running', 'Jobs running by kind', labelnames=('kind',),
+    function=lambda: {(kind,): count for kind, count in engine.stats()['running'].items()},
+)
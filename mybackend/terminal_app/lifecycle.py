@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+
+import docker
+from django.conf import settings
+from django.core.cache import cache
+
+from . import docker_control, metrics, workers
+from .container_index import get_index
+from .metrics import LatencySamples
+
+logger = logging.getLogger(__name__)
+
+# Without the container index, writes within this many seconds of output skip checking whether it is paused
+RECENT_OUTPUT = 1.0
+# Writes within this many seconds of finding a container running skip asking the shared cache again
+RUNNING_TTL = 5.0
+
+
+def last_io_key(container_id):
+    return f"lifecycle:last_io:{container_id}"
+
+
+def paused_key(container_id):
+    return f"lifecycle:paused:{container_id}"
+
+
+# Pauses containers whose terminals have been quiet for pause_after seconds
+# and stops them after stop_after. Terminal I/O is stamped locally by the
+# consumers and published to the shared cache every check_interval, so
+# with several processes or nodes a container counts as idle only once it
+# has been quiet in all of them. Candidates are the containers Docker
+# reports running or paused that have a published stamp, and their state
+# comes from Docker too. Under runworkers only the primary worker runs the
+# checks; it marks the containers it finds paused in the cache, so any
+# process can resume them without asking Docker. Stamps and marks expire
+# after stop_after plus pause_after and are deleted when the manager stops
+# a container, so nothing piles up.
+class LifecycleManager:
+    def __init__(self, pause_after=900, stop_after=4 * 3600, remove_on_stop=False, check_interval=30):
+        self.pause_after = pause_after
+        self.stop_after = stop_after
+        self.remove_on_stop = remove_on_stop
+        self.check_interval = check_interval
+
+        self._last_io = {}
+        self._last_output = {}
+        # container id -> time.monotonic() until which it is taken to be running
+        self._running_until = {}
+        self._published = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self.paused = 0
+        self.paused_total = 0
+        self.resumed_total = 0
+        self.stopped_total = 0
+        self.resume_latency = LatencySamples()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="container-lifecycle", daemon=True)
+            self._thread.start()
+
+    # Called on every chunk of terminal traffic, so it only stamps a time
+    def touch(self, container_id, output=False):
+        now = time.time()
+        self._last_io[container_id] = now
+        if output:
+            self._last_output[container_id] = now
+
+    # Unpause a container, whoever paused it, before it is attached to or written to.
+    # Runs on every input write: once the container is known to be running,
+    # writes for RUNNING_TTL seconds take that on trust instead of asking the
+    # shared cache per keystroke. It cannot be paused in that time unless its
+    # terminals were already quiet for pause_after seconds before it.
+    async def ensure_running(self, container_id):
+        self.touch(container_id)
+        if self._running_until.get(container_id, 0) > time.monotonic():
+            return
+        index = get_index()
+        if index and index.ready:
+            entry = index.get(container_id)
+            if not entry or entry['status'] != 'paused':
+                return
+        elif time.time() - self._last_output.get(container_id, 0) < RECENT_OUTPUT:
+            # A paused container prints nothing, so it was running a moment ago
+            return
+        elif not await cache.aget(paused_key(container_id)):
+            self._running_until[container_id] = time.monotonic() + RUNNING_TTL
+            return
+        started = time.monotonic()
+        try:
+            await docker_control.run(docker_control.get_client().api.unpause, container_id)
+        except docker.errors.APIError as e:
+            # Not paused after all: another process resumed it first
+            if e.status_code != 409:
+                raise
+            await cache.adelete(paused_key(container_id))
+            self._running_until[container_id] = time.monotonic() + RUNNING_TTL
+            return
+        await cache.adelete(paused_key(container_id))
+        self._running_until[container_id] = time.monotonic() + RUNNING_TTL
+        with self._lock:
+            self.resumed_total += 1
+        self.resume_latency.observe(time.monotonic() - started)
+        logger.info(f"Resumed idle container {container_id[:12]}.")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked': len(self._last_io),
+                'paused': self.paused,
+                'paused_total': self.paused_total,
+                'resumed_total': self.resumed_total,
+                'stopped_total': self.stopped_total,
+                'pause_after': self.pause_after,
+                'stop_after': self.stop_after,
+                'resume_latency': self.resume_latency.summary(),
+            }
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self._publish()
+                if workers.PRIMARY:
+                    self._check()
+            except Exception as e:
+                logger.error(f"Lifecycle check failed: {e}")
+
+    # Stamps since the last publish go to the shared cache; local ones are
+    # only kept long enough for ensure_running to skip recently active containers
+    def _publish(self):
+        now = time.time()
+        fresh = {
+            last_io_key(container_id): last_io
+            for container_id, last_io in list(self._last_io.items())
+            if last_io > self._published
+        }
+        if fresh:
+            cache.set_many(fresh, timeout=self.stop_after + self.pause_after)
+        self._published = now
+        for stamps in (self._last_io, self._last_output):
+            for container_id, last_io in list(stamps.items()):
+                if now - last_io > self.check_interval * 2:
+                    stamps.pop(container_id, None)
+        expired = time.monotonic()
+        for container_id, until in list(self._running_until.items()):
+            if until < expired:
+                self._running_until.pop(container_id, None)
+
+    def _check(self):
+        containers = self._running_or_paused()
+        stamps = cache.get_many([last_io_key(container_id) for container_id in containers])
+        now = time.time()
+        paused = []
+        for container_id, status in containers.items():
+            last_io = stamps.get(last_io_key(container_id))
+            if last_io is None:
+                # Never had a terminal, or its stamp expired; not ours to manage
+                continue
+            idle = now - last_io
+            try:
+                if idle > self.stop_after:
+                    self._stop(container_id, status)
+                    continue
+                if idle > self.pause_after and status == 'running' and self._pause(container_id):
+                    status = 'paused'
+            except docker.errors.NotFound:
+                # Removed behind our back, nothing left to manage
+                cache.delete_many([last_io_key(container_id), paused_key(container_id)])
+                continue
+            except Exception as e:
+                logger.error(f"Lifecycle action on {container_id[:12]} failed: {e}")
+            if status == 'paused':
+                paused.append(container_id)
+        # Also covers containers paused from outside, such as by docker pause
+        if paused:
+            cache.set_many({paused_key(container_id): True for container_id in paused}, timeout=self.stop_after + self.pause_after)
+        with self._lock:
+            self.paused = len(paused)
+
+    # {id: status} from the container index, or the daemon while it is not ready
+    def _running_or_paused(self):
+        index = get_index()
+        if index and index.ready:
+            return index.with_status('running', 'paused')
+        containers = docker_control.get_client().containers.list(filters={'status': ['running', 'paused']})
+        return {container.id: container.status for container in containers}
+
+    def _pause(self, container_id):
+        client = docker_control.get_client()
+        info = client.api.inspect_container(container_id)
+        if not info['State']['Running'] or info['State']['Paused']:
+            return False
+        # An install or other exec still running is not idle
+        for exec_id in info.get('ExecIDs') or []:
+            if client.api.exec_inspect(exec_id).get('Running'):
+                return False
+        client.api.pause(container_id)
+        self._running_until.pop(container_id, None)
+        cache.set(paused_key(container_id), True, timeout=self.stop_after + self.pause_after)
+        with self._lock:
+            self.paused_total += 1
+        logger.info(f"Paused container {container_id[:12]} after {self.pause_after}s idle.")
+        return True
+
+    def _stop(self, container_id, status):
+        client = docker_control.get_client()
+        if status == 'paused':
+            client.api.unpause(container_id)
+        client.api.stop(container_id)
+        if self.remove_on_stop:
+            client.api.remove_container(container_id)
+        cache.delete_many([last_io_key(container_id), paused_key(container_id)])
+        with self._lock:
+            self.stopped_total += 1
+        logger.info(f"Stopped container {container_id[:12]} after {self.stop_after}s idle.")
+
+
+lifecycle_settings = getattr(settings, 'CONTAINER_LIFECYCLE', {})
+manager = LifecycleManager(
+    pause_after=lifecycle_settings.get('PAUSE_AFTER', 900),
+    stop_after=lifecycle_settings.get('STOP_AFTER', 4 * 3600),
+    remove_on_stop=lifecycle_settings.get('REMOVE_ON_STOP', False),
+    check_interval=lifecycle_settings.get('CHECK_INTERVAL', 30),
+) if lifecycle_settings.get('ENABLED', False) else None
+
+if manager:
+    workers.STATS['lifecycle'] = manager.stats
+    metrics.Gauge('containers_paused', 'Paused containers with terminals, as of the last lifecycle check', function=lambda: manager.paused)
+    metrics.Counter('containers_paused_total', 'Idle containers paused', function=lambda: manager.paused_total)
+    metrics.Counter('containers_resumed_total', 'Paused containers resumed on activity', function=lambda: manager.resumed_total)
+    metrics.Counter('containers_idle_stopped_total', 'Containers stopped for being idle', function=lambda: manager.stopped_total)
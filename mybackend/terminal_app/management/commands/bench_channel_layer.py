@@ -0,0 +1,383 @@
+import asyncio
+import multiprocessing
+import socket
+import time
+
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand
+
+from terminal_app.channel_layer import TerminalChannelLayer
+from terminal_app.metrics import LatencySamples
+
+
+# Stand-in for a Redis server, good for the commands channels_redis,
+# TerminalChannelLayer and Django's Redis cache send. Scripts are
+# recognised by their text and run natively, since there is no Lua here.
+# One per process, so round trips cross a real socket and a real
+# scheduler boundary.
+class RedisStandIn:
+    def __init__(self):
+        self.zsets = {}
+        self.strings = {}
+        self.expires = {}
+        self.waiters = {}
+
+    async def serve(self, sock):
+        server = await asyncio.start_server(self.handle, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Commands queued by MULTI until EXEC
+        queued = None
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper()
+                if name == b'MULTI':
+                    queued, reply = [], Status('OK')
+                elif name == b'EXEC' and queued is not None:
+                    reply = [await self.execute(queued_command) for queued_command in queued]
+                    queued = None
+                elif queued is not None:
+                    queued.append(command)
+                    reply = Status('QUEUED')
+                else:
+                    reply = await self.execute(command)
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def execute(self, command):
+        name = command[0].upper()
+        args = command[1:]
+        handler = getattr(self, f"cmd_{name.decode().lower()}", None)
+        if handler is None:
+            return Error(f"ERR unknown command '{name.decode()}'")
+        return await handler(*args)
+
+    async def cmd_hello(self, *args):
+        return {b'server': b'redis', b'version': b'7.2.0', b'proto': 3, b'mode': b'standalone'}
+
+    async def cmd_ping(self, *args):
+        return Status('PONG')
+
+    async def cmd_client(self, *args):
+        return Status('OK')
+
+    async def cmd_select(self, *args):
+        return Status('OK')
+
+    def _alive(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.zsets.pop(key, None)
+            self.strings.pop(key, None)
+            del self.expires[key]
+
+    def _zset(self, key):
+        self._alive(key)
+        return self.zsets.setdefault(key, {})
+
+    def _sorted(self, key):
+        self._alive(key)
+        return sorted(self.zsets.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def _wake(self, key):
+        for waiter in self.waiters.pop(key, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def cmd_zadd(self, key, *pairs):
+        zset = self._zset(key)
+        added = 0
+        for index in range(0, len(pairs), 2):
+            member = pairs[index + 1]
+            added += member not in zset
+            zset[member] = float(pairs[index])
+        self._wake(key)
+        return added
+
+    async def cmd_zrem(self, key, *members):
+        zset = self._zset(key)
+        return sum(zset.pop(member, None) is not None for member in members)
+
+    async def cmd_zcount(self, key, low, high):
+        return sum(_in_range(score, low, high) for score in self._zset(key).values())
+
+    async def cmd_zrange(self, key, start, stop, *options):
+        items = self._sorted(key)
+        start, stop = int(start), int(stop)
+        stop = len(items) + stop if stop < 0 else stop
+        items = items[start:stop + 1]
+        if options and options[0].upper() == b'WITHSCORES':
+            return [value for member, score in items for value in (member, repr(score).encode())]
+        return [member for member, _ in items]
+
+    async def cmd_zremrangebyscore(self, key, low, high):
+        zset = self._zset(key)
+        removed = [member for member, score in zset.items() if _in_range(score, low, high)]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    async def cmd_zpopmin(self, key):
+        items = self._sorted(key)
+        if not items:
+            return []
+        member, score = items[0]
+        del self.zsets[key][member]
+        return [member, repr(score).encode()]
+
+    async def cmd_bzpopmin(self, *args):
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            for key in keys:
+                items = self._sorted(key)
+                if items:
+                    member, score = items[0]
+                    del self.zsets[key][member]
+                    return [key, member, repr(score).encode()]
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0:
+                return None
+            waiter = asyncio.get_running_loop().create_future()
+            for key in keys:
+                self.waiters.setdefault(key, []).append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                return None
+
+    async def cmd_get(self, key):
+        self._alive(key)
+        return self.strings.get(key)
+
+    async def cmd_set(self, key, value, *options):
+        self._alive(key)
+        options = [option.upper() if isinstance(option, bytes) else option for option in options]
+        if b'NX' in options and (key in self.strings or key in self.zsets):
+            return None
+        self.strings[key] = value
+        self.expires.pop(key, None)
+        for unit, scale in ((b'EX', 1), (b'PX', 0.001)):
+            if unit in options:
+                self.expires[key] = time.time() + int(options[options.index(unit) + 1]) * scale
+        return Status('OK')
+
+    async def cmd_expire(self, key, seconds):
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    async def cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += self.zsets.pop(key, None) is not None or self.strings.pop(key, None) is not None
+            self.expires.pop(key, None)
+        return deleted
+
+    async def cmd_eval(self, script, numkeys, *rest):
+        keys, argv = rest[:int(numkeys)], rest[int(numkeys):]
+        if b'over_capacity' in script:
+            # Group delivery
+            now, expiry = argv[-2], argv[-1]
+            over = 0
+            for index, key in enumerate(keys):
+                if len(self._zset(key)) < int(argv[index + len(keys)]):
+                    await self.cmd_zadd(key, now, argv[index])
+                    await self.cmd_expire(key, expiry)
+                else:
+                    over += 1
+            return over
+        if b'backed_up' in script:
+            # Put messages a cancelled receive had taken back on the channel
+            backup = self._zset(argv[1])
+            self._zset(argv[0]).update(backup)
+            self.zsets.pop(argv[1], None)
+            if backup:
+                self._wake(argv[0])
+            return None
+        if b"redis.call('GET', KEYS[1]) == ARGV[1]" in script:
+            # Registry lease: extended or released only while it holds the caller's record
+            if await self.cmd_get(keys[0]) != argv[0]:
+                return 0
+            if b"'EXPIRE'" in script:
+                return await self.cmd_expire(keys[0], argv[1])
+            return await self.cmd_del(keys[0])
+        if b"'keys'" in script:
+            # flush(): delete by prefix
+            prefix = argv[0].rstrip(b'*')
+            for key in [key for key in list(self.zsets) + list(self.strings) if key.startswith(prefix)]:
+                await self.cmd_del(key)
+            return None
+        return Error("ERR unknown script")
+
+
+class Status(str):
+    pass
+
+
+class Error(str):
+    pass
+
+
+def _in_range(score, low, high):
+    return _bound(low, float('-inf')) <= score <= _bound(high, float('inf'))
+
+
+def _bound(value, infinite):
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    return infinite if value in ('-inf', '+inf', 'inf') else float(value)
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    count = int(line[1:])
+    command = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+# RESP3 replies
+def encode(value):
+    if value is None:
+        return b'_\r\n'
+    if isinstance(value, Error):
+        return f"-{value}\r\n".encode()
+    if isinstance(value, Status):
+        return f"+{value}\r\n".encode()
+    if isinstance(value, bool):
+        return f":{int(value)}\r\n".encode()
+    if isinstance(value, int):
+        return f":{value}\r\n".encode()
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, dict):
+        return b'%%%d\r\n' % len(value) + b''.join(encode(k) + encode(v) for k, v in value.items())
+    return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+
+
+def run_standin(sock):
+    asyncio.run(RedisStandIn().serve(sock))
+
+
+# Listening socket bound here, so the port is known before the child runs
+def start_standin(port=0):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', port))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+    process = multiprocessing.get_context('fork').Process(target=run_standin, args=(sock,), daemon=True)
+    process.start()
+    sock.close()
+    return process, port
+
+
+class Command(BaseCommand):
+    # Needs neither Docker nor Redis, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Measure group_send latency and throughput of the channel layers against local Redis stand-ins"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000, help="group_send calls per scenario")
+        parser.add_argument('--groups', type=int, default=10)
+        parser.add_argument('--receivers', type=int, default=2, help="Channels in each group")
+        parser.add_argument('--concurrency', type=int, default=8, help="Concurrent senders")
+        parser.add_argument('--shards', type=int, default=2, help="Stand-ins for the sharded scenario")
+
+    def handle(self, *args, **options):
+        standins = [start_standin() for _ in range(max(options['shards'], 1))]
+        try:
+            hosts = [f"redis://127.0.0.1:{port}" for _, port in standins]
+            # (name, sender layer, receiver layer or None for the same layer)
+            scenarios = [
+                ('channels_redis', lambda: RedisChannelLayer(hosts=hosts[:1]), None),
+                ('local fast path', lambda: TerminalChannelLayer(hosts=hosts[:1]), None),
+                ('local_groups', lambda: TerminalChannelLayer(hosts=hosts[:1], local_groups=['bench']), None),
+                ('channels_redis, other process', lambda: RedisChannelLayer(hosts=hosts[:1]), lambda: RedisChannelLayer(hosts=hosts[:1])),
+                ('pipelined, other process', lambda: TerminalChannelLayer(hosts=hosts[:1]), lambda: TerminalChannelLayer(hosts=hosts[:1])),
+                (f'pipelined, {len(hosts)} shards', lambda: TerminalChannelLayer(hosts=hosts), lambda: TerminalChannelLayer(hosts=hosts)),
+            ]
+            for name, make_sender, make_receiver in scenarios:
+                result = asyncio.run(self.run(make_sender, make_receiver, options))
+                self.stdout.write(
+                    f"{name:>32}: p50 {result['p50_ms']:.2f} ms p99 {result['p99_ms']:.2f} ms, "
+                    f"{result['sends_per_s']:.0f} group_send/s, {result['delivered']} delivered"
+                )
+        finally:
+            for process, _ in standins:
+                process.terminate()
+
+    async def run(self, make_sender, make_receiver, options):
+        sender = make_sender()
+        # A second layer instance has its own client prefix, like another daphne process
+        receiver = make_receiver() if make_receiver else sender
+        await sender.flush()
+        groups = [f"bench_{number}" for number in range(options['groups'])]
+        pending = {}
+        delivered = 0
+
+        async def receive(channel):
+            nonlocal delivered
+            while True:
+                message = await receiver.receive(channel)
+                delivered += 1
+                entry = pending.get(message['seq'])
+                if entry is None:
+                    continue
+                entry[0] -= 1
+                if entry[0] == 0:
+                    entry[1].set_result(None)
+
+        receivers = []
+        for group in groups:
+            for _ in range(options['receivers']):
+                channel = await receiver.new_channel()
+                await receiver.group_add(group, channel)
+                receivers.append(asyncio.create_task(receive(channel)))
+
+        samples = LatencySamples(size=options['messages'])
+        loop = asyncio.get_running_loop()
+        counter = iter(range(options['messages']))
+
+        async def send():
+            for seq in counter:
+                done = loop.create_future()
+                pending[seq] = [options['receivers'], done]
+                started = time.perf_counter()
+                await sender.group_send(groups[seq % len(groups)], {'type': 'job.status', 'seq': seq, 'message': 'x' * 64})
+                await asyncio.wait_for(done, 10)
+                samples.observe(time.perf_counter() - started)
+                del pending[seq]
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send() for _ in range(options['concurrency'])))
+        wall = time.perf_counter() - started
+
+        for task in receivers:
+            task.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        for layer in {sender, receiver}:
+            await layer.flush()
+
+        summary = samples.summary()
+        return {
+            'p50_ms': summary['p50'] * 1000,
+            'p99_ms': summary['p99'] * 1000,
+            'sends_per_s': options['messages'] / wall,
+            'delivered': delivered,
+        }
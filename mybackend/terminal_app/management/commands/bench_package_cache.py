@@ -0,0 +1,87 @@
+import json
+import re
+import time
+
+import docker
+from django.core.management.base import BaseCommand, CommandError
+
+from terminal_app import package_cache
+from terminal_app.views import (
+    _create_container, _get_image_name, _get_install_command, _get_preconfigure_command,
+    _get_update_command, client,
+)
+
+# apt's summary lines, e.g. "Fetched 8,738 kB in 2s (4,369 kB/s)"
+FETCHED = re.compile(r"Fetched ([\d,.]+) (B|kB|MB|GB)")
+UNITS = {'B': 1, 'kB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3}
+
+
+class Command(BaseCommand):
+    help = "Measure install time and bytes downloaded with the shared package cache cold and warm"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--system', type=int, default=1, help="System id, as sent by the frontend")
+        parser.add_argument('--packages', type=int, nargs='+', default=[1], help="Package ids, as sent by the frontend")
+        parser.add_argument('--warm-runs', type=int, default=2)
+        parser.add_argument('--json', action='store_true', help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        system = options['system']
+        if not package_cache.uses_apt(system):
+            raise CommandError("The package cache is disabled or the system does not use apt.")
+
+        self.clear_volumes(system)
+        results = [self.run_install(system, options['packages'], 'cold')]
+        for _ in range(options['warm_runs']):
+            results.append(self.run_install(system, options['packages'], 'warm'))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['cache']:>4}: update {result['update_s']:.1f}s, install {result['install_s']:.1f}s, "
+                f"{result['downloaded_bytes'] / 1e6:.1f} MB downloaded"
+            )
+
+    def clear_volumes(self, system):
+        for name in package_cache.volume_names(system):
+            try:
+                client.volumes.get(name).remove()
+                self.stdout.write(f"Removed volume {name}")
+            except docker.errors.NotFound:
+                pass
+            except docker.errors.APIError as e:
+                raise CommandError(f"Cannot clear {name}, is a container still using it? {e}")
+
+    def run_install(self, system, packages, label):
+        container = _create_container(_get_image_name(system), system)
+        try:
+            for command in (_get_preconfigure_command(system), package_cache.setup_command(system)):
+                self.run_command(container, command)
+            update_s, update_bytes = self.run_command(container, _get_update_command(system))
+            install_s, install_bytes = self.run_command(container, _get_install_command(system, packages))
+            self.run_command(container, package_cache.evict_command(system))
+        finally:
+            container.remove(force=True)
+        return {
+            'cache': label,
+            'update_s': update_s,
+            'install_s': install_s,
+            'downloaded_bytes': update_bytes + install_bytes,
+        }
+
+    # Wall time and bytes apt reports fetching for one command
+    def run_command(self, container, command):
+        started = time.perf_counter()
+        exec_id = client.api.exec_create(container.id, command, tty=True, environment={"DEBIAN_FRONTEND": "noninteractive"})['Id']
+        output = b"".join(client.api.exec_start(exec_id, tty=True, stream=True)).decode('utf-8', errors='replace')
+        elapsed = time.perf_counter() - started
+        exit_code = client.api.exec_inspect(exec_id)['ExitCode']
+        if exit_code != 0:
+            raise CommandError(f"{command} exited with {exit_code}:\n{output[-2000:]}")
+        downloaded = sum(
+            float(amount.replace(',', '')) * UNITS[unit]
+            for amount, unit in FETCHED.findall(output)
+        )
+        return elapsed, int(downloaded)
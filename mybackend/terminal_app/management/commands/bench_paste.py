@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import random
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from terminal_app import lifecycle, sessions
+from terminal_app.management.commands.bench_terminal import FakeContainer
+from terminal_app.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    # Runs without a Docker daemon, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Paste a file into a terminal session through TerminalConsumer and check it arrives whole and in time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megabytes', type=float, default=1)
+        parser.add_argument('--frame-bytes', type=int, default=1024, help="Bytes per WebSocket frame from the client")
+        parser.add_argument('--read-kb-s', type=int, default=4096, help="How fast the container side reads stdin, in kB/s")
+        parser.add_argument('--max-seconds', type=float, default=10, help="Fail when the paste takes longer than this")
+
+    def handle(self, *args, **options):
+        with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+            result = asyncio.run(self.run(options))
+        self.stdout.write(
+            f"Pasted {result['bytes']} bytes in {result['frames']} frames in {result['seconds']:.2f} s "
+            f"({result['bytes'] / result['seconds'] / 1024:.0f} kB/s), {result['writes']} backend writes "
+            f"averaging {result['bytes'] / max(result['writes'], 1):.0f} bytes"
+        )
+        if not result['lossless']:
+            raise CommandError(f"Received {result['received']} bytes that do not match the paste")
+        if result['seconds'] > options['max_seconds']:
+            raise CommandError(f"Paste took {result['seconds']:.2f} s, over {options['max_seconds']} s")
+        self.stdout.write(self.style.SUCCESS("Paste arrived intact"))
+
+    async def run(self, options):
+        loop = asyncio.get_running_loop()
+        peers = {}
+        container_id = f"paste{0:059d}"
+
+        async def fake_start_container(container_id):
+            return FakeContainer(container_id, peers)
+
+        # Printable text with line breaks, like a pasted script
+        rng = random.Random(0)
+        size = int(options['megabytes'] * 1024 * 1024)
+        alphabet = b"abcdefghijklmnopqrstuvwxyz0123456789 ={}()[];:'\"\n"
+        paste = bytes(rng.choice(alphabet) for _ in range(size))
+
+        original_start_container = sessions.start_container
+        sessions.start_container = fake_start_container
+        # Fake containers have no Docker state to pause or resume
+        original_manager, lifecycle.manager = lifecycle.manager, None
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/terminal/{container_id}/?mode=binary")
+        try:
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError("Session was refused")
+            while container_id not in peers:
+                await asyncio.sleep(0.01)
+            peer = peers[container_id]
+
+            # The container side reads stdin at a fixed rate, so the attach
+            # socket fills up and writes have to wait for it
+            received = bytearray()
+
+            async def read_stdin():
+                chunk = 4096
+                delay = chunk / (options['read_kb_s'] * 1024)
+                while len(received) < size:
+                    data = await loop.sock_recv(peer, chunk)
+                    if not data:
+                        return
+                    received.extend(data)
+                    await asyncio.sleep(delay)
+
+            writes = sessions.WRITE_BYTES.count
+            started = time.perf_counter()
+            reader = asyncio.create_task(read_stdin())
+            frames = 0
+            for offset in range(0, size, options['frame_bytes']):
+                await communicator.send_to(bytes_data=paste[offset:offset + options['frame_bytes']])
+                frames += 1
+            try:
+                await asyncio.wait_for(reader, options['max_seconds'] * 2)
+            except asyncio.TimeoutError:
+                pass
+            seconds = time.perf_counter() - started
+        finally:
+            await communicator.disconnect()
+            sessions.start_container = original_start_container
+            lifecycle.manager = original_manager
+
+        return {
+            'bytes': size,
+            'frames': frames,
+            'received': len(received),
+            'lossless': hashlib.sha256(received).digest() == hashlib.sha256(paste).digest(),
+            'seconds': seconds,
+            'writes': sessions.WRITE_BYTES.count - writes,
+        }
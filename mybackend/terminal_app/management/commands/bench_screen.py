@@ -0,0 +1,142 @@
+import asyncio
+import json
+import random
+import time
+import types
+
+from django.core.management.base import BaseCommand, CommandError
+
+from terminal_app import screen
+from terminal_app.streaming import OutputCoalescer
+
+
+# One top-style redraw: home, a header, then every process row with
+# changing figures, each line erased to the end
+def top_frame(rng, tick, rows, cols):
+    lines = [
+        f"top - 12:{tick // 60 % 60:02d}:{tick % 60:02d} up 3 days,  1 user,  load average: {rng.random() * 4:.2f}, {rng.random() * 4:.2f}, {rng.random() * 4:.2f}",
+        f"Tasks: {rng.randint(180, 220)} total,   {rng.randint(1, 5)} running, {rng.randint(170, 210)} sleeping",
+        f"%Cpu(s): {rng.random() * 30:4.1f} us,  {rng.random() * 10:4.1f} sy,  0.0 ni, {60 + rng.random() * 39:4.1f} id",
+        f"MiB Mem :  15876.2 total,   {rng.random() * 9000:7.1f} free,   {rng.random() * 6000:7.1f} used",
+        "",
+        "\x1b[7m    PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND\x1b[0m",
+    ]
+    for pid in range(rows - len(lines)):
+        lines.append(
+            f"{1000 + pid:7d} user      20   0 {rng.randint(1000, 999999):7d} {rng.randint(100, 99999):6d} "
+            f"{rng.randint(100, 9999):6d} {rng.choice('SSSR')} {rng.random() * 100:5.1f} {rng.random() * 10:5.1f} "
+            f"{rng.randint(0, 99):4d}:{rng.randint(0, 59):02d}.{rng.randint(0, 99):02d} proc{pid}"
+        )
+    return ('\x1b[H' + '\x1b[K\r\n'.join(line[:cols] for line in lines) + '\x1b[K\x1b[J').encode()
+
+
+class Command(BaseCommand):
+    # Runs without a Docker daemon, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Compare raw passthrough and ?view=screen for a top-style app and a slow client"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5)
+        parser.add_argument('--redraws', type=int, default=50, help="App redraws per second")
+        parser.add_argument('--bandwidth-kb', type=int, default=64, help="Client link speed in kB/s")
+        parser.add_argument('--pty-kb', type=int, default=64, help="Output the app can write before its writes block")
+        parser.add_argument('--rows', type=int, default=40)
+        parser.add_argument('--cols', type=int, default=120)
+        parser.add_argument('--fps', type=int, default=30)
+        parser.add_argument('--parse-bytes', type=int, default=8192, help="SCREEN_PARSE_BYTES: output parsed per screen frame")
+        parser.add_argument('--viewers', type=int, default=1, help="Clients watching the session")
+        parser.add_argument('--json', action='store_true', help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        if not screen.available():
+            raise CommandError("pyte is not installed")
+        views = ('raw', 'raw+ack', 'screen', 'screen+ack')
+        results = [asyncio.run(self.run_view(view, options)) for view in views]
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['view']:>10}: {result['kb_sent']:.0f} kB in {result['frames']} frames per viewer, "
+                f"{result['redraws']} redraws, client {result['lag_s']:.2f} s behind at the end, {result['cpu_ms']:.0f} ms CPU"
+            )
+
+    async def run_view(self, view, options):
+        loop = asyncio.get_running_loop()
+        bandwidth = options['bandwidth_kb'] * 1024
+        acked = view.endswith('+ack')
+        viewers = []
+
+        # Like Daphne's send(), handing a frame over returns at once; each
+        # client's link drains bandwidth bytes a second behind it
+        async def deliver(viewer):
+            while True:
+                data = await viewer['link'].get()
+                await asyncio.sleep(len(data) / bandwidth)
+                viewer['sent'] += len(data)
+                viewer['frames'] += 1
+                viewer['received_at'] = loop.time()
+                if acked:
+                    viewer['output'].ack(viewer['sent'])
+                viewer['link'].task_done()
+
+        # What SharedSession does for its subscribers
+        session = types.SimpleNamespace(screen=None)
+        for _ in range(options['viewers']):
+            viewer = {'link': asyncio.Queue(), 'sent': 0, 'frames': 0, 'received_at': None}
+            if view.startswith('screen'):
+                viewer['output'] = screen.ScreenRenderer(
+                    viewer['link'].put, rows=options['rows'], cols=options['cols'], fps=options['fps'],
+                    max_parse=options['parse_bytes'], acked=acked,
+                )
+                viewer['output'].attach(session)
+            else:
+                viewer['output'] = OutputCoalescer(viewer['link'].put, acked=acked)
+            viewer['output'].start()
+            viewer['delivering'] = asyncio.create_task(deliver(viewer))
+            viewers.append(viewer)
+
+        # The app redraws on its own timer, but its writes block once the
+        # PTY and attach-socket buffers (pty_kb) are full; this queue is
+        # those buffers, drained by the session reader
+        redraw = top_frame(random.Random(0), 0, options['rows'], options['cols'])
+        pending = asyncio.Queue(maxsize=max(1, options['pty_kb'] * 1024 // len(redraw)))
+
+        async def reader():
+            while True:
+                data = await pending.get()
+                if data is None:
+                    return
+                if session.screen:
+                    await session.screen.feed(data)
+                for viewer in viewers:
+                    await viewer['output'].feed(data)
+
+        reading = asyncio.create_task(reader())
+        rng = random.Random(0)
+        interval = 1.0 / options['redraws']
+        cpu_start = time.process_time()
+        started = loop.time()
+        tick = 0
+        while loop.time() - started < options['seconds']:
+            await pending.put(top_frame(rng, tick, options['rows'], options['cols']))
+            tick += 1
+            await asyncio.sleep(max(0.0, started + tick * interval - loop.time()))
+        app_done = loop.time()
+        await pending.put(None)
+        await reading
+        for viewer in viewers:
+            await viewer['output'].close()
+            await viewer['link'].join()
+            viewer['delivering'].cancel()
+        cpu = time.process_time() - cpu_start
+
+        return {
+            'view': view,
+            'viewers': len(viewers),
+            'redraws': tick,
+            'frames': sum(viewer['frames'] for viewer in viewers) // len(viewers),
+            'kb_sent': sum(viewer['sent'] for viewer in viewers) / len(viewers) / 1024,
+            'lag_s': max(max(0.0, (viewer['received_at'] or app_done) - app_done) for viewer in viewers),
+            'cpu_ms': cpu * 1000,
+        }
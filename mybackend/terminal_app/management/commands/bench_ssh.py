@@ -0,0 +1,242 @@
+import asyncio
+import collections
+import socket
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from terminal_app import backends, ssh_pool
+
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+PROMPT = b'$ '
+
+
+# sshd stand-in: password logins, and shells that print a prompt and echo input
+def start_sshd(host_key):
+    import paramiko
+
+    class Server(paramiko.ServerInterface):
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_auth_password(self, username, password):
+            if username == USERNAME and password == PASSWORD:
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+            return True
+
+        def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+            return True
+
+        def check_channel_shell_request(self, channel):
+            threading.Thread(target=shell, args=(channel,), daemon=True).start()
+            return True
+
+    def shell(channel):
+        channel.sendall(PROMPT)
+        while True:
+            data = channel.recv(4096)
+            if not data:
+                break
+            channel.sendall(data)
+        channel.close()
+
+    handshakes = []
+
+    def serve(listener):
+        while True:
+            sock, _ = listener.accept()
+            # As sshd does for sessions with a terminal
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.start_server(server=Server())
+            handshakes.append(transport)
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    threading.Thread(target=serve, args=(listener,), daemon=True).start()
+    return listener.getsockname()[1], handshakes
+
+
+# Forwards connections to port with rtt/2 added each way, so handshake and
+# channel-open round trips cost what they would across a network
+def start_delay_proxy(port, rtt):
+    # The delay is fixed, so chunks fall due in the order they arrived
+    def pump(source, destination):
+        due = collections.deque()
+        ready = threading.Condition()
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(65536)
+                except OSError:
+                    data = b''
+                with ready:
+                    due.append((time.monotonic() + rtt / 2, data))
+                    ready.notify()
+                if not data:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        while True:
+            with ready:
+                while not due:
+                    ready.wait()
+                at, data = due[0]
+                if at > time.monotonic():
+                    ready.wait(at - time.monotonic())
+                    continue
+                due.popleft()
+            if not data:
+                break
+            try:
+                destination.sendall(data)
+            except OSError:
+                break
+        destination.close()
+
+    def serve(listener):
+        while True:
+            client, _ = listener.accept()
+            upstream = socket.create_connection(('127.0.0.1', port))
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=pump, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=pump, args=(upstream, client), daemon=True).start()
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    threading.Thread(target=serve, args=(listener,), daemon=True).start()
+    return listener.getsockname()[1]
+
+
+class Command(BaseCommand):
+    # Needs no Docker daemon or sshd, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Measure SSH session-open latency, cold and on pooled connections, against an in-process sshd stand-in"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, default=20, help="Sequential session opens per scenario")
+        parser.add_argument('--tabs', type=int, default=5, help="Sessions opened at once for the same user")
+        parser.add_argument('--rtt-ms', type=float, default=20, help="Round trip added by a delaying proxy, 0 to connect directly")
+
+    def handle(self, *args, **options):
+        try:
+            import paramiko
+        except ImportError:
+            raise CommandError("paramiko is not installed")
+
+        host_key = paramiko.RSAKey.generate(2048)
+        port, handshakes = start_sshd(host_key)
+        if options['rtt_ms']:
+            port = start_delay_proxy(port, options['rtt_ms'] / 1000)
+        self.stdout.write(f"sshd stand-in on 127.0.0.1:{port}, {options['rtt_ms']:g} ms round trip")
+
+        original_pool = ssh_pool.pool
+        try:
+            results = asyncio.run(self.run(port, handshakes, options))
+        finally:
+            ssh_pool.pool = original_pool
+
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<34} open p50 {result['p50'] * 1000:7.1f} ms  p95 {result['p95'] * 1000:7.1f} ms  "
+                f"{result['handshakes']:>3} handshakes  loop stalled at most {result['lag'] * 1000:.1f} ms"
+            )
+        cold, pooled = results['cold'], results['pooled']
+        self.stdout.write(self.style.SUCCESS(f"Pooled sessions open {cold['p50'] / pooled['p50']:.1f}x faster"))
+
+    async def run(self, port, handshakes, options):
+        results = {}
+
+        # What every session used to do: connect, authenticate, one shell, close it all
+        ssh_pool.pool = ssh_pool.SSHTransportPool(idle_timeout=0, max_channels=1)
+        results['cold'] = await self.measure(port, handshakes, options['sessions'], 1)
+
+        # The first open pays the handshake, later ones find the connection idle in the pool
+        ssh_pool.pool = ssh_pool.SSHTransportPool(idle_timeout=60)
+        backend, _ = await self.open(port)
+        await backend.close()
+        results['pooled'] = await self.measure(port, handshakes, options['sessions'], 1)
+        await self.drain_pool()
+
+        # Tabs opened together by one user share a single handshake
+        ssh_pool.pool = ssh_pool.SSHTransportPool(idle_timeout=60)
+        results[f"{options['tabs']} tabs at once, pooled"] = await self.measure(port, handshakes, 1, options['tabs'])
+        await self.drain_pool()
+
+        ssh_pool.pool = ssh_pool.SSHTransportPool(idle_timeout=0, max_channels=1)
+        results[f"{options['tabs']} tabs at once, cold"] = await self.measure(port, handshakes, 1, options['tabs'])
+        return results
+
+    async def measure(self, port, handshakes, rounds, concurrency):
+        handshakes_before = len(handshakes)
+        latencies = []
+        lag = LoopLag()
+        lag.start()
+        for _ in range(rounds):
+            opened = await asyncio.gather(*(self.open(port) for _ in range(concurrency)))
+            latencies.extend(seconds for _, seconds in opened)
+            for backend, _ in opened:
+                await backend.close()
+        lag.stop()
+        latencies.sort()
+        return {
+            'p50': statistics.median(latencies),
+            'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            'handshakes': len(handshakes) - handshakes_before,
+            'lag': lag.worst,
+        }
+
+    # Time until the shell's prompt arrives, as the user sees it
+    async def open(self, port):
+        started = time.perf_counter()
+        backend = backends.SSHBackend('127.0.0.1', USERNAME, PASSWORD, port=port)
+        await backend.open()
+        output = b''
+        while PROMPT not in output:
+            data = await asyncio.wait_for(backend.read(), 10)
+            if not data:
+                raise CommandError("Shell closed before its prompt")
+            output += data
+        return backend, time.perf_counter() - started
+
+    async def drain_pool(self):
+        for entries in list(ssh_pool.pool._transports.values()):
+            for pooled in list(entries):
+                ssh_pool.pool._discard(pooled)
+        # Let the executor finish closing them
+        await asyncio.sleep(0.1)
+
+
+# Worst delay of a 1 ms timer on the event loop, showing whether opens block it
+class LoopLag:
+    def __init__(self):
+        self.worst = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            self.worst = max(self.worst, time.perf_counter() - started - 0.001)
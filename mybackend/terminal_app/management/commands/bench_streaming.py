@@ -0,0 +1,125 @@
+import asyncio
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from terminal_app.streaming import FrameEncoder, OutputCoalescer
+
+# Terminal-like output with colour escapes and multibyte characters, so
+# reads regularly split a UTF-8 sequence
+SAMPLE = (
+    "\x1b[1;32muser@host\x1b[0m:\x1b[1;34m~/projet\x1b[0m$ ls -la — café, naïve, 日本語, ✓\r\n"
+    "drwxr-xr-x  2 user user 4096 oct. 18 12:00 données\r\n"
+).encode('utf-8')
+
+# Encoder settings per mode; the deflate modes need a binary session
+MODES = {
+    'text': {'binary': False},
+    'binary': {'binary': True},
+    'deflate': {'binary': True, 'compress': True, 'dictionary': None},
+    'deflate+dict': {'binary': True, 'compress': True},
+}
+
+
+# About two megabytes of apt-get update/install output with varying
+# package names, versions and sizes, so compression is not just finding
+# the same line again
+def apt_sample(seed=0):
+    rng = random.Random(seed)
+    syllables = ['lib', 'py', 'gcc', 'ssl', 'xml', 'z', 'curl', 'perl', 'data', 'dev', 'base', 'core', 'tools', 'utils', 'common']
+    lines = []
+    size = 0
+    while size < 2 * 1024 * 1024:
+        name = ''.join(rng.choice(syllables) for _ in range(rng.randint(1, 3))) + rng.choice(['', '3', '-dev', '-common', '6'])
+        version = f"{rng.randint(0, 9)}.{rng.randint(0, 40)}.{rng.randint(0, 99)}-{rng.randint(1, 9)}"
+        kind = rng.random()
+        if kind < 0.3:
+            line = f"Get:{rng.randint(1, 400)} http://deb.debian.org/debian bookworm/main amd64 {name} amd64 {version} [{rng.randint(5, 9000)} kB]\r\n"
+        elif kind < 0.5:
+            line = f"Selecting previously unselected package {name}.\r\nPreparing to unpack .../{rng.randint(0, 99):02d}-{name}_{version}_amd64.deb ...\r\n"
+        elif kind < 0.7:
+            line = f"Unpacking {name}:amd64 ({version}) ...\r\n"
+        elif kind < 0.9:
+            line = f"Setting up {name}:amd64 ({version}) ...\r\n"
+        else:
+            percent = rng.randint(0, 100)
+            line = f"\r\x1b[K\x1b[42m\x1b[30mProgress: [{percent:3d}%]\x1b[49m\x1b[39m [{'#' * (percent // 5)}{'.' * (20 - percent // 5)}] "
+        lines.append(line)
+        size += len(line)
+    return ''.join(lines).encode('utf-8')
+
+
+class Command(BaseCommand):
+    # Runs without a Docker daemon, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Measure CPU time per MB streamed through the terminal output stage in text and binary mode"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megabytes', type=int, default=64)
+        parser.add_argument('--read-size', type=int, default=4096, help="Bytes per simulated attach-socket read")
+        parser.add_argument('--compress', action='store_true', help="Add the ?compress=deflate modes, with and without the preset dictionary")
+        parser.add_argument('--sample', choices=['ls', 'apt'], default='ls', help="Stream a repeated listing or generated apt output")
+        parser.add_argument('--json', action='store_true', help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        modes = ['text', 'binary'] + (['deflate', 'deflate+dict'] if options['compress'] else [])
+        sample = apt_sample() if options['sample'] == 'apt' else SAMPLE
+        results = [
+            asyncio.run(self.run_mode(mode, sample, options['megabytes'], options['read_size']))
+            for mode in modes
+        ]
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            ratio = f", {result['ratio']:.1f}x smaller on the wire" if 'ratio' in result else ""
+            self.stdout.write(
+                f"{result['mode']:>12}: {result['cpu_ms_per_mb']:.2f} ms CPU/MB, "
+                f"{result['mb_per_s']:.1f} MB/s, {result['frames']} frames{ratio}"
+            )
+
+    async def run_mode(self, mode, sample, megabytes, read_size):
+        total = megabytes * 1024 * 1024
+        stream = sample * (read_size // len(sample) + 2)
+        encoder = FrameEncoder(**MODES[mode])
+        frames = 0
+
+        async def send(data):
+            nonlocal frames
+            frame = encoder.encode(data)
+            if frame is None:
+                return
+            frames += 1
+            # daphne puts text frames on the wire as UTF-8
+            if 'text_data' in frame:
+                frame['text_data'].encode('utf-8')
+
+        coalescer = OutputCoalescer(send)
+        coalescer.start()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        fed = offset = 0
+        while fed < total:
+            # Slide the read window so chunk boundaries land mid-character
+            chunk = stream[offset:offset + read_size]
+            offset = (offset + read_size + 7) % len(sample)
+            await coalescer.feed(chunk)
+            fed += len(chunk)
+        await coalescer.close()
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+
+        mb = fed / (1024 * 1024)
+        result = {
+            'mode': mode,
+            'megabytes': round(mb, 2),
+            'frames': frames,
+            'cpu_ms_per_mb': cpu * 1000 / mb,
+            'mb_per_s': mb / wall if wall else None,
+        }
+        if encoder.compressing:
+            result['ratio'] = encoder.raw_bytes / encoder.sent_bytes
+        return result
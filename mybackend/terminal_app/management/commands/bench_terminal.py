@@ -0,0 +1,249 @@
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import tempfile
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from terminal_app import lifecycle, recording, sessions
+from terminal_app.metrics import LatencySamples
+from terminal_app.routing import websocket_urlpatterns
+
+# Result keys compared against a baseline, and whether bigger is better
+COMPARED = {
+    'echo_p50_ms': False,
+    'echo_p99_ms': False,
+    'mb_per_s': True,
+    'frames_per_s': True,
+    'cpu_ms_per_mb': False,
+}
+
+
+# Stands in for a container: attach_socket hands back one end of a
+# socketpair and the other end echoes stdin like a tty in cooked mode
+class FakeContainer:
+    def __init__(self, container_id, peers):
+        self.id = container_id
+        self.peers = peers
+
+    def attach_socket(self, params):
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        self.peers[self.id] = theirs
+        return FakeAttachSocket(ours)
+
+
+class FakeAttachSocket:
+    def __init__(self, sock):
+        self._sock = sock
+
+    def close(self):
+        self._sock.close()
+
+
+class Command(BaseCommand):
+    # Runs without a Docker daemon, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Measure echo latency, throughput and CPU of TerminalConsumer against in-process fake containers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sessions', type=int, nargs='+', default=[1, 100, 1000])
+        parser.add_argument('--keystrokes', type=int, default=20, help="Echo round trips per session")
+        parser.add_argument('--bulk-megabytes', type=int, default=64, help="Output streamed per run, split across sessions")
+        parser.add_argument('--mode', choices=['binary', 'text'], default='binary')
+        parser.add_argument('--record', action='store_true', help="Also run each session count with session recording on")
+        parser.add_argument('--output', help="Write results to this JSON file")
+        parser.add_argument('--baseline', help="Compare against a previous --output file")
+        parser.add_argument('--tolerance', type=float, default=0.15, help="Allowed relative regression against the baseline")
+
+    def handle(self, *args, **options):
+        self.raise_fd_limit(max(options['sessions']))
+        # Only the terminal path is measured, so the consumers get an in-memory layer instead of redis
+        with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+            runs = []
+            for count in options['sessions']:
+                runs.append(self.measure(count, options, record=False))
+                if options['record']:
+                    runs.append(self.measure(count, options, record=True))
+        for result in runs:
+            self.stdout.write(
+                f"{result['sessions']:>5} sessions{' recorded' if result['recording'] else ''}: echo p50 {result['echo_p50_ms']:.2f} ms p99 {result['echo_p99_ms']:.2f} ms, "
+                f"{result['mb_per_s']:.1f} MB/s, {result['frames_per_s']:.0f} frames/s, "
+                f"{result['cpu_ms_per_mb']:.2f} ms CPU/MB, {result['cpu_ms_per_session']:.2f} ms CPU/session"
+            )
+
+        if options['record']:
+            plain = {run['sessions']: run for run in runs if not run['recording']}
+            for run in runs:
+                if run['recording']:
+                    base = plain[run['sessions']]
+                    self.stdout.write(
+                        f"{run['sessions']:>5} sessions recording overhead: "
+                        f"{run['cpu_ms_per_mb'] / base['cpu_ms_per_mb'] - 1:+.1%} CPU/MB, "
+                        f"{run['mb_per_s'] / base['mb_per_s'] - 1:+.1%} MB/s, "
+                        f"{run['recorded_bytes'] / (run['megabytes'] * 1024 * 1024):.1%} of streamed bytes on disk"
+                    )
+
+        report = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'mode': options['mode'],
+            'runs': runs,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if options['baseline']:
+            self.compare(report, options['baseline'], options['tolerance'])
+
+    # One run, with recording sent to a scratch directory when asked
+    def measure(self, count, options, record):
+        directory = tempfile.mkdtemp(prefix="bench-recordings-") if record else None
+        saved = recording.ENABLED, recording.DIRECTORY
+        recording.ENABLED, recording.DIRECTORY = record, directory or recording.DIRECTORY
+        try:
+            result = asyncio.run(self.run(count, options['keystrokes'], options['bulk_megabytes'], options['mode']))
+            result['recording'] = record
+            if record:
+                # Let the writer thread finish the last blocks before sizing the files
+                time.sleep(recording.FLUSH_INTERVAL * 2)
+                result['recorded_bytes'] = sum(
+                    entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.rec')
+                )
+            return result
+        finally:
+            recording.ENABLED, recording.DIRECTORY = saved
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    # Two sockets per session, beyond the usual 1024 soft limit at 1000 sessions
+    def raise_fd_limit(self, sessions):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = sessions * 2 + 256
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            limit = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+
+    def compare(self, report, baseline_path, tolerance):
+        with open(baseline_path) as baseline_file:
+            baseline = {(run['sessions'], run.get('recording', False)): run for run in json.load(baseline_file)['runs']}
+        regressions = []
+        for run in report['runs']:
+            previous = baseline.get((run['sessions'], run['recording']))
+            if previous is None:
+                continue
+            for key, higher_is_better in COMPARED.items():
+                old, new = previous.get(key), run[key]
+                if not old:
+                    continue
+                change = (new - old) / old
+                worse = -change if higher_is_better else change
+                if worse > tolerance:
+                    regressions.append(f"{run['sessions']} sessions {key}: {old:.2f} -> {new:.2f} ({change:+.0%})")
+        if regressions:
+            raise CommandError("Regressed against baseline:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"Within {tolerance:.0%} of {baseline_path}"))
+
+    async def run(self, count, keystrokes, bulk_megabytes, mode):
+        peers = {}
+        echo_tasks = []
+
+        async def fake_start_container(container_id):
+            return FakeContainer(container_id, peers)
+
+        original_start_container = sessions.start_container
+        sessions.start_container = fake_start_container
+        # Fake containers have no Docker state to pause or resume
+        original_manager, lifecycle.manager = lifecycle.manager, None
+        application = URLRouter(websocket_urlpatterns)
+        communicators = []
+        try:
+            for number in range(count):
+                container_id = f"bench{number:060d}"
+                communicator = WebsocketCommunicator(application, f"/ws/terminal/{container_id}/?mode={mode}")
+                connected, _ = await communicator.connect()
+                if not connected:
+                    raise CommandError(f"Session {number} was refused")
+                communicators.append((container_id, communicator))
+            # The attach is opened from a task started in connect
+            while len(peers) < count:
+                await asyncio.sleep(0.01)
+            echo_tasks = [asyncio.create_task(self.echo(peers[container_id])) for container_id, _ in communicators]
+
+            echo = LatencySamples(size=count * keystrokes)
+            await asyncio.gather(*(self.type_keys(communicator, keystrokes, echo) for _, communicator in communicators))
+
+            per_session = max(64 * 1024, bulk_megabytes * 1024 * 1024 // count)
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            received = await asyncio.gather(*(
+                self.stream(peers[container_id], communicator, per_session)
+                for container_id, communicator in communicators
+            ))
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+        finally:
+            for task in echo_tasks:
+                task.cancel()
+            for _, communicator in communicators:
+                await communicator.disconnect()
+            sessions.start_container = original_start_container
+            lifecycle.manager = original_manager
+
+        frames = sum(frame_count for frame_count, _ in received)
+        megabytes = sum(byte_count for _, byte_count in received) / (1024 * 1024)
+        latency = echo.summary()
+        return {
+            'sessions': count,
+            'echo_p50_ms': latency['p50'] * 1000,
+            'echo_p99_ms': latency['p99'] * 1000,
+            'megabytes': megabytes,
+            'mb_per_s': megabytes / wall,
+            'frames_per_s': frames / wall,
+            'cpu_ms_per_mb': cpu * 1000 / megabytes,
+            'cpu_ms_per_session': cpu * 1000 / count,
+        }
+
+    # The container's side of the tty: whatever is typed comes straight back
+    async def echo(self, peer):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.sock_recv(peer, 4096)
+            if not data:
+                return
+            await loop.sock_sendall(peer, data)
+
+    async def type_keys(self, communicator, keystrokes, samples):
+        for _ in range(keystrokes):
+            started = time.perf_counter()
+            await communicator.send_to(bytes_data=b'x')
+            await self.receive_bytes(communicator)
+            samples.observe(time.perf_counter() - started)
+
+    # Push size bytes of output from the container and wait until the client has all of it
+    async def stream(self, peer, communicator, size):
+        loop = asyncio.get_running_loop()
+        line = b"\x1b[32mbench\x1b[0m output line with some ordinary text in it 0123456789\r\n"
+        payload = (line * (size // len(line) + 1))[:size]
+        writer = asyncio.create_task(loop.sock_sendall(peer, payload))
+        frames = received = 0
+        while received < size:
+            received += len(await self.receive_bytes(communicator, timeout=30))
+            frames += 1
+        await writer
+        return frames, received
+
+    async def receive_bytes(self, communicator, timeout=5):
+        message = await communicator.receive_output(timeout)
+        if message.get('bytes') is not None:
+            return message['bytes']
+        return message['text'].encode('utf-8')
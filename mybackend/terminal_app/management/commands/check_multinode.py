@@ -0,0 +1,215 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from terminal_app import registry
+from terminal_app.management.commands.bench_channel_layer import start_standin
+
+CONTAINER_ID = 'c0ffee' * 10 + 'c0ff'
+
+
+# Entry point of each node process: Daphne serving the terminal routes,
+# with the session registry on and every container replaced by a fake
+# one that tags its echo with the node it runs on
+def run_node(number, port, lease, renew):
+    import django
+    django.setup()
+
+    from channels.routing import ProtocolTypeRouter, URLRouter
+    from daphne.server import Server
+
+    from terminal_app import lifecycle, sessions
+    from terminal_app.management.commands.bench_terminal import FakeContainer
+    from terminal_app.routing import websocket_urlpatterns
+
+    registry.ENABLED = True
+    registry.LEASE_SECONDS = lease
+    registry.RENEW_INTERVAL = renew
+    registry.NODE_URL = f"ws://127.0.0.1:{port}"
+    peers = {}
+
+    async def echo(peer):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.sock_recv(peer, 4096)
+            if not data:
+                return
+            await loop.sock_sendall(peer, f"node{number}:".encode() + data)
+
+    async def fake_start_container(container_id):
+        container = FakeContainer(container_id, peers)
+        original_attach = container.attach_socket
+        loop = asyncio.get_running_loop()
+
+        # Called on the Docker control thread
+        def attach_socket(params):
+            attached = original_attach(params)
+            loop.call_soon_threadsafe(loop.create_task, echo(peers[container_id]))
+            return attached
+        container.attach_socket = attach_socket
+        return container
+
+    sessions.start_container = fake_start_container
+    # Fake containers have no Docker state to pause or resume
+    lifecycle.manager = None
+    application = ProtocolTypeRouter({'websocket': URLRouter(websocket_urlpatterns)})
+    Server(application, endpoints=[f"tcp:port={port}:interface=127.0.0.1"], verbosity=0).run()
+
+
+class Command(BaseCommand):
+    # Needs neither Docker nor a configured Redis, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Start several Daphne nodes with the session registry and check relaying and owner failover"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=3)
+        parser.add_argument('--base-port', type=int, default=8101)
+        parser.add_argument('--lease', type=int, default=3, help="Lease seconds, short so failover is quick to see")
+        parser.add_argument('--renew', type=float, default=1)
+
+    def handle(self, *args, **options):
+        standin = None
+        if not self.redis_running():
+            # Nodes and this command share settings, so the stand-in takes Redis' place
+            standin, _ = start_standin(6379)
+            self.stdout.write("No Redis on 127.0.0.1:6379, using the stand-in")
+        ports = [options['base_port'] + number for number in range(options['nodes'])]
+        nodes = [self.start_node(number, port, options) for number, port in enumerate(ports)]
+        try:
+            for port in ports:
+                self.wait_for_port(port)
+            asyncio.run(self.check(nodes, ports, options))
+        finally:
+            for node in nodes:
+                if node.poll() is None:
+                    node.terminate()
+                    node.wait()
+            if standin:
+                standin.terminate()
+        self.stdout.write(self.style.SUCCESS("Relaying and failover work"))
+
+    def redis_running(self):
+        try:
+            socket.create_connection(('127.0.0.1', 6379), timeout=0.5).close()
+            return True
+        except OSError:
+            return False
+
+    def start_node(self, number, port, options):
+        code = (
+            "from terminal_app.management.commands.check_multinode import run_node; "
+            f"run_node({number}, {port}, {options['lease']}, {options['renew']})"
+        )
+        return subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'mybackend.settings')},
+        )
+
+    def wait_for_port(self, port, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise CommandError(f"Node on port {port} did not start")
+
+    async def check(self, nodes, ports, options):
+        path = f"/ws/terminal/{CONTAINER_ID}/?mode=binary"
+        first = await TerminalClient.connect(ports[0], path)
+        await asyncio.sleep(0.5)
+        others = [await TerminalClient.connect(port, path) for port in ports[1:]]
+        # Sessions open after the handshake, and input before that is dropped
+        await asyncio.sleep(0.5)
+
+        # Input typed on any node reaches the one container attached, on the first node
+        await others[-1].send(b'hello')
+        for client in [first] + others:
+            await client.expect(b'node0:hello')
+        self.stdout.write(f"{len(ports)} nodes share one attach stream, owned by node0")
+        current = await registry.owner(CONTAINER_ID)
+        self.stdout.write(f"Registry owner: {current['node']}")
+
+        # Owner dies without releasing its lease
+        nodes[0].send_signal(signal.SIGKILL)
+        nodes[0].wait()
+        killed = time.monotonic()
+        survivor = others[0]
+        while True:
+            if time.monotonic() - killed > options['lease'] + options['renew'] * 2 + 10:
+                raise CommandError("No node took the session over")
+            await survivor.send(b'ping')
+            output = await survivor.receive_until(b'ping', timeout=0.5)
+            if output is not None and b'node0:' not in output:
+                break
+        took_over = output.split(b':')[0].decode()
+        self.stdout.write(f"{took_over} took over {time.monotonic() - killed:.1f} s after node0 was killed")
+
+        for client in others:
+            await client.send(b'again')
+        for client in others:
+            await client.expect(f"{took_over}:again".encode())
+        self.stdout.write(f"Remaining clients are served by {took_over}")
+        for client in [first] + others:
+            client.close()
+
+
+# Just enough of a WebSocket client for binary terminal frames
+class TerminalClient:
+    @classmethod
+    async def connect(cls, port, path):
+        from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+        received = asyncio.Queue()
+        opened = asyncio.get_running_loop().create_future()
+
+        class Protocol(WebSocketClientProtocol):
+            def onOpen(self):
+                opened.set_result(self)
+
+            def onMessage(self, payload, is_binary):
+                if is_binary:
+                    received.put_nowait(payload)
+
+        factory = WebSocketClientFactory(f"ws://127.0.0.1:{port}{path}")
+        factory.protocol = Protocol
+        await asyncio.get_running_loop().create_connection(factory, '127.0.0.1', port)
+        client = cls()
+        client.protocol = await asyncio.wait_for(opened, 5)
+        client.received = received
+        client.buffer = b''
+        return client
+
+    async def send(self, data):
+        self.protocol.sendMessage(data, isBinary=True)
+
+    # Output up to and including marker, or None when it does not come in time
+    async def receive_until(self, marker, timeout=5):
+        deadline = asyncio.get_running_loop().time() + timeout
+        while marker not in self.buffer:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return None
+            try:
+                self.buffer += await asyncio.wait_for(self.received.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        end = self.buffer.index(marker) + len(marker)
+        output, self.buffer = self.buffer[:end], self.buffer[end:]
+        return output
+
+    async def expect(self, marker, timeout=5):
+        if await self.receive_until(marker, timeout) is None:
+            raise CommandError(f"Expected {marker!r}, got {self.buffer[-200:]!r}")
+
+    def close(self):
+        self.protocol.sendClose()
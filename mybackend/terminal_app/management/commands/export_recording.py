@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from terminal_app.recording import Recording, export_asciicast
+
+
+class Command(BaseCommand):
+    # Works on recording files alone, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Export a terminal session recording as asciicast v2, optionally from a point in time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Recording file (.rec)")
+        parser.add_argument('--start', type=float, default=0.0, help="Seconds into the session to start from")
+        parser.add_argument('--end', type=float, help="Seconds into the session to stop at")
+        parser.add_argument('--output', help="Write the .cast here instead of stdout")
+
+    def handle(self, *args, **options):
+        try:
+            recording = Recording(options['path'])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        try:
+            if options['output']:
+                with open(options['output'], 'w') as out:
+                    export_asciicast(recording, out, options['start'], options['end'])
+            else:
+                export_asciicast(recording, sys.stdout, options['start'], options['end'])
+        finally:
+            recording.close()
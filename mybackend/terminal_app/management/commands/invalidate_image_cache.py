@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from terminal_app.views import IMAGE_MAP, client, image_cache
+
+
+class Command(BaseCommand):
+    help = "Remove cached provisioned images whose base image has changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pull', action='store_true', help="Pull the base images before comparing")
+        parser.add_argument('--all', action='store_true', help="Remove every cached image")
+
+    def handle(self, *args, **options):
+        if image_cache is None:
+            self.stdout.write("Image cache is disabled.")
+            return
+
+        if options['all']:
+            removed = image_cache.invalidate()
+        else:
+            removed = []
+            for base_image in sorted(set(IMAGE_MAP.values())):
+                if options['pull']:
+                    self.stdout.write(f"Pulling {base_image}")
+                    client.images.pull(base_image)
+                removed += image_cache.invalidate(base_image)
+
+        for tag in removed:
+            self.stdout.write(f"Removed {tag}")
+        self.stdout.write(self.style.SUCCESS(f"{len(removed)} cached image(s) invalidated."))
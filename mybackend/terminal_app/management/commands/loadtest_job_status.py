@@ -0,0 +1,73 @@
+import asyncio
+import json
+import time
+import uuid
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from terminal_app import job_status
+
+
+class Command(BaseCommand):
+    # Runs without a Docker daemon, so skip the URL checks that import the views
+    requires_system_checks = []
+    help = "Compare job-status fan-out for one global group against per-container subscriptions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--jobs', type=int, default=100, help="Jobs running, one container each")
+        parser.add_argument('--events', type=int, default=5, help="Events published per job")
+        parser.add_argument('--json', action='store_true', help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        results = [
+            asyncio.run(self.run(scoped, options['clients'], options['jobs'], options['events']))
+            for scoped in (False, True)
+        ]
+        broadcast, scoped = results
+        if broadcast['deliveries'] and scoped['deliveries']:
+            scoped['reduction'] = broadcast['deliveries'] / scoped['deliveries']
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        for result in results:
+            self.stdout.write(
+                f"{result['routing']:>9}: {result['deliveries']} deliveries for {result['events']} events "
+                f"({result['deliveries_per_event']:.1f}/event) in {result['seconds']:.3f}s"
+            )
+        if 'reduction' in scoped:
+            self.stdout.write(self.style.SUCCESS(f"Fan-out reduced {scoped['reduction']:.0f}x"))
+
+    async def run(self, scoped, clients, jobs, events):
+        layer = InMemoryChannelLayer(expiry=3600, capacity=events * jobs + 1)
+        containers = [uuid.uuid4().hex + uuid.uuid4().hex for _ in range(jobs)]
+        channels = [await layer.new_channel() for _ in range(clients)]
+
+        # Each client owns one container; with one global group it hears about all of them
+        for number, channel in enumerate(channels):
+            if scoped:
+                await layer.group_add(job_status.container_group(containers[number % jobs]), channel)
+            else:
+                await layer.group_add('status_job_status', channel)
+
+        started = time.perf_counter()
+        for seq in range(events):
+            for container_id in containers:
+                event = {'type': 'job_progress', 'payload': {'v': 1, 'containerId': container_id, 'seq': seq}}
+                if scoped:
+                    await job_status.publish(container_id, event, layer)
+                else:
+                    await layer.group_send('status_job_status', event)
+        seconds = time.perf_counter() - started
+
+        deliveries = sum(queue.qsize() for queue in layer.channels.values())
+        return {
+            'routing': 'scoped' if scoped else 'broadcast',
+            'clients': clients,
+            'events': events * jobs,
+            'deliveries': deliveries,
+            'deliveries_per_event': deliveries / (events * jobs),
+            'seconds': seconds,
+        }
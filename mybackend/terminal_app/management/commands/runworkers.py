@@ -0,0 +1,394 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from terminal_app import registry, workers
+
+logger = logging.getLogger(__name__)
+
+worker_settings = getattr(settings, 'TERMINAL_WORKERS', {})
+DRAIN_TIMEOUT = worker_settings.get('DRAIN_TIMEOUT', 600)
+HEARTBEAT_INTERVAL = worker_settings.get('HEARTBEAT_INTERVAL', 1)
+HEARTBEAT_TIMEOUT = worker_settings.get('HEARTBEAT_TIMEOUT', 10)
+# Importing Django and the app takes a while before the first heartbeat
+STARTUP_TIMEOUT = worker_settings.get('STARTUP_TIMEOUT', 60)
+# Seconds between the metrics and stats each worker sends with its heartbeat
+REPORT_INTERVAL = worker_settings.get('REPORT_INTERVAL', 5)
+
+
+def cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# Entry point of each worker process: Daphne on the listening socket the
+# parent bound, reporting to it over the heartbeat pipe
+def run_worker(listen_fd, heartbeat_fd, drain_timeout, heartbeat_interval, permessage_deflate):
+    import django
+    django.setup()
+
+    # Installs Twisted's asyncio reactor, so before anything else imports one
+    from daphne.server import Server
+    from daphne.ws_protocol import WebSocketProtocol
+    from django.utils.module_loading import import_string
+    from twisted.internet import reactor
+
+    from terminal_app import jobs, workers
+
+    class Worker(Server):
+        def __init__(self, application):
+            super().__init__(
+                application,
+                endpoints=[f"fd:fileno={listen_fd}"],
+                signal_handlers=False,
+                ready_callable=self.ready,
+            )
+            self.ports = []
+            self.draining = None
+            self.reported = 0.0
+            self.heartbeat = os.fdopen(heartbeat_fd, 'w', buffering=1)
+
+        def listen_success(self, port):
+            self.ports.append(port)
+            super().listen_success(port)
+
+        def ready(self):
+            if permessage_deflate:
+                from terminal_app import streaming
+                self.ws_factory.setProtocolOptions(perMessageCompressionAccept=streaming.accept_permessage_deflate)
+            loop = asyncio.get_event_loop()
+            loop.add_signal_handler(signal.SIGTERM, self.drain)
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+            self.beat()
+
+        def beat(self):
+            websockets = sum(1 for protocol in self.connections if isinstance(protocol, WebSocketProtocol))
+            beat = {
+                'pid': os.getpid(),
+                'connections': len(self.connections),
+                'websockets': websockets,
+                'draining': self.draining is not None,
+            }
+            if time.monotonic() - self.reported >= REPORT_INTERVAL:
+                beat['report'] = workers.report()
+                self.reported = time.monotonic()
+            try:
+                self.heartbeat.write(json.dumps(beat) + '\n')
+            except (BrokenPipeError, ValueError):
+                # Parent is gone, nobody would replace us on a reload
+                logger.warning(f"Worker {os.getpid()} lost its parent, stopping.")
+                self.stop()
+                return
+            reactor.callLater(heartbeat_interval, self.beat)
+
+        # Stop accepting and let open connections and engine jobs finish;
+        # the other workers take new connections from the shared socket,
+        # and the new generation's primary the background work
+        def drain(self):
+            if self.draining is not None:
+                self.stop()
+                return
+            self.draining = time.monotonic()
+            for port in self.ports:
+                port.stopListening()
+            workers.step_down()
+            logger.info(f"Worker {os.getpid()} draining {len(self.connections)} connections.")
+            self.check_drained()
+
+        def check_drained(self):
+            if not self.connections and jobs.engine.idle():
+                logger.info(f"Worker {os.getpid()} drained.")
+                self.stop()
+            elif time.monotonic() - self.draining > drain_timeout:
+                logger.warning(f"Worker {os.getpid()} closing {len(self.connections)} connections left after draining.")
+                self.stop()
+            else:
+                reactor.callLater(1, self.check_drained)
+
+    Worker(import_string(settings.ASGI_APPLICATION)).run()
+
+
+# One worker process as the parent sees it. Slot 0 of each generation is
+# the primary, and a replacement takes the slot of the worker it replaces.
+class WorkerProcess:
+    def __init__(self, process, pipe, generation, slot):
+        self.process = process
+        self.pipe = pipe
+        self.generation = generation
+        self.slot = slot
+        self.worker_id = f"{generation}.{slot}"
+        self.started = time.monotonic()
+        self.beat = None
+        self.stats = {}
+        self.report = None
+        self.report_fresh = False
+        self.state = 'starting'
+        self.drain_started = None
+        self._buffer = b''
+
+    def read_heartbeats(self):
+        try:
+            data = os.read(self.pipe, 65536)
+        except BlockingIOError:
+            return
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            self.stats = json.loads(line)
+            report = self.stats.pop('report', None)
+            if report is not None:
+                self.report = report
+                self.report_fresh = True
+            self.beat = time.monotonic()
+            if self.state == 'starting':
+                self.state = 'running'
+
+    def signal(self, signum):
+        if self.process.poll() is None:
+            self.process.send_signal(signum)
+
+    def status(self, now):
+        return {
+            'pid': self.process.pid,
+            'worker': self.worker_id,
+            'primary': self.slot == 0,
+            'generation': self.generation,
+            'state': self.state,
+            'uptime': round(now - self.started, 1),
+            'last_heartbeat': round(now - self.beat, 1) if self.beat else None,
+            'connections': self.stats.get('connections', 0),
+            'websockets': self.stats.get('websockets', 0),
+        }
+
+
+# Keeps `workers` Daphne processes serving one listening socket. SIGHUP
+# starts a fresh generation and drains the old one once the new workers
+# are up; SIGTERM or SIGINT drains everything and exits, a second one
+# stops the workers at once. Workers that exit unexpectedly or miss
+# heartbeats for HEARTBEAT_TIMEOUT are replaced. The workers' reports of
+# metrics and stats are published together to the shared cache.
+class Supervisor:
+    def __init__(self, sock, workers, drain_timeout, status_file, permessage_deflate):
+        self.sock = sock
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.status_file = status_file
+        self.permessage_deflate = permessage_deflate
+        # Names this launcher's workers in the shared cache and the channel layer
+        self.group = re.sub(r'[^A-Za-z0-9_.-]', '-', f"{socket.gethostname()}-{sock.getsockname()[1]}")
+        self.generation = 0
+        self.processes = []
+        self.selector = selectors.DefaultSelector()
+        self.reload_requested = False
+        self.stopping = None
+        self.restarts = 0
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        self._start_generation()
+        while self.processes or self.stopping is None:
+            for key, _ in self.selector.select(timeout=HEARTBEAT_INTERVAL / 2):
+                key.data.read_heartbeats()
+            if self.reload_requested:
+                self.reload_requested = False
+                if self.stopping is None:
+                    self._start_generation()
+            self._check()
+            self._publish_reports()
+            self._write_status()
+        self.sock.close()
+        logger.info("All workers stopped.")
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_stop(self, signum, frame):
+        if self.stopping is None:
+            logger.info(f"Draining {len(self.processes)} workers.")
+            self.stopping = time.monotonic()
+            for worker in self.processes:
+                self._drain(worker)
+        else:
+            logger.info("Stopping workers now.")
+            for worker in self.processes:
+                worker.signal(signal.SIGINT)
+
+    def _start_generation(self):
+        self.generation += 1
+        logger.info(f"Starting {self.workers} workers, generation {self.generation}.")
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+    def _spawn(self, slot):
+        read, write = os.pipe()
+        os.set_blocking(read, False)
+        code = (
+            "from terminal_app.management.commands.runworkers import run_worker; "
+            f"run_worker({self.sock.fileno()}, {write}, {self.drain_timeout}, {HEARTBEAT_INTERVAL}, {self.permessage_deflate})"
+        )
+        process = subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=settings.BASE_DIR,
+            pass_fds=(self.sock.fileno(), write),
+            env={
+                **os.environ,
+                'TERMINAL_WORKER_GROUP': self.group,
+                'TERMINAL_WORKER_ID': f"{self.generation}.{slot}",
+                'TERMINAL_WORKER_PRIMARY': '1' if slot == 0 else '0',
+            },
+            # Ctrl-C reaches the parent only, which drains the workers
+            start_new_session=True,
+        )
+        os.close(write)
+        worker = WorkerProcess(process, read, self.generation, slot)
+        self.selector.register(read, selectors.EVENT_READ, worker)
+        self.processes.append(worker)
+
+    def _drain(self, worker):
+        if worker.state != 'draining':
+            worker.state = 'draining'
+            worker.drain_started = time.monotonic()
+            worker.signal(signal.SIGTERM)
+
+    def _check(self):
+        now = time.monotonic()
+        current = [worker for worker in self.processes if worker.generation == self.generation]
+        # Older generations drain once every current worker answers
+        if self.stopping is None and all(worker.state == 'running' for worker in current):
+            for worker in self.processes:
+                if worker.generation < self.generation:
+                    self._drain(worker)
+
+        for worker in list(self.processes):
+            code = worker.process.poll()
+            if code is not None:
+                self._reap(worker, code)
+                continue
+            if worker.state == 'starting' and now - worker.started > STARTUP_TIMEOUT:
+                logger.error(f"Worker {worker.process.pid} did not start in {STARTUP_TIMEOUT} s, killing it.")
+                worker.process.kill()
+            elif worker.state == 'running' and now - worker.beat > HEARTBEAT_TIMEOUT:
+                logger.error(f"Worker {worker.process.pid} missed heartbeats for {now - worker.beat:.0f} s, killing it.")
+                worker.process.kill()
+            elif worker.state == 'draining' and now - worker.drain_started > self.drain_timeout + HEARTBEAT_TIMEOUT:
+                logger.error(f"Worker {worker.process.pid} did not finish draining, killing it.")
+                worker.process.kill()
+
+    def _reap(self, worker, code):
+        self.processes.remove(worker)
+        self.selector.unregister(worker.pipe)
+        os.close(worker.pipe)
+        if worker.state == 'draining':
+            logger.info(f"Worker {worker.process.pid} exited after draining.")
+            return
+        logger.error(f"Worker {worker.process.pid} exited with {code}, replacing it.")
+        self.restarts += 1
+        if worker.generation == self.generation and self.stopping is None:
+            # A worker failing at startup would otherwise respawn in a tight loop
+            if time.monotonic() - worker.started < 1:
+                time.sleep(1)
+            self._spawn(worker.slot)
+
+    # Whichever worker serves /metrics/ or a stats endpoint reads the
+    # others' latest reports from here
+    def _publish_reports(self):
+        if not any(worker.report_fresh for worker in self.processes):
+            return
+        reports = {worker.worker_id: worker.report for worker in self.processes if worker.report}
+        for worker in self.processes:
+            worker.report_fresh = False
+        try:
+            cache.set(workers.reports_key(self.group), reports, timeout=REPORT_INTERVAL * 3)
+        except Exception as e:
+            logger.error(f"Publishing worker reports failed: {e}")
+
+    def _write_status(self):
+        if not self.status_file:
+            return
+        now = time.monotonic()
+        status = {
+            'pid': os.getpid(),
+            'address': '%s:%s' % self.sock.getsockname()[:2],
+            'generation': self.generation,
+            'restarts': self.restarts,
+            'stopping': self.stopping is not None,
+            'updated': time.time(),
+            'workers': [worker.status(now) for worker in self.processes],
+        }
+        # Readers never see a half-written file
+        temporary = f"{self.status_file}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(status, f)
+        os.replace(temporary, self.status_file)
+
+
+class Command(BaseCommand):
+    help = "Serve the ASGI application from several Daphne worker processes sharing one port"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--bind', default='127.0.0.1')
+        parser.add_argument('-p', '--port', type=int, default=8001)
+        parser.add_argument(
+            '-w', '--workers', type=int, default=worker_settings.get('WORKERS') or 0,
+            help="Worker processes, one per CPU core when 0",
+        )
+        parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT, help="Seconds old workers keep open connections after a reload")
+        parser.add_argument('--status-file', default=worker_settings.get('STATUS_FILE', ''), help="Where to keep a JSON report of worker health")
+        parser.add_argument('--permessage-deflate', action='store_true', default=worker_settings.get('PERMESSAGE_DEFLATE', False))
+        parser.add_argument('--status', action='store_true', help="Print the status file of a running launcher and exit")
+
+    def handle(self, *args, **options):
+        if options['status']:
+            self.print_status(options['status_file'])
+            return
+
+        workers = options['workers'] or cpu_count()
+        if workers > 1 and not registry.ENABLED:
+            logger.warning(
+                "TERMINAL_REGISTRY is not enabled: viewers of one container on different workers "
+                "get separate attach streams, scrollback and recordings."
+            )
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((options['bind'], options['port']))
+        except OSError as e:
+            raise CommandError(f"Cannot listen on {options['bind']}:{options['port']}: {e}")
+        sock.listen(1024)
+        logger.info(f"Listening on {options['bind']}:{options['port']}, pid {os.getpid()}; SIGHUP reloads the workers.")
+        Supervisor(sock, workers, options['drain_timeout'], options['status_file'], options['permessage_deflate']).run()
+
+    def print_status(self, status_file):
+        if not status_file:
+            raise CommandError("No status file, pass --status-file or set TERMINAL_WORKERS['STATUS_FILE']")
+        try:
+            with open(status_file) as f:
+                status = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read {status_file}: {e}")
+        age = time.time() - status['updated']
+        self.stdout.write(
+            f"Launcher {status['pid']} on {status['address']}, generation {status['generation']}, "
+            f"{status['restarts']} restarts, updated {age:.0f} s ago"
+        )
+        for worker in status['workers']:
+            heartbeat = '-' if worker['last_heartbeat'] is None else f"{worker['last_heartbeat']} s ago"
+            self.stdout.write(
+                f"  {worker['pid']:>7}  gen {worker['generation']}  {'primary' if worker.get('primary') else '':<7} {worker['state']:<9} up {worker['uptime']:>8} s  "
+                f"heartbeat {heartbeat:<9} {worker['connections']} connections, {worker['websockets']} websockets"
+            )
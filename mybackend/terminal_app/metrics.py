@@ -0,0 +1,219 @@
+import math
+import threading
+from bisect import bisect_left
+from collections import deque
+
+
+# Fixed-size window of latency samples with percentile lookup
+class LatencySamples:
+    def __init__(self, size=1024):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+        }
+
+
+# Prometheus text exposition of this process's metrics. Metrics are created
+# once at import by the module that updates them and changed in place:
+# inc() and observe() only touch preallocated attributes and lists, so they
+# stay on in the hot path. Updates take no lock; the streaming metrics are
+# only touched from the event loop thread, and a lost increment from a
+# worker thread is an acceptable price elsewhere.
+REGISTRY = []
+
+# Seconds, from a keystroke echo up to a slow container create
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    # function, when given, is called at scrape time for the value, or for
+    # a {label values tuple: value} dict when the metric has labels
+    def __init__(self, name, help, labelnames=(), function=None, register=True):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._children = {}
+        self._reset()
+        if register:
+            REGISTRY.append(self)
+
+    # Series for one set of label values; look it up once and keep it
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def _child(self):
+        return type(self)(self.name, self.help, register=False)
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        self.collect(lines)
+
+    # Sample lines only, without the HELP and TYPE header
+    def collect(self, lines):
+        if self.function is not None:
+            value = self.function()
+            if isinstance(value, dict):
+                for label_values, sample in value.items():
+                    lines.append(f"{self.name}{_labels(self.labelnames, label_values)} {_number(sample)}")
+            elif value is not None:
+                lines.append(f"{self.name} {_number(value)}")
+        elif self._children:
+            for label_values, child in list(self._children.items()):
+                child._samples(lines, self.labelnames, label_values)
+        else:
+            self._samples(lines, (), ())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _reset(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self, lines, labelnames, label_values):
+        lines.append(f"{self.name}{_labels(labelnames, label_values)} {_number(self.value)}")
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, labelnames=(), register=True):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, register=register)
+
+    def _reset(self):
+        # One slot per bucket plus +Inf, made cumulative only when scraped
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self):
+        return Histogram(self.name, self.help, self.buckets, register=False)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self, lines, labelnames, label_values):
+        names = labelnames + ('le',)
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(names, label_values + (_number(bound),))} {cumulative}")
+        lines.append(f"{self.name}_bucket{_labels(names, label_values + ('+Inf',))} {self.count}")
+        lines.append(f"{self.name}_sum{_labels(labelnames, label_values)} {_number(self.sum)}")
+        lines.append(f"{self.name}_count{_labels(labelnames, label_values)} {self.count}")
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (math.inf, -math.inf):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(int(value)) if isinstance(value, bool) else str(value)
+
+
+# Every registered metric as [name, help, kind, sample lines], for a
+# process that reports its metrics to another one
+def families():
+    result = []
+    for metric in REGISTRY:
+        lines = []
+        try:
+            metric.collect(lines)
+        except Exception as e:
+            lines = [f"# {metric.name} unavailable: {e}"]
+        result.append([metric.name, metric.help, metric.kind, lines])
+    return result
+
+
+# Families reported by several processes as one exposition: {process: families}.
+# Every sample gets a label naming its process, so series stay apart.
+def render_families(by_process, label='worker'):
+    merged = {}
+    for process, process_families in sorted(by_process.items()):
+        for name, help, kind, samples in process_families:
+            family = merged.setdefault(name, (help, kind, []))
+            family[2].extend(_with_label(sample, label, process) for sample in samples)
+    lines = []
+    for name, (help, kind, samples) in merged.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _with_label(sample, name, value):
+    if sample.startswith('#'):
+        return sample
+    label = f'{name}="{_escape(value)}"'
+    metric, brace, rest = sample.partition('{')
+    if brace and ' ' not in metric:
+        return f"{metric}{{{label},{rest}"
+    metric, _, number = sample.partition(' ')
+    return f"{metric}{{{label}}} {number}"
+
+
+# Every registered metric in the text exposition format
+def render():
+    lines = []
+    for metric in REGISTRY:
+        try:
+            metric.render(lines)
+        except Exception as e:
+            lines.append(f"# {metric.name} unavailable: {e}")
+    lines.append('')
+    return '\n'.join(lines)
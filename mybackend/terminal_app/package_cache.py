@@ -0,0 +1,104 @@
+from django.conf import settings
+
+# Shared apt download cache for the Debian and Ubuntu user containers.
+# Alpine has no cache: no package is ever installed on it, so there is
+# nothing for apk to download.
+#
+# User containers are untrusted and run as root, so what one of them can
+# write must not decide what another installs:
+#
+# - With APT_PROXY set (apt-cacher-ng or similar), containers fetch through
+#   the proxy and share no volume at all. This is the safer setup.
+# - Otherwise each distribution gets one named volume for the downloaded
+#   .deb files. Package lists are never shared: every container runs its
+#   own apt-get update against the signed repository indexes, and apt
+#   checks each cached .deb against the hashes in those lists before using
+#   it, re-downloading anything that does not match. A root user can still
+#   swap a file between that check and dpkg reading it, which is why the
+#   proxy is preferred wherever one can run. Installs and evictions
+#   run under flock on one lock file in the volume, so concurrent installs
+#   in different containers do not trip over each other; the archives are
+#   trimmed back under MAX_BYTES, least recently used first.
+
+package_cache_settings = getattr(settings, 'PACKAGE_CACHE', {})
+ENABLED = package_cache_settings.get('ENABLED', False)
+APT_PROXY = package_cache_settings.get('APT_PROXY', '')
+MAX_BYTES = package_cache_settings.get('MAX_BYTES', 5 * 1024 ** 3)
+LOCK_TIMEOUT = package_cache_settings.get('LOCK_TIMEOUT', 900)
+
+VOLUME_PREFIX = "terminal_pkgcache"
+APT_ARCHIVES = "/var/cache/apt/archives"
+
+# Taken by everything that reads or writes the shared archives
+ARCHIVES_LOCK = f"{APT_ARCHIVES}/.terminal-archives.lock"
+
+# system id -> (volume name, mount point) pairs
+CACHE_MOUNTS = {
+    1: [("debian_archives", APT_ARCHIVES)],
+    2: [("ubuntu_archives", APT_ARCHIVES)],
+}
+
+
+def uses_apt(system):
+    return ENABLED and system in [1, 2]
+
+
+def shares_volume(system):
+    return uses_apt(system) and not APT_PROXY
+
+
+# volumes= argument for containers.run, empty when nothing is shared
+def volumes_for(system):
+    if not shares_volume(system):
+        return {}
+    return {
+        f"{VOLUME_PREFIX}_{name}": {'bind': path, 'mode': 'rw'}
+        for name, path in CACHE_MOUNTS.get(system, [])
+    }
+
+
+def volume_names(system):
+    return [f"{VOLUME_PREFIX}_{name}" for name, _ in CACHE_MOUNTS.get(system, [])]
+
+
+# Point apt at the proxy, or keep downloaded .debs in the shared volume:
+# the Debian and Ubuntu images delete them after every install
+def setup_command(system):
+    if not uses_apt(system):
+        return None
+    if APT_PROXY:
+        return [
+            "/bin/sh", "-c",
+            f"echo 'Acquire::http::Proxy \"{APT_PROXY}\";' > /etc/apt/apt.conf.d/99terminal-proxy",
+        ]
+    return [
+        "/bin/sh", "-c",
+        "rm -f /etc/apt/apt.conf.d/docker-clean && "
+        "echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";' > /etc/apt/apt.conf.d/99terminal-keep-cache",
+    ]
+
+
+# The container's own lists, so no lock is needed
+def update_command():
+    return ["apt-get", "update"]
+
+
+def install_command(packages):
+    if APT_PROXY:
+        return ["apt-get", "install", "-y", *packages]
+    return ["flock", "-w", str(LOCK_TIMEOUT), ARCHIVES_LOCK, "apt-get", "install", "-y", *packages]
+
+
+# Delete the least recently accessed archives until the total fits MAX_BYTES
+def evict_command(system):
+    if not shares_volume(system):
+        return None
+    script = (
+        f"find {APT_ARCHIVES} -type f -name '*.deb' -exec stat -c '%X %s %n' {{}} + "
+        "| sort -n "
+        f"| awk -v max={MAX_BYTES} "
+        "'{ size[NR] = $2; name[NR] = substr($0, index($0, $3)); total += $2 } "
+        "END { for (i = 1; i <= NR && total > max; i++) { print name[i]; total -= size[i] } }' "
+        "| while IFS= read -r archive; do rm -f \"$archive\"; done"
+    )
+    return ["flock", "-w", str(LOCK_TIMEOUT), ARCHIVES_LOCK, "/bin/sh", "-c", script]
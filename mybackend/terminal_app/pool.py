@@ -0,0 +1,185 @@
+import logging
+import threading
+import time
+import uuid
+
+import docker
+from django.core.cache import cache
+
+from . import docker_control
+from .metrics import LatencySamples
+
+logger = logging.getLogger(__name__)
+
+POOL_LABEL = "terminal_app.pool"
+# Warm containers are named with this prefix until one is claimed
+POOL_PREFIX = "terminal-pool-"
+
+
+def misses_key(image):
+    return f"pool:misses:{image}"
+
+
+# Pool of pre-started containers per image, handed out by create_instance.
+# The pool is kept in Docker: warm containers carry POOL_LABEL and a
+# POOL_PREFIX name, so every worker process sees the same pool, and a
+# process starting later adopts what an earlier one left. A container is
+# claimed by renaming it, which only one of several processes racing for
+# it can do. A background thread, run by one process only (the primary
+# runworkers worker), keeps each image topped up between MIN_SIZE and
+# MAX_SIZE and removes warm containers left unused past IDLE_TIMEOUT;
+# misses in any process raise its target through the shared cache.
+class ContainerPool:
+    def __init__(self, client, images, min_size=1, max_size=3, idle_timeout=600, refill_interval=5, volumes=None):
+        self.client = client
+        self.images = list(images)
+        # Per-image volumes= for containers.run, so warm containers match cold ones
+        self.volumes = volumes or {}
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.idle_timeout = idle_timeout
+        self.refill_interval = refill_interval
+
+        # Warm containers per image as of the last refill
+        self._idle = {image: 0 for image in self.images}
+        self._target = {image: min_size for image in self.images}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.pool_latency = LatencySamples()
+        self.cold_latency = LatencySamples()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._refill_loop, name="container-pool", daemon=True)
+            self._thread.start()
+
+    # Stop refilling; the warm containers stay for whoever starts the pool next
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    # Claim a running warm container for the image, or None when the pool is empty
+    def acquire(self, image):
+        if image not in self._target:
+            return None
+        for container in docker_control.run_sync(self._warm, image):
+            if docker_control.run_sync(self._claim, container, f"terminal-{container.id[:12]}"):
+                with self._lock:
+                    self.hits += 1
+                self._wakeup.set()
+                return container
+        with self._lock:
+            self.misses += 1
+        # Demand outran the pool, keep one more warm next time
+        try:
+            cache.add(misses_key(image), 0, timeout=None)
+            cache.incr(misses_key(image))
+        except Exception as e:
+            logger.error(f"Recording a container pool miss for {image} failed: {e}")
+        self._wakeup.set()
+        return None
+
+    def record_create(self, seconds, from_pool):
+        if from_pool:
+            self.pool_latency.observe(seconds)
+        else:
+            self.cold_latency.observe(seconds)
+
+    def stats(self):
+        with self._lock:
+            sizes = dict(self._idle)
+            targets = dict(self._target)
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else None,
+            'idle': sizes,
+            'target': targets,
+            'create_latency': {
+                'pool': self.pool_latency.summary(),
+                'cold': self.cold_latency.summary(),
+            },
+        }
+
+    def _refill_loop(self):
+        while not self._stopped.is_set():
+            for image in self.images:
+                try:
+                    self._refill(image)
+                except Exception as e:
+                    logger.error(f"Container pool refill for {image} failed: {e}")
+            self._wakeup.wait(self.refill_interval)
+            self._wakeup.clear()
+
+    def _refill(self, image):
+        missed = cache.get(misses_key(image)) or 0
+        if missed:
+            cache.decr(misses_key(image), missed)
+        dead = self.client.containers.list(
+            all=True, filters={'label': f"{POOL_LABEL}={image}", 'name': POOL_PREFIX, 'status': ['exited', 'dead']}, sparse=True,
+        )
+        for container in dead:
+            logger.info(f"Discarding dead pooled container {container.id[:12]} ({image})")
+            self._remove(container)
+        warm = self._warm(image)
+        # Nobody ever attached to a warm container, so its age is its idle time
+        now = time.time()
+        expired = [
+            container for container in warm[:max(0, len(warm) - self.min_size)]
+            if now - container.attrs.get('Created', now) > self.idle_timeout
+        ]
+        with self._lock:
+            target = self._target[image] = max(self.min_size, min(self.max_size, self._target[image] + missed - len(expired)))
+        count = len(warm)
+        for container in expired:
+            # Claimed first, so no other process hands it out while it goes
+            if self._claim(container, f"terminal-evicted-{container.id[:12]}"):
+                logger.info(f"Evicting idle pooled container {container.id[:12]} ({image})")
+                self._remove(container)
+                count -= 1
+        while count < target and not self._stopped.is_set():
+            self.client.containers.run(
+                image=image,
+                entrypoint="/bin/sh",
+                detach=True,
+                stdin_open=True,
+                tty=True,
+                volumes=self.volumes.get(image) or None,
+                labels={POOL_LABEL: image},
+                name=f"{POOL_PREFIX}{uuid.uuid4().hex[:12]}",
+            )
+            count += 1
+        with self._lock:
+            self._idle[image] = count
+
+    # Unclaimed running warm containers for the image, oldest first; ones
+    # that died waiting (OOM, a daemon restart) are never handed out
+    def _warm(self, image):
+        containers = self.client.containers.list(
+            filters={'label': f"{POOL_LABEL}={image}", 'name': POOL_PREFIX, 'status': 'running'},
+            sparse=True,
+        )
+        return sorted(containers, key=lambda container: container.attrs.get('Created', 0))
+
+    # Docker renames atomically: of several processes renaming one container
+    # to the same new name, one succeeds and the others get an error
+    def _claim(self, container, name):
+        try:
+            container.rename(name)
+        except docker.errors.APIError:
+            return False
+        return True
+
+    def _remove(self, container):
+        try:
+            container.remove(force=True)
+        except Exception as e:
+            logger.error(f"Error removing pooled container {container.id[:12]}: {e}")
@@ -0,0 +1,94 @@
+import asyncio
+import codecs
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import job_status
+
+# Bumped whenever the job_progress payload changes shape
+PROGRESS_VERSION = 1
+
+progress_settings = getattr(settings, 'JOB_PROGRESS', {})
+
+
+# Streams a job's output and phase changes to job-status subscribers.
+# Lines are batched into one message per interval, at most max_rate
+# messages a second, and a batch keeps only its last max_lines lines with
+# a count of the ones dropped, so a 20k-line apt log stays a few hundred
+# small messages. Lines held back by the rate cap go out on a timer, so
+# the last progress line of a command that goes quiet is not left unsent.
+class ProgressReporter:
+    def __init__(self, container_id, job_id):
+        self.container_id = container_id
+        self.job_id = job_id
+        self.max_lines = progress_settings.get('MAX_LINES', 50)
+        self.min_gap = 1.0 / progress_settings.get('MAX_RATE', 4)
+        self.phase_name = None
+        self._seq = 0
+        self._lines = []
+        self._dropped = 0
+        self._partial = ''
+        # A multibyte character can be split across exec output chunks
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._last_sent = 0.0
+        self._timer = None
+        self._pending = None
+        self._channel_layer = get_channel_layer()
+
+    async def phase(self, name):
+        self._partial += self._decoder.decode(b'', True)
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ''
+        await self.flush()
+        self.phase_name = name
+        await self.flush(force=True)
+
+    # Raw exec output, split into lines; '\r' redraws count as line ends
+    async def feed(self, chunk):
+        text = self._partial + self._decoder.decode(chunk)
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            if line:
+                self._add_line(line)
+        if not self._lines:
+            return
+        wait = self._last_sent + self.min_gap - time.monotonic()
+        if wait <= 0:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(wait, self._flush_later)
+
+    async def flush(self, force=False):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if not self._lines and not force:
+            return
+        payload = {
+            'v': PROGRESS_VERSION,
+            'containerId': self.container_id,
+            'jobId': self.job_id,
+            'phase': self.phase_name,
+            'seq': self._seq,
+            'lines': '\n'.join(self._lines),
+            'dropped': self._dropped,
+        }
+        self._seq += 1
+        self._lines = []
+        self._dropped = 0
+        self._last_sent = time.monotonic()
+        await job_status.publish(self.container_id, {'type': 'job_progress', 'payload': payload}, self._channel_layer)
+
+    def _flush_later(self):
+        self._timer = None
+        self._pending = asyncio.ensure_future(self.flush())
+
+    def _add_line(self, line):
+        self._lines.append(line)
+        if len(self._lines) > self.max_lines:
+            del self._lines[0]
+            self._dropped += 1
@@ -0,0 +1,275 @@
+import asyncio
+import bisect
+import codecs
+import json
+import logging
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+recording_settings = getattr(settings, 'TERMINAL_RECORDING', {})
+ENABLED = recording_settings.get('ENABLED', False)
+DIRECTORY = str(recording_settings.get('DIRECTORY', 'recordings'))
+BLOCK_BYTES = recording_settings.get('BLOCK_BYTES', 64 * 1024)
+FLUSH_INTERVAL = recording_settings.get('FLUSH_INTERVAL', 1.0)
+RECORD_INPUT = recording_settings.get('RECORD_INPUT', True)
+# Terminal output is repetitive enough that the fastest level already shrinks it several times over
+COMPRESS_LEVEL = recording_settings.get('COMPRESS_LEVEL', 1)
+
+# File layout, all little-endian:
+#   MAGIC, u32 header length, JSON header
+#   blocks: BLOCK header (compressed length, raw length, first and last
+#   event time, terminal size when the block starts) followed by a zlib
+#   stream of events
+#   event: EVENT header (seconds since start, kind, length) and the data
+# Every block decompresses on its own, so each is a keyframe, and the .idx
+# file next to the recording holds one INDEX entry (first event time,
+# block offset) per block for seeking.
+MAGIC = b'TREC\x01'
+HEADER_LENGTH = struct.Struct('<I')
+BLOCK = struct.Struct('<IIddHH')
+EVENT = struct.Struct('<dcI')
+INDEX = struct.Struct('<dQ')
+
+# Event kinds, as in asciicast v2
+OUTPUT = b'o'
+INPUT = b'i'
+RESIZE = b'r'
+
+
+# Tees one session into a recording. Events are packed into the current
+# block on the event loop, which costs a struct.pack and a copy; a block
+# goes to the writer thread once it reaches BLOCK_BYTES or has been open
+# for FLUSH_INTERVAL seconds, so the streaming path never waits on
+# compression or disk and the writer wakes once per block, not per event.
+class Recorder:
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.started = time.monotonic()
+
+        self._block = bytearray()
+        self._block_first = 0.0
+        self._block_last = 0.0
+        self._size = (header['width'], header['height'])
+        self._block_size = self._size
+        self._timer = None
+
+        # Owned by the writer thread
+        self._file = None
+        self._index = None
+
+    def output(self, data):
+        self._add(OUTPUT, data)
+
+    def input(self, data):
+        if RECORD_INPUT:
+            self._add(INPUT, data)
+
+    def resize(self, rows, cols):
+        self._size = (cols, rows)
+        self._add(RESIZE, f"{cols}x{rows}".encode())
+
+    def close(self):
+        self._flush()
+        writer.put(self, None)
+
+    def _add(self, kind, data):
+        elapsed = time.monotonic() - self.started
+        if not self._block:
+            self._block_first = elapsed
+            self._block_size = self._size if kind != RESIZE else self._block_size
+            self._timer = asyncio.get_running_loop().call_later(FLUSH_INTERVAL, self._flush)
+        self._block_last = elapsed
+        self._block += EVENT.pack(elapsed, kind, len(data))
+        self._block += data
+        if len(self._block) >= BLOCK_BYTES:
+            self._flush()
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._block:
+            writer.put(self, (self._block, self._block_first, self._block_last, self._block_size))
+            self._block = bytearray()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        header = json.dumps(self.header).encode()
+        # Never onto another session's recording
+        self._file = open(self.path, 'xb')
+        self._index = open(self.path + '.idx', 'xb')
+        self._file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+
+    def _write_block(self, block, first, last, size):
+        if self._file is None:
+            self._open()
+        compressed = zlib.compress(block, COMPRESS_LEVEL)
+        offset = self._file.tell()
+        self._file.write(BLOCK.pack(len(compressed), len(block), first, last, *size))
+        self._file.write(compressed)
+        self._file.flush()
+        # Written after its block, so the index never points past the data
+        self._index.write(INDEX.pack(first, offset))
+        self._index.flush()
+
+    def _finish(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+
+
+# One thread compresses and writes the blocks of every recording in the process
+class RecordingWriter:
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # block is None once the recording is closed
+    def put(self, recorder, block):
+        if self._thread is None:
+            self._start()
+        self._queue.put((recorder, block))
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="recording-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            recorder, block = self._queue.get()
+            try:
+                if block is None:
+                    recorder._finish()
+                else:
+                    recorder._write_block(*block)
+            except Exception as e:
+                logger.error(f"Recording write to {recorder.path} failed: {e}")
+
+
+writer = RecordingWriter()
+
+
+# Recorder for a new session, None when recording is off
+def start(key, rows=24, cols=80):
+    if not ENABLED:
+        return None
+    name = re.sub(r'[^A-Za-z0-9_.-]', '_', key)
+    # Sessions for one key can start within the same second in one process
+    path = os.path.join(DIRECTORY, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{uuid.uuid4().hex[:12]}.rec")
+    return Recorder(path, {'key': key, 'width': cols, 'height': rows, 'timestamp': int(time.time())})
+
+
+# Read side of a recording. The file is mapped rather than read, so
+# seeking to a late timestamp touches only the pages of the blocks played.
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as data:
+            self._map = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a terminal recording")
+        (length,) = HEADER_LENGTH.unpack_from(self._map, len(MAGIC))
+        start = len(MAGIC) + HEADER_LENGTH.size
+        self.header = json.loads(self._map[start:start + length])
+        self._data_start = start + length
+
+        self._times, self._offsets = [], []
+        if os.path.exists(path + '.idx'):
+            with open(path + '.idx', 'rb') as index:
+                entries = index.read()
+            for first, offset in INDEX.iter_unpack(entries[:len(entries) - len(entries) % INDEX.size]):
+                self._times.append(first)
+                self._offsets.append(offset)
+
+    def close(self):
+        self._map.close()
+
+    # Offset of the block holding the first event at or after seconds
+    def seek(self, seconds):
+        position = bisect.bisect_right(self._times, seconds) - 1
+        return self._offsets[position] if position >= 0 else self._data_start
+
+    # (width, height) in effect at seconds, from the enclosing block only
+    def size_at(self, seconds):
+        offset = self.seek(seconds)
+        if offset + BLOCK.size > len(self._map):
+            return self.header.get('width', 80), self.header.get('height', 24)
+        _, _, first, _, width, height = BLOCK.unpack_from(self._map, offset)
+        for _, kind, data in self.events(first, seconds):
+            if kind == RESIZE:
+                width, height = (int(part) for part in data.split(b'x'))
+        return width, height
+
+    # (seconds, kind, data) from the given time on. Blocks past the end of
+    # the index, from a recording still being written, are found by walking
+    # the block headers.
+    def events(self, start=0.0, end=None):
+        offset = self.seek(start)
+        size = len(self._map)
+        while offset + BLOCK.size <= size:
+            compressed, raw, first, last, _, _ = BLOCK.unpack_from(self._map, offset)
+            body = offset + BLOCK.size
+            if body + compressed > size:
+                break
+            offset = body + compressed
+            if last < start:
+                continue
+            if end is not None and first > end:
+                return
+            block = zlib.decompress(self._map[body:body + compressed], bufsize=raw)
+            position = 0
+            while position < len(block):
+                elapsed, kind, length = EVENT.unpack_from(block, position)
+                position += EVENT.size
+                if end is not None and elapsed > end:
+                    return
+                if elapsed >= start:
+                    yield elapsed, kind, block[position:position + length]
+                position += length
+
+    @property
+    def duration(self):
+        last = 0.0
+        offset = self._offsets[-1] if self._offsets else self._data_start
+        size = len(self._map)
+        while offset + BLOCK.size <= size:
+            compressed, _, _, last_event, _, _ = BLOCK.unpack_from(self._map, offset)
+            last = max(last, last_event)
+            offset += BLOCK.size + compressed
+        return last
+
+
+# Write the recording as asciicast v2, optionally from a point in time.
+# Output and input are decoded incrementally so a character split across
+# events stays whole.
+def export_asciicast(recording, out, start=0.0, end=None):
+    width, height = recording.size_at(start)
+    decoders = {}
+    out.write(json.dumps({
+        'version': 2,
+        'width': width,
+        'height': height,
+        'timestamp': recording.header.get('timestamp', 0) + int(start),
+    }) + '\n')
+    for elapsed, kind, data in recording.events(start, end):
+        decoder = decoders.get(kind)
+        if decoder is None:
+            decoder = decoders[kind] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        text = decoder.decode(data)
+        if text:
+            out.write(json.dumps([round(elapsed - start, 6), kind.decode(), text]) + '\n')
@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import os
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+
+from . import job_status, metrics
+
+logger = logging.getLogger(__name__)
+
+registry_settings = getattr(settings, 'TERMINAL_REGISTRY', {})
+ENABLED = registry_settings.get('ENABLED', False)
+LEASE_SECONDS = registry_settings.get('LEASE_SECONDS', 15)
+RENEW_INTERVAL = registry_settings.get('RENEW_INTERVAL', 5)
+# Where clients can reach this node, handed out by the session-owner view
+NODE_URL = registry_settings.get('NODE_URL', '')
+# Relayed output chunks queued on the owner before its reader waits, and
+# on a relay before it drops output
+RELAY_QUEUE = registry_settings.get('RELAY_QUEUE', 256)
+
+RELAYED_BYTES = metrics.Counter(
+    'terminal_relayed_bytes_total', 'Session output relayed between nodes, sent by owners and received by relays',
+    labelnames=('direction',),
+)
+RELAY_SENT, RELAY_RECEIVED = RELAYED_BYTES.labels('sent'), RELAYED_BYTES.labels('received')
+RELAY_DROPPED = metrics.Counter('terminal_relay_dropped_bytes_total', 'Relayed session output dropped by relays that could not keep up')
+TAKEOVERS = metrics.Counter('terminal_session_takeovers_total', 'Sessions this node took over after their owner went away')
+
+
+def owner_key(key):
+    return f"terminal:owner:{key}"
+
+
+# Same name as TerminalConsumer.group_name
+def relay_group(key):
+    return f"terminal_{key}"
+
+
+# Only container sessions are shared across nodes, and their ids make safe group names
+def routable(key, backend):
+    return ENABLED and backend.shared and job_status.is_container_id(key)
+
+
+async def owner(key):
+    return await cache.aget(owner_key(key))
+
+
+# Check-and-set on the lease in one step: it is only extended or released
+# while it still holds this node's record, never after another node took
+# it between reading and writing it
+EXTEND_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+# This node's lease record; the scripts compare it as the cache stores it
+def lease_record():
+    return {'channel': router.channel_name, 'node': NODE_URL}
+
+
+def _run_lease_script(script, key, *args):
+    cache_key = cache.make_and_validate_key(owner_key(key))
+    client = cache._cache
+    record = client._serializer.dumps(lease_record())
+    return bool(client.get_client(cache_key, write=True).eval(script, 1, cache_key, record, *args))
+
+
+async def extend_lease(key):
+    return await sync_to_async(_run_lease_script)(EXTEND_LEASE, key, LEASE_SECONDS)
+
+
+async def release_lease(key):
+    return await sync_to_async(_run_lease_script)(RELEASE_LEASE, key)
+
+
+# One per process: a channel on the channel layer that owners and relays
+# address each other by, and the lease loop for every routed session here
+class Router:
+    def __init__(self):
+        self.channel_name = None
+        self.sessions = {}
+        self._lock = None
+        self._tasks = []
+
+    async def start(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.channel_name:
+                return
+            self.layer = get_channel_layer()
+            # A plain specific channel: channels_redis pops every one of a
+            # process through a single receive, for one name prefix only.
+            # Tagged after the '!' so channel_capacity can size it.
+            channel = await self.layer.new_channel()
+            self.channel_name = channel.replace('!', '!router-', 1)
+            self._tasks = [asyncio.create_task(self._receive()), asyncio.create_task(self._renew())]
+            logger.info(f"Session router {self.channel_name} started, pid {os.getpid()}.")
+
+    async def _receive(self):
+        while True:
+            message = await self.layer.receive(self.channel_name)
+            routed = self.sessions.get(message.get('key'))
+            if routed is None:
+                continue
+            try:
+                await routed.handle(message)
+            except Exception as e:
+                logger.error(f"Error handling {message['type']} for {routed.key}: {e}")
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(RENEW_INTERVAL)
+            for routed in list(self.sessions.values()):
+                try:
+                    await routed.check_lease()
+                except Exception as e:
+                    logger.error(f"Lease check for {routed.key} failed: {e}")
+
+
+router = Router()
+
+# Wakes a relay's read() after it has taken the session over
+_TAKEOVER = object()
+
+
+# Container session routed across nodes. The node holding the lease in the
+# cache owns the attach stream and runs the wrapped backend; every other
+# node relays: output comes from the owner over the channel layer, to the
+# relay_group every relaying router has joined, and input and resizes go
+# to the owner's router channel. Owners renew their lease every
+# RENEW_INTERVAL; relays watch it, take over when it lapses and re-point
+# when another node got there first, so a dead node costs at most
+# LEASE_SECONDS of output. An owner that closes releases the lease and
+# tells the relays, so one of them takes over at once.
+class RoutedBackend:
+    shared = True
+
+    def __init__(self, key, inner):
+        self.key = key
+        self.inner = inner
+        self.owning = False
+        self.owner = None
+        self.relays = set()
+        self._output = asyncio.Queue(maxsize=RELAY_QUEUE)
+        self._dropped = 0
+        self._outbox = None
+        self._sender = None
+        self._joined = False
+        self._closed = False
+        self._checking = asyncio.Lock()
+
+    async def open(self):
+        await router.start()
+        router.sessions[self.key] = self
+        try:
+            await self._claim()
+        except BaseException:
+            router.sessions.pop(self.key, None)
+            raise
+
+    # A relay never holds its session's read loop: the owner's output keeps
+    # coming whatever this node does, so a slow viewer here is skipped and
+    # catches up from scrollback like any lagging viewer
+    @property
+    def relaying(self):
+        return not self.owning
+
+    async def _claim(self):
+        while True:
+            if await cache.aadd(owner_key(self.key), lease_record(), LEASE_SECONDS):
+                await self._own()
+                return
+            current = await owner(self.key)
+            if current is not None:
+                await self._relay_to(current['channel'])
+                return
+            # Expired between the two calls, try again
+
+    async def _own(self):
+        try:
+            await self.inner.open()
+        except BaseException:
+            await self._release()
+            raise
+        self.owning = True
+        self.owner = router.channel_name
+        self._outbox = asyncio.Queue(maxsize=RELAY_QUEUE)
+        self._sender = asyncio.create_task(self._send_relayed())
+        if self._joined:
+            # Was relaying until now
+            await router.layer.group_discard(relay_group(self.key), router.channel_name)
+            self._joined = False
+        logger.info(f"Node {router.channel_name} owns session {self.key}.")
+
+    async def _relay_to(self, channel):
+        self.owner = channel
+        if not self._joined:
+            await router.layer.group_add(relay_group(self.key), router.channel_name)
+            self._joined = True
+        await router.layer.send(channel, {'type': 'terminal.join', 'key': self.key, 'channel': router.channel_name})
+        logger.info(f"Relaying session {self.key} from {channel}.")
+
+    async def read(self):
+        while True:
+            if self.owning:
+                output = await self.inner.read()
+                if self.relays:
+                    await self._outbox.put(('terminal.output', output) if output else ('terminal.ended', b''))
+                return output
+            output = await self._output.get()
+            if output is not _TAKEOVER:
+                RELAY_RECEIVED.inc(len(output))
+                return output
+
+    async def write(self, data):
+        if self.owning:
+            await self.inner.write(data)
+        else:
+            await router.layer.send(self.owner, {'type': 'terminal.input', 'key': self.key, 'data': data})
+
+    async def resize(self, rows, cols):
+        if self.owning:
+            await self.inner.resize(rows, cols)
+        else:
+            await router.layer.send(self.owner, {'type': 'terminal.resize', 'key': self.key, 'rows': rows, 'cols': cols})
+
+    async def close(self):
+        self._closed = True
+        if router.sessions.get(self.key) is self:
+            del router.sessions[self.key]
+        if self.owning:
+            if self._sender:
+                self._sender.cancel()
+            await self._release()
+            await router.layer.group_send(relay_group(self.key), {'type': 'terminal.released', 'key': self.key})
+            await self.inner.close()
+        else:
+            if self._joined:
+                await router.layer.group_discard(relay_group(self.key), router.channel_name)
+            if self.owner:
+                await router.layer.send(self.owner, {'type': 'terminal.leave', 'key': self.key, 'channel': router.channel_name})
+
+    async def _release(self):
+        await release_lease(self.key)
+
+    async def handle(self, message):
+        kind = message['type']
+        if kind == 'terminal.output':
+            self._relayed(message['data'])
+        elif kind == 'terminal.ended':
+            self._relayed(b'', keep=True)
+        elif kind == 'terminal.released':
+            await self.check_lease()
+        elif not self.owning:
+            return
+        elif kind == 'terminal.join':
+            self.relays.add(message['channel'])
+        elif kind == 'terminal.leave':
+            self.relays.discard(message['channel'])
+        elif kind == 'terminal.input':
+            # Through the session, so relayed input queues with local input
+            from . import sessions
+            shared = sessions._attached.get(self.key)
+            if shared is not None and shared.backend is self:
+                await shared.write(message['data'])
+        elif kind == 'terminal.resize':
+            await self.inner.resize(message['rows'], message['cols'])
+
+    # Renew our lease, or follow or take over the session when the owner changed or went away
+    async def check_lease(self):
+        async with self._checking:
+            if not self._closed:
+                await self._check_lease()
+
+    async def _check_lease(self):
+        current = await owner(self.key)
+        if self.owning:
+            if current is not None and current['channel'] != router.channel_name:
+                # Another node took over while we could not renew; end this
+                # stream, clients reconnect and are relayed
+                logger.warning(f"Lost session {self.key} to {current['channel']}.")
+                await self.inner.close()
+            elif current is None:
+                await cache.aadd(owner_key(self.key), lease_record(), LEASE_SECONDS)
+            elif not await extend_lease(self.key):
+                # Taken over since the read above; the next check ends the stream
+                logger.warning(f"Lease on session {self.key} changed hands while renewing it.")
+            return
+        if current is None:
+            if await cache.aadd(owner_key(self.key), lease_record(), LEASE_SECONDS):
+                logger.info(f"Owner of session {self.key} went away, taking over.")
+                TAKEOVERS.inc()
+                await self._own()
+                self._relayed(_TAKEOVER, keep=True)
+                return
+            current = await owner(self.key)
+        if current is not None and current['channel'] != self.owner:
+            await self._relay_to(current['channel'])
+
+    # Relay side: the read loop takes output as fast as it comes, so a full
+    # queue means this node is overloaded; output is dropped rather than
+    # queued without bound. The end of the stream and a takeover are always
+    # kept, in place of the oldest chunk when need be.
+    def _relayed(self, item, keep=False):
+        if self._output.full():
+            dropped = self._output.get_nowait() if keep else item
+            if not self._dropped:
+                logger.warning(f"Relay of {self.key} fell {self._output.maxsize} chunks behind, dropping output.")
+            if dropped is not _TAKEOVER:
+                self._dropped += len(dropped)
+                RELAY_DROPPED.inc(len(dropped))
+            if not keep:
+                return
+        elif self._dropped:
+            logger.warning(f"Relay of {self.key} dropped {self._dropped} bytes of output.")
+            self._dropped = 0
+        self._output.put_nowait(item)
+
+    # Owner side: relayed output in read order, one group_send per chunk
+    async def _send_relayed(self):
+        group = relay_group(self.key)
+        while True:
+            kind, data = await self._outbox.get()
+            try:
+                await router.layer.group_send(group, {'type': kind, 'key': self.key, 'data': data})
+                RELAY_SENT.inc(len(data))
+            except Exception as e:
+                logger.error(f"Relaying output of {self.key} failed: {e}")
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path, re_path
 from . import consumers
 
@@ -5,3 +6,12 @@ websocket_urlpatterns = [
     re_path(r'ws/terminal/(?P<container_id>[^/]+)/$', consumers.TerminalConsumer.as_asgi()),
     path('ws/job-status/', consumers.JobConsumer.as_asgi()),
 ]
+
+# Shells on the server itself, off unless explicitly enabled
+if getattr(settings, 'TERMINAL_BACKENDS', {}).get('LOCAL_ENABLED', False):
+    websocket_urlpatterns.append(path('ws/local/', consumers.TerminalConsumer.as_asgi(backend='local')))
+
+# Shells on other hosts, opened from this server; off unless explicitly
+# enabled, and then only to the hosts in SSH_ALLOWED_HOSTS
+if getattr(settings, 'TERMINAL_BACKENDS', {}).get('SSH_ENABLED', False):
+    websocket_urlpatterns.append(re_path(r'ws/ssh/(?P<session_id>[^/]+)/$', consumers.TerminalConsumer.as_asgi(backend='ssh')))
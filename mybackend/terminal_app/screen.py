@@ -0,0 +1,287 @@
+import asyncio
+
+try:
+    import pyte
+    from pyte import graphics
+except ImportError:
+    pyte = None
+
+# SGR codes for pyte's colour names; 256-colour and truecolour cells come
+# back from pyte as hex and are sent as truecolour
+if pyte:
+    FG_CODES = {name: str(code) for code, name in {**graphics.FG_ANSI, **graphics.FG_AIXTERM}.items()}
+    BG_CODES = {name: str(code) for code, name in {**graphics.BG_ANSI, **graphics.BG_AIXTERM}.items()}
+
+# Private modes that change what the client sends rather than what it
+# shows, so they are forwarded: application cursor keys, mouse reporting
+# and bracketed paste. pyte keeps private modes shifted left by 5.
+CLIENT_MODES = (1, 1000, 1002, 1003, 1006, 2004)
+CURSOR_VISIBLE = 25 << 5
+
+
+def available():
+    return pyte is not None
+
+
+# Cursor-home sequences full-screen apps start a redraw with
+HOME = (b'\x1b[H', b'\x1b[1;1H', b'\x1b[;H')
+
+
+# One virtual screen per session, shared by all of its ?view=screen
+# viewers. Output is queued as it arrives and parsed on the viewers'
+# frame ticks, at most max_parse bytes per interval however many viewers
+# there are: pyte parses a few hundred kB a second, so this bounds what
+# the screen costs. When more than that has queued up, only the newest
+# output is parsed, from the latest cursor home if it is recent enough,
+# else from a line break: a full-screen app's last redraw covers what was
+# skipped, and scrolling output leaves only its last lines on screen.
+# feed() never blocks, so screen viewers never hold up the session.
+class SessionScreen:
+    def __init__(self, rows=24, cols=80, interval=1.0 / 30, max_parse=8192):
+        self.screen = pyte.Screen(cols, rows)
+        self.stream = pyte.ByteStream(self.screen)
+        self.interval = interval
+        self.max_parse = max_parse
+        self.renderers = set()
+        self.skipped = 0
+        self._pending = bytearray()
+        self._parsed_at = None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    async def feed(self, data):
+        self._pending += data
+        for renderer in self.renderers:
+            renderer._changed.set()
+
+    # Parses the newest queued output, once per interval unless forced
+    def parse(self, force=False):
+        now = asyncio.get_running_loop().time()
+        if not self._pending or (not force and self._parsed_at is not None and now - self._parsed_at < self.interval):
+            return
+        self._parsed_at = now
+        if len(self._pending) > self.max_parse:
+            self._skip()
+        data = bytes(self._pending[:self.max_parse])
+        del self._pending[:self.max_parse]
+        self.stream.feed(data)
+        for renderer in self.renderers:
+            renderer._dirty |= self.screen.dirty
+        self.screen.dirty.clear()
+
+    def _skip(self):
+        cut = len(self._pending) - self.max_parse
+        home = max(self._pending.rfind(sequence) for sequence in HOME)
+        if home >= cut:
+            cut = home
+        else:
+            line = self._pending.find(b'\n', cut)
+            cut = line + 1 if line >= 0 else len(self._pending)
+        del self._pending[:cut]
+        self.skipped += cut
+
+    def resize(self, rows, cols):
+        self.screen.resize(rows, cols)
+        for renderer in self.renderers:
+            renderer._full = True
+            renderer._changed.set()
+
+
+# Output stage for ?view=screen. Instead of forwarding every byte, the
+# session's SessionScreen is redrawn: at most fps times a second the
+# lines that changed since this viewer's last frame are sent, with cursor
+# addressing. Redraw-heavy apps (top, htop, watch) then cost at most a
+# screen per frame, and a client that cannot keep up skips the states in
+# between instead of falling further behind. With acked=True a new frame
+# waits until the client has acknowledged all but the last one.
+# Same interface as streaming.OutputCoalescer, plus attach().
+class ScreenRenderer:
+    def __init__(self, send, rows=24, cols=80, fps=30, max_parse=8192, acked=False):
+        self._send = send
+        self.rows = rows
+        self.cols = cols
+        self.interval = 1.0 / fps
+        self.max_parse = max_parse
+        self.acked = acked
+        self.session = None
+        self.screen = None
+        self._dirty = set()
+        self._modes = set()
+        self._full = True
+        self._fresh = False
+        self._sent = 0
+        self._acknowledged = 0
+        self._last_frame = 0
+        self._changed = asyncio.Event()
+        self._task = None
+        self._closed = False
+        self.frames = 0
+
+    # Joins the session's screen, starting one for its first screen viewer
+    def attach(self, session):
+        self._fresh = session.screen is None
+        if self._fresh:
+            session.screen = SessionScreen(self.rows, self.cols, self.interval, self.max_parse)
+        self.session = session
+        self.screen = session.screen
+        self.screen.renderers.add(self)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    # The session feeds its screen once for all of its viewers, and frames
+    # are skipped rather than queued, so a screen viewer is never behind
+    backlogged = False
+
+    async def feed(self, data):
+        pass
+
+    def offer(self, data):
+        pass
+
+    async def drained(self):
+        pass
+
+    # A screen already drawn has the replay's effect in it
+    def prime(self, data):
+        if data and self._fresh:
+            self.screen._pending += data
+            self._changed.set()
+
+    def resize(self, rows, cols):
+        self.screen.resize(rows, cols)
+
+    def ack(self, received):
+        self._acknowledged = min(max(received, self._acknowledged), self._sent)
+        self._changed.set()
+
+    async def close(self, flush=True):
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.screen is None:
+            return
+        if flush:
+            self.screen.parse(force=True)
+            if self._dirty or self._full:
+                await self._flush()
+        self.screen.renderers.discard(self)
+        if not self.screen.renderers and self.session.screen is self.screen:
+            self.session.screen = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._changed.wait()
+            started = loop.time()
+            self._changed.clear()
+            self.screen.parse()
+            if not self.acked or self._sent - self._acknowledged <= self._last_frame:
+                await self._flush()
+            if self.screen.pending:
+                self._changed.set()
+            # A slow send eats into the wait, so the cap holds for slow clients too
+            await asyncio.sleep(max(0.0, self.interval - (loop.time() - started)))
+
+    async def _flush(self):
+        frame = self.render()
+        if frame:
+            self.frames += 1
+            await self._send(frame)
+            self._sent += len(frame)
+            self._last_frame = len(frame)
+
+    # ANSI for everything that changed since the last call
+    def render(self):
+        screen = self.screen.screen
+        parts = []
+        if self._full:
+            parts.append('\x1b[0m\x1b[H\x1b[2J')
+            lines = range(screen.lines)
+            self._full = False
+        else:
+            lines = sorted(self._dirty)
+        self._dirty.clear()
+
+        for mode in CLIENT_MODES:
+            enabled = (mode << 5) in screen.mode
+            if enabled != (mode in self._modes):
+                parts.append(f"\x1b[?{mode}{'h' if enabled else 'l'}")
+                (self._modes.add if enabled else self._modes.discard)(mode)
+
+        if lines:
+            parts.append('\x1b[?25l')
+            for y in lines:
+                if y < screen.lines:
+                    parts.append(f'\x1b[{y + 1};1H')
+                    parts.append(render_line(screen.buffer[y], screen.columns))
+        elif not parts:
+            return b''
+
+        parts.append(f'\x1b[{screen.cursor.y + 1};{screen.cursor.x + 1}H')
+        if CURSOR_VISIBLE in screen.mode and not screen.cursor.hidden:
+            parts.append('\x1b[?25h')
+        return ''.join(parts).encode()
+
+
+PLAIN = ('default', 'default', False, False, False, False, False, False)
+
+
+# One screen line with SGR changes only where the attributes do. Lines
+# start and end with attributes reset; trailing default blanks are left to
+# an erase, so short lines stay short.
+def render_line(line, columns):
+    cells = [line[x] for x in range(columns)]
+    end = len(cells)
+    while end and cells[end - 1].data == ' ' and _is_plain(cells[end - 1]):
+        end -= 1
+
+    parts = []
+    current = PLAIN
+    for cell in cells[:end]:
+        # Second half of a wide character
+        if cell.data == '':
+            continue
+        attrs = (cell.fg, cell.bg, cell.bold, cell.italics, cell.underscore, cell.strikethrough, cell.reverse, cell.blink)
+        if attrs != current:
+            parts.append(_sgr(cell))
+            current = attrs
+        parts.append(cell.data)
+    parts.append('\x1b[0m\x1b[K')
+    return ''.join(parts)
+
+
+def _is_plain(cell):
+    return (cell.fg == 'default' and cell.bg == 'default' and not cell.reverse
+            and not cell.underscore and not cell.strikethrough)
+
+
+def _sgr(cell):
+    codes = ['0']
+    if cell.bold:
+        codes.append('1')
+    if cell.italics:
+        codes.append('3')
+    if cell.underscore:
+        codes.append('4')
+    if cell.blink:
+        codes.append('5')
+    if cell.reverse:
+        codes.append('7')
+    if cell.strikethrough:
+        codes.append('9')
+    for colour, names, base in ((cell.fg, FG_CODES, '38'), (cell.bg, BG_CODES, '48')):
+        if colour == 'default':
+            continue
+        if colour in names:
+            codes.append(names[colour])
+        elif len(colour) == 6:
+            codes.append(f'{base};2;{int(colour[0:2], 16)};{int(colour[2:4], 16)};{int(colour[4:6], 16)}')
+    return f"\x1b[{';'.join(codes)}m"
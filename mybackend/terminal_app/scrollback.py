@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# Fixed-size output history backed by one preallocated bytearray. Offsets
+# are absolute byte counts since the buffer was created, so a client can
+# ask for everything after the last byte it saw.
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.end = 0
+        self._buf = bytearray(capacity)
+
+    @property
+    def start(self):
+        return max(0, self.end - self.capacity)
+
+    def write(self, data):
+        size = len(data)
+        if size >= self.capacity:
+            # Only the last capacity bytes survive; lay them out at their ring positions
+            tail = memoryview(data)[size - self.capacity:]
+            self.end += size
+            pos = self.end % self.capacity
+            self._buf[pos:] = tail[:self.capacity - pos]
+            self._buf[:pos] = tail[self.capacity - pos:]
+            return
+        view = memoryview(data)
+        pos = self.end % self.capacity
+        first = min(size, self.capacity - pos)
+        self._buf[pos:pos + first] = view[:first]
+        if first < size:
+            self._buf[:size - first] = view[first:]
+        self.end += size
+
+    # Bytes from offset to the end, clamped to what is still held. An offset
+    # past the end comes from an evicted buffer and replays everything held.
+    def read_from(self, offset):
+        if offset > self.end:
+            offset = self.start
+        offset = max(offset, self.start)
+        if offset >= self.end:
+            return offset, b''
+        pos = offset % self.capacity
+        size = self.end - offset
+        if pos + size <= self.capacity:
+            return offset, bytes(self._buf[pos:pos + size])
+        return offset, bytes(self._buf[pos:]) + bytes(self._buf[:size - (self.capacity - pos)])
+
+
+# Per-container ring buffers under one memory budget. Buffers are kept in
+# order of last activity and the least recently active ones are dropped
+# when a new buffer would push the total past the budget.
+class ScrollbackStore:
+    def __init__(self, buffer_bytes, memory_budget):
+        self.buffer_bytes = buffer_bytes
+        self.memory_budget = memory_budget
+        self._buffers = OrderedDict()
+
+    def append(self, container_id, data):
+        buffer = self._buffers.get(container_id)
+        if buffer is None:
+            buffer = self._buffers[container_id] = RingBuffer(self.buffer_bytes)
+            self._evict()
+        else:
+            self._buffers.move_to_end(container_id)
+        buffer.write(data)
+
+    def read_from(self, container_id, offset):
+        buffer = self._buffers.get(container_id)
+        if buffer is None:
+            return 0, b''
+        return buffer.read_from(offset)
+
+    def end(self, container_id):
+        buffer = self._buffers.get(container_id)
+        return buffer.end if buffer else 0
+
+    def discard(self, container_id):
+        self._buffers.pop(container_id, None)
+
+    @property
+    def used_bytes(self):
+        return len(self._buffers) * self.buffer_bytes
+
+    def _evict(self):
+        while len(self._buffers) > 1 and self.used_bytes > self.memory_budget:
+            self._buffers.popitem(last=False)
+
+
+scrollback_settings = getattr(settings, 'TERMINAL_SCROLLBACK', {})
+store = ScrollbackStore(
+    buffer_bytes=scrollback_settings.get('BUFFER_BYTES', 256 * 1024),
+    memory_budget=scrollback_settings.get('MEMORY_BUDGET', 64 * 1024 * 1024),
+)
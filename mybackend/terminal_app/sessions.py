@@ -0,0 +1,214 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+from . import docker_control, lifecycle, metrics, recording, registry, scrollback
+from .container_index import get_index
+from .streaming import InputWriter
+
+logger = logging.getLogger(__name__)
+
+streaming_settings = getattr(settings, 'TERMINAL_STREAMING', {})
+
+async def start_container(container_id):
+    client = docker_control.get_client()
+    if lifecycle.manager:
+        await lifecycle.manager.ensure_running(container_id)
+    index = get_index()
+    if index and index.ready:
+        entry = index.get(container_id)
+        if entry and entry['status'] == 'running':
+            # Known running from the event stream, no daemon round trip needed
+            return client.containers.prepare_model({'Id': entry['id']})
+
+    running_containers = await docker_control.run(client.containers.list, filters={"id": container_id, "status": "running"})
+    if running_containers:
+        print(f"Container {container_id} is already running.")
+        return running_containers[0]
+    else:
+        print(f"Starting container {container_id}")
+        container = await docker_control.run(client.containers.get, container_id)
+        if container.status == 'paused':
+            await docker_control.run(container.unpause)
+        else:
+            await docker_control.run(container.start)
+        return container
+
+# Bytes requested from the attach socket per read
+READ_SIZE = 4096
+
+READ_BYTES = metrics.Histogram(
+    'terminal_read_bytes', 'Bytes returned by each read from a session backend',
+    buckets=(16, 64, 256, 1024, 2048, 4096, 16384, 65536),
+)
+WRITE_BYTES = metrics.Histogram(
+    'terminal_write_bytes', 'Bytes passed to each write to a session backend',
+    buckets=(16, 64, 256, 1024, 2048, 4096, 16384, 65536),
+)
+
+# Wait for the non-blocking attach socket to become readable on the event loop
+# itself, so idle sessions cost nothing. Returns b'' once the stream has ended.
+async def read_from_docker(socket_docker):
+    loop = asyncio.get_running_loop()
+    return await loop.sock_recv(socket_docker._sock, READ_SIZE)
+
+
+# One session per key per process, on top of a backends.py backend.
+# Every consumer viewing it subscribes: output is fanned out to each
+# subscriber's output stage and input from any of them goes to the same
+# stdin. Only shared (container) sessions keep scrollback, the rest are
+# keyed per connection.
+class SharedSession:
+    def __init__(self, key, backend):
+        self.key = key
+        self.backend = backend
+        self.subscribers = set()
+        self.refs = 0
+        self.opening = None
+        self.reader_task = None
+        # Catch-up task of each subscriber that fell behind the others
+        self.lagging = {}
+        self.recorder = None
+        # screen.SessionScreen while anyone views the session with ?view=screen
+        self.screen = None
+        self.input = InputWriter(
+            self._write,
+            max_bytes=streaming_settings.get('INPUT_QUEUE_BYTES', 256 * 1024),
+            max_write=streaming_settings.get('MAX_INPUT_WRITE', 65536),
+            linger=streaming_settings.get('INPUT_LINGER', 0.002),
+        )
+
+    # rows and cols are the opening viewer's terminal size, for the recording
+    async def open(self, rows=24, cols=80):
+        await self.backend.open()
+        self.recorder = recording.start(self.key, rows, cols)
+        self.reader_task = asyncio.create_task(self._read_loop())
+        self.input.start()
+
+    # Queued behind earlier input, waiting only when the queue is full
+    async def write(self, data):
+        if self.recorder:
+            self.recorder.input(data)
+        await self.input.put(data)
+
+    async def _write(self, data):
+        WRITE_BYTES.observe(len(data))
+        await self.backend.write(data)
+
+    async def resize(self, rows, cols):
+        if self.recorder:
+            self.recorder.resize(rows, cols)
+        await self.backend.resize(rows, cols)
+
+    async def close(self):
+        if self.reader_task and self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+        await self.input.close()
+        if self.recorder:
+            self.recorder.close()
+        await self.backend.close()
+
+    async def _read_loop(self):
+        try:
+            while True:
+                output = await self.backend.read()
+                if not output:
+                    logger.info(f"Session stream for {self.key} ended.")
+                    break
+                READ_BYTES.observe(len(output))
+                if self.recorder:
+                    self.recorder.output(output)
+                if self.backend.shared:
+                    scrollback.store.append(self.key, output)
+                if self.screen:
+                    await self.screen.feed(output)
+                await self._fan_out(output)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in session stream for {self.key}: {e}")
+        # Later viewers must open afresh rather than join a dead stream
+        if _attached.get(self.key) is self:
+            del _attached[self.key]
+        for consumer in list(self.subscribers):
+            await consumer.stream_ended()
+
+    # A lone subscriber above its high-water mark holds the stream, which
+    # slows the app down rather than buffer its output. With several, or on
+    # a node relaying another node's stream, one that falls behind is
+    # skipped instead, so it holds up nobody else, and catches up from
+    # scrollback once it has drained.
+    async def _fan_out(self, output):
+        subscribers = list(self.subscribers)
+        if len(subscribers) == 1 and not self.lagging and not getattr(self.backend, 'relaying', False):
+            await subscribers[0].output.feed(output)
+            return
+        for consumer in subscribers:
+            if consumer in self.lagging:
+                continue
+            if consumer.output.backlogged and self.backend.shared:
+                missed_from = scrollback.store.end(self.key) - len(output)
+                self.lagging[consumer] = asyncio.ensure_future(self._catch_up(consumer, missed_from))
+                continue
+            consumer.output.offer(output)
+
+    async def _catch_up(self, consumer, offset):
+        try:
+            while True:
+                await consumer.output.drained()
+                start, data = scrollback.store.read_from(self.key, offset)
+                if start > offset:
+                    logger.warning(f"Viewer of {self.key} fell {start - offset} bytes past the scrollback and missed them.")
+                if not data:
+                    # Up to date, and nothing can arrive before the next fan-out
+                    break
+                consumer.output.offer(data)
+                offset = start + len(data)
+        finally:
+            if self.lagging.get(consumer) is asyncio.current_task():
+                del self.lagging[consumer]
+
+    def stop_catching_up(self, consumer):
+        task = self.lagging.pop(consumer, None)
+        if task:
+            task.cancel()
+
+
+_attached = {}
+
+metrics.Gauge('terminal_sessions', 'Open session backends in this process', function=lambda: len(_attached))
+metrics.Gauge(
+    'terminal_viewers', 'WebSocket clients subscribed to a session',
+    function=lambda: sum(len(shared.subscribers) for shared in list(_attached.values())),
+)
+
+# Join the session for key, opening make_backend() first if nobody holds it yet
+async def subscribe(key, consumer, make_backend):
+    shared = _attached.get(key)
+    if shared is None:
+        backend = make_backend()
+        # With several nodes, only the lease holder attaches; the rest relay
+        if registry.routable(key, backend):
+            backend = registry.RoutedBackend(key, backend)
+        shared = _attached[key] = SharedSession(key, backend)
+        shared.opening = asyncio.ensure_future(shared.open(consumer.rows, consumer.cols))
+    shared.refs += 1
+    try:
+        await asyncio.shield(shared.opening)
+    except BaseException:
+        await unsubscribe(shared, consumer)
+        raise
+    shared.subscribers.add(consumer)
+    return shared
+
+# Leave the session, tearing it down when the last viewer is gone
+async def unsubscribe(shared, consumer):
+    shared.subscribers.discard(consumer)
+    shared.stop_catching_up(consumer)
+    shared.refs -= 1
+    if shared.refs > 0:
+        return
+    if _attached.get(shared.key) is shared:
+        del _attached[shared.key]
+    await shared.close()
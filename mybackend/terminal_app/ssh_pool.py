@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+from . import metrics, workers
+from .metrics import LatencySamples
+
+logger = logging.getLogger(__name__)
+
+backend_settings = getattr(settings, 'TERMINAL_BACKENDS', {})
+
+# Keys the credential fingerprints, so the pool holds nothing a password could be recovered from
+_FINGERPRINT_KEY = os.urandom(32)
+
+
+def fingerprint(password):
+    return hmac.new(_FINGERPRINT_KEY, password.encode(), hashlib.sha256).hexdigest()
+
+
+# One authenticated SSH connection and the shells open on it
+class PooledTransport:
+    def __init__(self, key, client, max_channels):
+        self.key = key
+        self.client = client
+        self.channels = 0
+        self.max_channels = max_channels
+        self.idle_timer = None
+
+    def active(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+# Authenticated SSH transports keyed by (host, port, user, credential
+# fingerprint). A new session to the same host as the same user opens a
+# channel on a transport already in the pool, one round trip instead of
+# TCP, key exchange and authentication. Transports carry up to
+# max_channels shells, OpenSSH's default MaxSessions, and close once
+# they have had none for idle_timeout. Handshakes and channel opens run
+# in the default executor; concurrent opens for one key wait for a single
+# handshake rather than each starting their own.
+class SSHTransportPool:
+    def __init__(self, idle_timeout=300, max_channels=10, connect_timeout=10):
+        self.idle_timeout = idle_timeout
+        self.max_channels = max_channels
+        self.connect_timeout = connect_timeout
+
+        self._transports = {}
+        self._connecting = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.pool_latency = LatencySamples()
+        self.cold_latency = LatencySamples()
+
+    # Shell channel for the user on host, and the transport it runs on for release()
+    async def open_shell(self, host, port, username, password):
+        key = (host, port, username, fingerprint(password))
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        pooled = self._reserve(key)
+        if pooled is None:
+            pooled = await self._wait_for_handshake(key)
+        if pooled is not None:
+            try:
+                channel = await loop.run_in_executor(None, _invoke_shell, pooled.client)
+            except Exception as e:
+                if pooled.active():
+                    # Refused by the server, likely a lower MaxSessions; the
+                    # shells already on it are fine, just open no more there
+                    pooled.max_channels = pooled.channels - 1
+                    self.release(pooled)
+                else:
+                    # Went away while idle
+                    self._discard(pooled)
+                logger.info(f"No shell on pooled SSH transport to {host}:{port} ({e}), connecting anew.")
+            else:
+                self.hits += 1
+                self.pool_latency.observe(time.monotonic() - started)
+                return pooled, channel
+
+        pooled = await self._connect(key, host, port, username, password)
+        try:
+            channel = await loop.run_in_executor(None, _invoke_shell, pooled.client)
+        except BaseException:
+            self.release(pooled)
+            raise
+        self.misses += 1
+        self.cold_latency.observe(time.monotonic() - started)
+        return pooled, channel
+
+    # Called once the session's channel is closed
+    def release(self, pooled):
+        pooled.channels -= 1
+        if pooled.channels > 0:
+            return
+        if self.idle_timeout > 0 and pooled.active():
+            pooled.idle_timer = asyncio.get_running_loop().call_later(self.idle_timeout, self._expire, pooled)
+        else:
+            self._discard(pooled)
+
+    def _reserve(self, key):
+        for pooled in list(self._transports.get(key, ())):
+            if not pooled.active():
+                self._discard(pooled)
+            elif pooled.channels < pooled.max_channels:
+                pooled.channels += 1
+                if pooled.idle_timer:
+                    pooled.idle_timer.cancel()
+                    pooled.idle_timer = None
+                return pooled
+        return None
+
+    # Another session is already authenticating with these credentials
+    async def _wait_for_handshake(self, key):
+        while key in self._connecting:
+            # Its failure is ours too, same host and credentials
+            await asyncio.shield(self._connecting[key])
+            pooled = self._reserve(key)
+            if pooled is not None:
+                return pooled
+        return None
+
+    async def _connect(self, key, host, port, username, password):
+        loop = asyncio.get_running_loop()
+        handshake = self._connecting[key] = loop.create_future()
+        try:
+            client = await loop.run_in_executor(
+                None, _connect, host, port, username, password, self.connect_timeout,
+            )
+        except BaseException as e:
+            handshake.set_exception(e)
+            # Retrieved here, whether or not anyone was waiting
+            handshake.exception()
+            raise
+        finally:
+            del self._connecting[key]
+        pooled = PooledTransport(key, client, self.max_channels)
+        pooled.channels = 1
+        self._transports.setdefault(key, []).append(pooled)
+        if not handshake.done():
+            handshake.set_result(None)
+        return pooled
+
+    def _expire(self, pooled):
+        pooled.idle_timer = None
+        if pooled.channels == 0:
+            logger.info(f"Closing SSH transport to {pooled.key[0]}:{pooled.key[1]} after {self.idle_timeout}s idle.")
+            self._discard(pooled)
+
+    def _discard(self, pooled):
+        entries = self._transports.get(pooled.key, [])
+        if pooled in entries:
+            entries.remove(pooled)
+            if not entries:
+                del self._transports[pooled.key]
+        if pooled.idle_timer:
+            pooled.idle_timer.cancel()
+            pooled.idle_timer = None
+        # Closing joins paramiko's transport thread
+        asyncio.get_running_loop().run_in_executor(None, pooled.client.close)
+
+    # Also read from request threads, hence the copies
+    def transports(self):
+        return sum(len(entries) for entries in list(self._transports.values()))
+
+    def stats(self):
+        opens = self.hits + self.misses
+        return {
+            'transports': self.transports(),
+            'channels': sum(pooled.channels for entries in list(self._transports.values()) for pooled in list(entries)),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / opens if opens else None,
+            'open_latency': {
+                'pool': self.pool_latency.summary(),
+                'cold': self.cold_latency.summary(),
+            },
+        }
+
+
+def _connect(host, port, username, password, timeout):
+    import paramiko
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(host, port=port, username=username, password=password, timeout=timeout)
+    # Keystrokes are tiny packets; don't hold them back waiting for ACKs
+    client.get_transport().sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client
+
+
+def _invoke_shell(client):
+    return client.invoke_shell(term='xterm-256color')
+
+
+# With SSH_POOL_ENABLED off, every session gets a connection of its own, closed with it
+pool = SSHTransportPool(
+    idle_timeout=backend_settings.get('SSH_POOL_IDLE_TIMEOUT', 300),
+    max_channels=backend_settings.get('SSH_POOL_MAX_CHANNELS', 10),
+    connect_timeout=backend_settings.get('SSH_CONNECT_TIMEOUT', 10),
+) if backend_settings.get('SSH_POOL_ENABLED', True) else SSHTransportPool(
+    idle_timeout=0, max_channels=1, connect_timeout=backend_settings.get('SSH_CONNECT_TIMEOUT', 10),
+)
+
+workers.STATS['ssh_pool'] = pool.stats
+metrics.Gauge('ssh_transports', 'Authenticated SSH connections open, in use or idle in the pool', function=pool.transports)
+metrics.Counter('ssh_pool_hits_total', 'SSH sessions opened on a pooled connection', function=lambda: pool.hits)
+metrics.Counter('ssh_pool_misses_total', 'SSH sessions that needed a new connection', function=lambda: pool.misses)
@@ -0,0 +1,325 @@
+import asyncio
+import codecs
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+# Frames at least this big mean output is arriving faster than it is sent
+BURST_BYTES = 1024
+
+
+# Output stage between the attach socket reader and the WebSocket.
+# Bytes fed in are coalesced into frames of at most max_frame bytes. Output
+# after a quiet spell, and small frames like typing echo or a prompt, are
+# flushed at once; only while a burst is under way (the last frame was
+# big, or more output came in while it was being sent) is the next frame
+# given flush_interval seconds to fill.
+#
+# feed() blocks once high_water bytes are queued, in flight or, with
+# acked=True, sent but not yet acknowledged by the client. Channels'
+# send() returns once the frame is handed to the server, so without
+# acknowledgements a slow client lets output pile up in the server's
+# transport instead of holding back the reader. Acknowledged clients
+# report the total output bytes they have received with ack().
+class OutputCoalescer:
+    def __init__(self, send, max_frame=16384, flush_interval=0.005, high_water=262144, acked=False):
+        self._send = send
+        self.max_frame = max_frame
+        self.flush_interval = flush_interval
+        self.high_water = high_water
+        self.acked = acked
+
+        self._chunks = []
+        self._size = 0
+        self._inflight = 0
+        self._sent = 0
+        self._acknowledged = 0
+        self._last_flush = 0.0
+        self._bursting = False
+        self._data_ready = asyncio.Event()
+        self._frame_full = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def feed(self, data):
+        self.offer(data)
+        if self.backlogged:
+            await self.drained()
+
+    # Queue data without waiting for room
+    def offer(self, data):
+        if self._closed:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        self._data_ready.set()
+        if self._size >= self.max_frame:
+            self._frame_full.set()
+
+    # At or over the high-water mark, where feed() would wait
+    @property
+    def backlogged(self):
+        return self._backlog() >= self.high_water
+
+    async def drained(self):
+        if self.backlogged:
+            self._drained.clear()
+            await self._drained.wait()
+
+    # Queue data ahead of anything fed later, without waiting for room
+    def prime(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+            self._data_ready.set()
+
+    # Total output bytes the client has received, as it reported them
+    def ack(self, received):
+        if not self.acked:
+            return
+        self._acknowledged = min(max(received, self._acknowledged), self._sent)
+        if self._backlog() < self.high_water:
+            self._drained.set()
+
+    # Stop the sender task, flushing whatever is still queued unless told not to
+    async def close(self, flush=True):
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if flush and self._size:
+            await self._flush()
+        self._chunks = []
+        self._size = 0
+        self._drained.set()
+
+    def _backlog(self):
+        unacknowledged = self._sent - self._acknowledged if self.acked else 0
+        return self._size + self._inflight + unacknowledged
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._data_ready.wait()
+            if self._size < self.max_frame and self._bursting and loop.time() - self._last_flush < self.flush_interval:
+                # Mid-burst: give the reader a short window to fill the frame
+                self._frame_full.clear()
+                try:
+                    await asyncio.wait_for(self._frame_full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush()
+
+    async def _flush(self):
+        chunks = self._chunks
+        self._chunks = []
+        self._inflight = self._size
+        self._size = 0
+        self._data_ready.clear()
+        self._frame_full.clear()
+
+        data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        try:
+            if len(data) <= self.max_frame:
+                await self._send(data)
+            else:
+                view = memoryview(data)
+                for start in range(0, len(data), self.max_frame):
+                    await self._send(bytes(view[start:start + self.max_frame]))
+            self._sent += len(data)
+        finally:
+            self._inflight = 0
+            self._last_flush = asyncio.get_running_loop().time()
+            self._bursting = len(data) >= BURST_BYTES or self._size > 0
+            if self._backlog() < self.high_water:
+                self._drained.set()
+
+
+# Input stage between the WebSocket and a session backend. put() queues
+# the bytes and returns; one writer task drains the queue, joining
+# whatever arrived while the previous write was in flight. A backend that
+# keeps up finishes each write before the next frame comes in, so while a
+# paste is under way (the last write was big) the writer also lingers up
+# to linger seconds, or until max_write bytes are queued, for more of it.
+# A paste split over many frames reaches the backend in a few large
+# writes, and a keystroke still goes out at once. put() blocks once
+# max_bytes are queued, which holds up the consumer's receive and with it
+# the client, instead of buffering a runaway paste in memory.
+class InputWriter:
+    def __init__(self, write, max_bytes=262144, max_write=65536, linger=0.002):
+        self._write = write
+        self.max_bytes = max_bytes
+        self.max_write = max_write
+        self.linger = linger
+
+        self._chunks = []
+        self._size = 0
+        self._pasting = False
+        self._data_ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, data):
+        if self._closed:
+            return
+        while self._size >= self.max_bytes:
+            self._room.clear()
+            await self._room.wait()
+            if self._closed:
+                return
+        self._chunks.append(data)
+        self._size += len(data)
+        self._data_ready.set()
+        if self._size >= self.max_write:
+            self._full.set()
+
+    async def close(self):
+        self._closed = True
+        self._room.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._chunks = []
+        self._size = 0
+
+    async def _run(self):
+        while True:
+            await self._data_ready.wait()
+            if self._pasting and self.linger > 0 and self._size < self.max_write:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.linger)
+                except asyncio.TimeoutError:
+                    pass
+            data = self._take()
+            self._pasting = len(data) >= BURST_BYTES
+            try:
+                await self._write(data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The session is gone; drop the input rather than retry it
+                logger.error(f"Session input write failed: {e}")
+                self._closed = True
+                self._chunks = []
+                self._size = 0
+                self._room.set()
+                return
+
+    # Up to max_write queued bytes as one buffer
+    def _take(self):
+        taken, size = 0, 0
+        while taken < len(self._chunks) and (not taken or size + len(self._chunks[taken]) <= self.max_write):
+            size += len(self._chunks[taken])
+            taken += 1
+        chunks, self._chunks = self._chunks[:taken], self._chunks[taken:]
+        self._size -= size
+        if not self._chunks:
+            self._data_ready.clear()
+        if self._size < self.max_write:
+            self._full.clear()
+        if self._size < self.max_bytes:
+            self._room.set()
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+# Preset dictionary for compressed frames: escape sequences and phrases
+# that dominate shell and package-manager output. Deflate reaches matches
+# near the end of the dictionary most cheaply, so the most common go last.
+ZDICT = (
+    b"Reading package lists... Done\r\nBuilding dependency tree... Done\r\n"
+    b"Reading state information... Done\r\nThe following NEW packages will be installed:\r\n"
+    b"The following additional packages will be installed:\r\n"
+    b"0 upgraded, newly installed, to remove and not upgraded.\r\nNeed to get kB of archives.\r\n"
+    b"After this operation, of additional disk space will be used.\r\n"
+    b"debconf: delaying package configuration, since apt-utils is not installed\r\n"
+    b"(Reading database ... files and directories currently installed.)\r\n"
+    b"Processing triggers for Selecting previously unselected package "
+    b"Preparing to unpack .../archives/ Fetched kB in s (kB/s)\r\n"
+    b"Hit: Get: http://deb.debian.org/debian bookworm-updates InRelease [ kB]\r\n"
+    b"http://archive.ubuntu.com/ubuntu noble/main amd64 all .deb "
+    b"total drwxr-xr-x -rw-r--r-- root root "
+    b"error: warning: No such file or directory\r\nPermission denied\r\n"
+    b"\x1b]0;\x07\x1b[?1049h\x1b[?1049l\x1b[?25l\x1b[?25h\x1b[?2004h\x1b[?2004l\r"
+    b"\x1b[H\x1b[2J\x1b[J\x1b[K\x1b[1;34m\x1b[1;32m\x1b[01;34m\x1b[01;32m\x1b[0;31m\x1b[33m\x1b[36m\x1b[1m\x1b[m"
+    b"Setting up Unpacking ) ...\r\n\x1b[0m\x1b[0m\r\n"
+)
+
+# Leading byte of each binary frame when compression is on
+FRAME_RAW = b'\x00'
+FRAME_DEFLATE = b'\x01'
+
+# Every deflate frame ends with a sync flush; like permessage-deflate the
+# empty stored block is left off the wire and the client puts it back
+SYNC_TAIL = b'\x00\x00\xff\xff'
+
+
+# Turns coalesced output into send() arguments for the session's protocol.
+# Binary sessions get the attach-socket bytes as-is; text sessions decode
+# incrementally so a multibyte character split across reads stays intact.
+# Binary sessions may also ask for compression: each frame then starts with
+# FRAME_RAW or FRAME_DEFLATE. Frames below min_compress bytes, typing echo
+# mostly, go raw. The rest share one raw deflate stream per session, primed
+# with ZDICT and sync-flushed per frame, so a frame can refer back to
+# earlier output the way permessage-deflate with context takeover does.
+class FrameEncoder:
+    def __init__(self, binary=False, compress=False, min_compress=256, level=1, dictionary=ZDICT):
+        self.binary = binary
+        self._decoder = None if binary else codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.compressing = binary and compress
+        self.min_compress = min_compress
+        self._compressor = None
+        if self.compressing:
+            if dictionary:
+                self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+            else:
+                self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+
+    def encode(self, data, final=False):
+        if self.binary:
+            if not data:
+                return None
+            if not self.compressing:
+                return {'bytes_data': data}
+            if len(data) < self.min_compress:
+                payload = FRAME_RAW + data
+            else:
+                payload = FRAME_DEFLATE + self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)[:-len(SYNC_TAIL)]
+            self.raw_bytes += len(data)
+            self.sent_bytes += len(payload)
+            return {'bytes_data': payload}
+        text = self._decoder.decode(data, final)
+        return {'text_data': text} if text else None
+
+
+# Accept callback for autobahn's perMessageCompressionAccept. Daphne does
+# not negotiate permessage-deflate itself; a launcher that owns the
+# daphne Server can install this on server.ws_factory once it is built.
+def accept_permessage_deflate(offers):
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            return PerMessageDeflateOfferAccept(offer)
+    return None
@@ -1,3 +1,552 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from docker.models.containers import Container
+
+from . import lifecycle, metrics, recording, registry, sessions
+from .container_index import ContainerIndex
+from .jobs import JobEngine
+from .progress import ProgressReporter
+from .scrollback import RingBuffer, ScrollbackStore
+from .streaming import FRAME_DEFLATE, FRAME_RAW, SYNC_TAIL, ZDICT, FrameEncoder, InputWriter, OutputCoalescer
+
+
+class RingBufferTests(SimpleTestCase):
+    def test_read_from_within_capacity(self):
+        ring = RingBuffer(8)
+        ring.write(b'abcdef')
+        self.assertEqual(ring.read_from(0), (0, b'abcdef'))
+        self.assertEqual(ring.read_from(4), (4, b'ef'))
+        self.assertEqual(ring.read_from(6), (6, b''))
+
+    def test_read_from_clamps_to_what_is_held(self):
+        ring = RingBuffer(8)
+        ring.write(b'abcdef')
+        ring.write(b'ghij')
+        self.assertEqual((ring.start, ring.end), (2, 10))
+        # Overwritten bytes are gone, the read starts at the oldest held
+        self.assertEqual(ring.read_from(0), (2, b'cdefghij'))
+        self.assertEqual(ring.read_from(5), (5, b'fghij'))
+        # An offset past the end replays everything held
+        self.assertEqual(ring.read_from(99), (2, b'cdefghij'))
+
+    def test_write_larger_than_capacity(self):
+        ring = RingBuffer(4)
+        ring.write(b'ab')
+        ring.write(b'cdefghi')
+        self.assertEqual(ring.read_from(0), (5, b'fghi'))
+
+
+class ScrollbackStoreTests(SimpleTestCase):
+    def test_unknown_key(self):
+        store = ScrollbackStore(buffer_bytes=8, memory_budget=64)
+        self.assertEqual(store.read_from('missing', 5), (0, b''))
+        self.assertEqual(store.end('missing'), 0)
+
+    def test_read_from_clamps_per_key(self):
+        store = ScrollbackStore(buffer_bytes=4, memory_budget=64)
+        store.append('a', b'123456')
+        store.append('b', b'xy')
+        self.assertEqual(store.read_from('a', 0), (2, b'3456'))
+        self.assertEqual(store.read_from('b', 1), (1, b'y'))
+        self.assertEqual(store.end('a'), 6)
+
+    def test_least_recently_active_buffer_is_evicted(self):
+        store = ScrollbackStore(buffer_bytes=4, memory_budget=8)
+        store.append('a', b'a')
+        store.append('b', b'b')
+        store.append('a', b'a')
+        store.append('c', b'c')
+        self.assertEqual(store.read_from('b', 0), (0, b''))
+        self.assertEqual(store.read_from('a', 0), (0, b'aa'))
+        self.assertEqual(store.read_from('c', 0), (0, b'c'))
+
+
+class FrameEncoderTests(SimpleTestCase):
+    def test_binary_passes_bytes_through(self):
+        encoder = FrameEncoder(binary=True)
+        self.assertEqual(encoder.encode(b'\x1b[1mhi'), {'bytes_data': b'\x1b[1mhi'})
+        self.assertIsNone(encoder.encode(b''))
+
+    def test_text_keeps_split_characters_whole(self):
+        encoder = FrameEncoder()
+        data = 'größe €'.encode()
+        self.assertEqual(encoder.encode(data[:3]), {'text_data': 'gr'})
+        self.assertEqual(encoder.encode(data[3:-2]), {'text_data': 'öße '})
+        self.assertEqual(encoder.encode(data[-2:]), {'text_data': '€'})
+
+    def test_compressed_frames_round_trip(self):
+        encoder = FrameEncoder(binary=True, compress=True, min_compress=16)
+        decompressor = zlib.decompressobj(-15, zdict=ZDICT)
+        chunks = [b'$ ', b'Reading package lists... Done\r\n' * 20, b'ok\r\n', os.urandom(300)]
+        flags = []
+        for chunk in chunks:
+            payload = encoder.encode(chunk)['bytes_data']
+            flags.append(payload[:1])
+            if payload[:1] == FRAME_DEFLATE:
+                self.assertEqual(decompressor.decompress(payload[1:] + SYNC_TAIL), chunk)
+            else:
+                self.assertEqual(payload[1:], chunk)
+        self.assertEqual(flags, [FRAME_RAW, FRAME_DEFLATE, FRAME_RAW, FRAME_DEFLATE])
+        self.assertEqual(encoder.raw_bytes, sum(len(chunk) for chunk in chunks))
+        self.assertLess(encoder.sent_bytes, encoder.raw_bytes)
+
+    def test_compression_needs_binary(self):
+        encoder = FrameEncoder(binary=False, compress=True)
+        self.assertFalse(encoder.compressing)
+        self.assertEqual(encoder.encode(b'hi'), {'text_data': 'hi'})
+
+
+class OutputCoalescerTests(SimpleTestCase):
+    async def test_output_arrives_in_order_in_bounded_frames(self):
+        frames = []
+
+        async def send(data):
+            frames.append(data)
+
+        coalescer = OutputCoalescer(send, max_frame=64, flush_interval=0.001)
+        coalescer.start()
+        data = [bytes([65 + n % 26]) * (n * 7 % 50 + 1) for n in range(200)]
+        for chunk in data:
+            await coalescer.feed(chunk)
+        await coalescer.close()
+        self.assertEqual(b''.join(frames), b''.join(data))
+        self.assertTrue(all(len(frame) <= 64 for frame in frames))
+
+    async def test_acked_client_holds_back_the_feeder(self):
+        async def send(data):
+            pass
+
+        coalescer = OutputCoalescer(send, max_frame=16, high_water=32, acked=True)
+        coalescer.start()
+        await coalescer.feed(b'x' * 16)
+        await asyncio.sleep(0.01)
+        feeding = asyncio.create_task(coalescer.feed(b'y' * 16))
+        await asyncio.sleep(0.01)
+        self.assertTrue(coalescer.backlogged)
+        self.assertFalse(feeding.done())
+        coalescer.ack(32)
+        await asyncio.wait_for(feeding, 1)
+        await coalescer.close()
+
+    async def test_offer_never_waits(self):
+        async def send(data):
+            pass
+
+        coalescer = OutputCoalescer(send, high_water=8, acked=True)
+        coalescer.offer(b'x' * 32)
+        self.assertTrue(coalescer.backlogged)
+        await coalescer.close(flush=False)
+        coalescer.offer(b'dropped')
+        self.assertFalse(coalescer.backlogged)
+
+
+class InputWriterTests(SimpleTestCase):
+    async def test_input_is_written_in_order(self):
+        written = []
+
+        async def write(data):
+            written.append(data)
+            await asyncio.sleep(0)
+
+        writer = InputWriter(write, max_bytes=64, max_write=16, linger=0.001)
+        writer.start()
+        data = [f"key {n}\r".encode() for n in range(100)]
+        for chunk in data:
+            await writer.put(chunk)
+        while writer._size:
+            await asyncio.sleep(0.001)
+        await writer.close()
+        self.assertEqual(b''.join(written), b''.join(data))
+        self.assertTrue(all(len(chunk) <= 16 for chunk in written))
+
+    async def test_failed_write_drops_input(self):
+        async def write(data):
+            raise OSError("socket closed")
+
+        writer = InputWriter(write)
+        writer.start()
+        await writer.put(b'ls\r')
+        await asyncio.sleep(0.01)
+        await writer.put(b'pwd\r')
+        self.assertEqual(writer._size, 0)
+        await writer.close()
+
+
+class JobEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.ran = []
+        self.lock = threading.Lock()
+
+    def blocking(self, name):
+        async def fn(job):
+            with self.lock:
+                self.ran.append(name)
+            await asyncio.get_running_loop().run_in_executor(None, self.release.wait, 5)
+        return fn
+
+    def recording(self, name):
+        async def fn(job):
+            with self.lock:
+                self.ran.append(name)
+        return fn
+
+    def wait_idle(self, engine):
+        deadline = time.monotonic() + 5
+        while not engine.idle():
+            self.assertLess(time.monotonic(), deadline, "jobs did not finish")
+            time.sleep(0.005)
+
+    def wait_running(self, engine, count):
+        deadline = time.monotonic() + 5
+        while sum(engine.stats()['running'].values()) < count:
+            self.assertLess(time.monotonic(), deadline, "jobs did not start")
+            time.sleep(0.005)
+
+    def test_lower_priority_value_runs_first(self):
+        engine = JobEngine(workers=1)
+        engine.submit('exec', self.blocking('busy'))
+        self.wait_running(engine, 1)
+        engine.submit('cache', self.recording('cache'))
+        engine.submit('provision', self.recording('provision'))
+        engine.submit('exec', self.recording('exec'))
+        engine.submit('stop', self.recording('stop'))
+        engine.submit('provision', self.recording('urgent'), priority=-1)
+        self.release.set()
+        self.wait_idle(engine)
+        self.assertEqual(self.ran, ['busy', 'urgent', 'stop', 'exec', 'provision', 'cache'])
+
+    def test_per_kind_limit_leaves_workers_for_other_kinds(self):
+        engine = JobEngine(workers=3, limits={'exec': 1})
+        engine.submit('exec', self.blocking('exec 1'))
+        engine.submit('exec', self.blocking('exec 2'))
+        engine.submit('stop', self.blocking('stop'))
+        self.wait_running(engine, 2)
+        time.sleep(0.05)
+        self.assertEqual(engine.stats()['running'], {'exec': 1, 'stop': 1})
+        self.assertEqual(engine.stats()['queued'], 1)
+        self.release.set()
+        self.wait_idle(engine)
+        self.assertEqual(sorted(self.ran), ['exec 1', 'exec 2', 'stop'])
+
+    def test_cancelled_queued_job_never_runs(self):
+        engine = JobEngine(workers=1)
+        engine.submit('exec', self.blocking('busy'))
+        self.wait_running(engine, 1)
+        job = engine.submit('exec', self.recording('cancelled'))
+        self.assertIs(engine.cancel(job.id), job)
+        self.assertEqual(job.status, 'cancelled')
+        self.assertEqual(engine.stats()['queued'], 0)
+        self.release.set()
+        self.wait_idle(engine)
+        self.assertEqual(self.ran, ['busy'])
+        self.assertIsNone(engine.cancel(job.id))
+
+    def test_running_job_sees_cancel(self):
+        engine = JobEngine(workers=1)
+        started = threading.Event()
+
+        async def fn(job):
+            started.set()
+            while not job.cancelled:
+                await asyncio.sleep(0.005)
+
+        job = engine.submit('exec', fn, container_id='c1')
+        self.assertTrue(started.wait(5))
+        with mock.patch('terminal_app.jobs.publish_cancelled', new=mock.AsyncMock()) as publish:
+            self.assertEqual(engine.cancel_container('c1', kinds=('exec',)), [job])
+            self.wait_idle(engine)
+            deadline = time.monotonic() + 5
+            while not publish.await_count:
+                self.assertLess(time.monotonic(), deadline, "cancellation was not published")
+                time.sleep(0.005)
+        self.assertEqual(job.status, 'cancelled')
+        publish.assert_awaited_with(job)
+
+
+class ProgressReporterTests(SimpleTestCase):
+    def sent(self, publish):
+        return [call.args[1]['payload'] for call in publish.await_args_list]
+
+    async def test_split_character_and_quiet_tail(self):
+        with mock.patch('terminal_app.job_status.publish', new=mock.AsyncMock()) as publish:
+            progress = ProgressReporter('c1', 'job1')
+            progress.min_gap = 0.02
+            line = 'Unpacking café ...\r\n'.encode()
+            split = line.index('é'.encode()) + 1
+            await progress.feed(line[:split])
+            await progress.feed(line[split:])
+            # Rate-capped, then sent by the timer although no more output comes
+            await progress.feed(b'Setting up\r\n')
+            self.assertEqual([payload['lines'] for payload in self.sent(publish)], ['Unpacking café ...'])
+            await asyncio.sleep(0.1)
+            self.assertEqual([payload['lines'] for payload in self.sent(publish)], ['Unpacking café ...', 'Setting up'])
+            self.assertEqual([payload['seq'] for payload in self.sent(publish)], [0, 1])
+
+    async def test_phase_sends_the_unfinished_line(self):
+        with mock.patch('terminal_app.job_status.publish', new=mock.AsyncMock()) as publish:
+            progress = ProgressReporter('c1', 'job1')
+            await progress.feed(b'50%\r60%')
+            await progress.phase('done')
+            payloads = self.sent(publish)
+            self.assertEqual([(payload['phase'], payload['lines']) for payload in payloads], [(None, '50%'), (None, '60%'), ('done', '')])
+
+
+class LifecycleManagerTests(SimpleTestCase):
+    async def test_running_container_is_checked_once_per_ttl(self):
+        manager = lifecycle.LifecycleManager()
+        with mock.patch('terminal_app.lifecycle.get_index', return_value=None), \
+                mock.patch.object(lifecycle.cache, 'aget', new=mock.AsyncMock(return_value=None)) as aget:
+            for _ in range(20):
+                await manager.ensure_running('c1')
+            self.assertEqual(aget.await_count, 1)
+            manager._running_until['c1'] = time.monotonic() - 1
+            await manager.ensure_running('c1')
+            self.assertEqual(aget.await_count, 2)
+
+    async def test_paused_container_is_resumed(self):
+        manager = lifecycle.LifecycleManager()
+        manager._running_until['c1'] = time.monotonic() - 1
+        client = mock.Mock()
+        with mock.patch('terminal_app.lifecycle.get_index', return_value=None), \
+                mock.patch.object(lifecycle.cache, 'aget', new=mock.AsyncMock(return_value=True)), \
+                mock.patch.object(lifecycle.cache, 'adelete', new=mock.AsyncMock()) as adelete, \
+                mock.patch('terminal_app.docker_control.get_client', return_value=client):
+            await manager.ensure_running('c1')
+            await manager.ensure_running('c1')
+        client.api.unpause.assert_called_once_with('c1')
+        adelete.assert_awaited_once_with(lifecycle.paused_key('c1'))
+        self.assertEqual(manager.resumed_total, 1)
+
+
+class RelayTests(SimpleTestCase):
+    async def test_relay_queue_is_bounded_but_keeps_the_end(self):
+        with mock.patch.object(registry, 'RELAY_QUEUE', 2):
+            relay = registry.RoutedBackend('c1', inner=None)
+        for chunk in (b'one', b'two', b'three'):
+            await relay.handle({'type': 'terminal.output', 'key': 'c1', 'data': chunk})
+        await relay.handle({'type': 'terminal.ended', 'key': 'c1'})
+        self.assertEqual([await relay.read(), await relay.read()], [b'two', b''])
+        self.assertEqual(relay._dropped, len(b'three') + len(b'one'))
+
+    def test_relay_never_holds_the_read_loop(self):
+        relay = registry.RoutedBackend('c1', inner=None)
+        self.assertTrue(relay.relaying)
+        relay.owning = True
+        self.assertFalse(relay.relaying)
+
+
+class ContainerIndexTests(SimpleTestCase):
+    def event(self, action, container_id, **attributes):
+        return {'Action': action, 'Actor': {'ID': container_id, 'Attributes': attributes}}
+
+    def test_events_track_status_and_name(self):
+        index = ContainerIndex(client=None)
+        index._apply(self.event('create', 'abc123', name='terminal-1', image='ubuntu'))
+        self.assertEqual(index.get('abc123'), {'id': 'abc123', 'name': 'terminal-1', 'status': 'created', 'image': 'ubuntu'})
+        self.assertIsNone(index.find_running('terminal-1'))
+
+        index._apply(self.event('start', 'abc123', name='terminal-1', image='ubuntu'))
+        self.assertEqual(index.find_running('terminal-1')['id'], 'abc123')
+
+        index._apply(self.event('pause', 'abc123', name='terminal-1'))
+        self.assertEqual(index.with_status('paused'), {'abc123': 'paused'})
+        self.assertIsNone(index.find_running('terminal-1'))
+
+        index._apply(self.event('unpause', 'abc123', name='terminal-1'))
+        index._apply(self.event('rename', 'abc123', name='terminal-2'))
+        self.assertIsNone(index.find_running('terminal-1'))
+        self.assertEqual(index.find_running('terminal-2')['status'], 'running')
+        self.assertEqual(index.get('abc')['name'], 'terminal-2')
+
+        index._apply(self.event('destroy', 'abc123', name='terminal-2'))
+        self.assertIsNone(index.get('abc123'))
+        self.assertIsNone(index.find_running('terminal-2'))
+
+    def test_seed_reads_the_sparse_list_payload(self):
+        client = mock.Mock()
+        client.containers.list.return_value = [
+            Container(attrs={'Id': 'abc123', 'Names': ['/terminal-1'], 'State': 'running', 'Image': 'ubuntu:latest'}),
+            Container(attrs={'Id': 'def456', 'Names': ['/terminal-2'], 'State': 'paused', 'Image': 'alpine:latest'}),
+        ]
+        index = ContainerIndex(client)
+        index._seed()
+        client.containers.list.assert_called_once_with(all=True, sparse=True)
+        self.assertEqual(index.find_running('terminal-1'), {'id': 'abc123', 'name': 'terminal-1', 'status': 'running', 'image': 'ubuntu:latest'})
+        self.assertEqual(index.with_status('paused'), {'def456': 'paused'})
+
+    def test_unrelated_actions_are_ignored(self):
+        index = ContainerIndex(client=None)
+        index._apply(self.event('exec_start: ls', 'abc123', name='terminal-1'))
+        index._apply(self.event('attach', 'abc123', name='terminal-1'))
+        self.assertIsNone(index.get('abc123'))
+        index._apply(self.event('die', 'abc123', name='terminal-1'))
+        self.assertEqual(index.with_status('exited'), {'abc123': 'exited'})
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render_counter_gauge_and_labels(self):
+        counter = metrics.Counter('terminal_test_total', 'Test counter', register=False)
+        counter.inc()
+        counter.inc(2)
+        gauge = metrics.Gauge('terminal_test_sessions', 'Test gauge', ['kind'], register=False)
+        gauge.labels('shared').set(3)
+        gauge.labels('a "quoted"\nkind').dec()
+        lines = []
+        counter.render(lines)
+        gauge.render(lines)
+        self.assertEqual(lines, [
+            '# HELP terminal_test_total Test counter',
+            '# TYPE terminal_test_total counter',
+            'terminal_test_total 3',
+            '# HELP terminal_test_sessions Test gauge',
+            '# TYPE terminal_test_sessions gauge',
+            'terminal_test_sessions{kind="shared"} 3',
+            'terminal_test_sessions{kind="a \\"quoted\\"\\nkind"} -1',
+        ])
+
+    def test_render_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('terminal_test_seconds', 'Test histogram', buckets=(0.1, 1), register=False)
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        lines = []
+        histogram.collect(lines)
+        self.assertEqual(lines, [
+            'terminal_test_seconds_bucket{le="0.1"} 2',
+            'terminal_test_seconds_bucket{le="1"} 3',
+            'terminal_test_seconds_bucket{le="+Inf"} 4',
+            'terminal_test_seconds_sum 3.65',
+            'terminal_test_seconds_count 4',
+        ])
+
+    def test_function_metric_is_read_at_scrape_time(self):
+        sizes = {('ubuntu',): 2}
+        gauge = metrics.Gauge('terminal_test_pool', 'Test pool', ['image'], function=lambda: sizes, register=False)
+        sizes[('alpine',)] = 0.5
+        lines = []
+        gauge.collect(lines)
+        self.assertEqual(lines, ['terminal_test_pool{image="ubuntu"} 2', 'terminal_test_pool{image="alpine"} 0.5'])
+
+    def test_render_families_labels_each_worker(self):
+        families = {
+            '1': [['terminal_test_total', 'Test counter', 'counter', ['terminal_test_total 3']]],
+            '0': [['terminal_test_total', 'Test counter', 'counter', ['terminal_test_total{kind="x"} 1']]],
+        }
+        self.assertEqual(metrics.render_families(families), '\n'.join([
+            '# HELP terminal_test_total Test counter',
+            '# TYPE terminal_test_total counter',
+            'terminal_test_total{worker="0",kind="x"} 1',
+            'terminal_test_total{worker="1"} 3',
+            '',
+        ]))
+
+
+class RecordingTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def finish(self, recorder):
+        recorder.close()
+        deadline = time.monotonic() + 5
+        while recorder._file is None or not recorder._file.closed:
+            self.assertLess(time.monotonic(), deadline, "recording was not written")
+            time.sleep(0.005)
+
+    async def record(self, events):
+        with mock.patch.object(recording, 'ENABLED', True), mock.patch.object(recording, 'DIRECTORY', self.directory), \
+                mock.patch.object(recording, 'BLOCK_BYTES', 64):
+            recorder = recording.start('user 1/ubuntu', rows=30, cols=100)
+        for kind, data in events:
+            if kind == 'r':
+                recorder.resize(*data)
+            elif kind == 'i':
+                recorder.input(data)
+            else:
+                recorder.output(data)
+            await asyncio.sleep(0.002)
+        await asyncio.get_running_loop().run_in_executor(None, self.finish, recorder)
+        return recorder.path
+
+    def test_disabled_by_default(self):
+        with mock.patch.object(recording, 'ENABLED', False):
+            self.assertIsNone(recording.start('user1'))
+
+    async def test_write_and_read_back(self):
+        events = [('o', b'$ '), ('i', b'ls\r'), ('o', b'file\r\n' * 20), ('r', (40, 120)), ('o', 'é'.encode())]
+        path = await self.record(events)
+        self.assertTrue(os.path.basename(path).startswith('user_1_ubuntu-'))
+        played = recording.Recording(path)
+        self.addCleanup(played.close)
+        self.assertEqual(played.header['key'], 'user 1/ubuntu')
+        self.assertEqual((played.header['width'], played.header['height']), (100, 30))
+        read = [(kind, data) for _, kind, data in played.events()]
+        self.assertEqual(read, [
+            (recording.OUTPUT, b'$ '), (recording.INPUT, b'ls\r'), (recording.OUTPUT, b'file\r\n' * 20),
+            (recording.RESIZE, b'120x40'), (recording.OUTPUT, 'é'.encode()),
+        ])
+        times = [elapsed for elapsed, _, _ in played.events()]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(played.duration, times[-1])
+        self.assertEqual(played.size_at(0), (100, 30))
+        self.assertEqual(played.size_at(played.duration), (120, 40))
+
+    async def test_session_records_the_viewers_size(self):
+        class Backend:
+            shared = False
+
+            async def open(self):
+                pass
+
+            async def read(self):
+                await asyncio.Event().wait()
+
+            async def resize(self, rows, cols):
+                pass
+
+            async def close(self):
+                pass
+
+        class Viewer:
+            rows, cols = 50, 160
+
+        viewer = Viewer()
+        with mock.patch.object(recording, 'ENABLED', True), mock.patch.object(recording, 'DIRECTORY', self.directory):
+            shared = await sessions.subscribe('local:test', viewer, Backend)
+        recorder = shared.recorder
+        await shared.resize(40, 120)
+        await sessions.unsubscribe(shared, viewer)
+        await asyncio.get_running_loop().run_in_executor(None, self.finish, recorder)
+
+        played = recording.Recording(recorder.path)
+        self.addCleanup(played.close)
+        self.assertEqual(played.size_at(0), (160, 50))
+        self.assertEqual(played.size_at(played.duration), (120, 40))
+
+    async def test_export_asciicast(self):
+        euro = '€'.encode()
+        path = await self.record([('o', b'hello '), ('o', euro[:1]), ('o', euro[1:]), ('r', (50, 132)), ('o', b'!')])
+        played = recording.Recording(path)
+        self.addCleanup(played.close)
+        out = io.StringIO()
+        recording.export_asciicast(played, out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(lines[0]['version'], 2)
+        self.assertEqual((lines[0]['width'], lines[0]['height']), (100, 30))
+        self.assertEqual([(kind, text) for _, kind, text in lines[1:]], [('o', 'hello '), ('o', '€'), ('r', '132x50'), ('o', '!')])
+
+        resized = [elapsed for elapsed, kind, _ in played.events() if kind == recording.RESIZE][0]
+        out = io.StringIO()
+        recording.export_asciicast(played, out, start=resized)
+        header = json.loads(out.getvalue().splitlines()[0])
+        self.assertEqual((header['width'], header['height']), (132, 50))
@@ -1,9 +1,15 @@
 from django.urls import path
-from .views import hello_world, create_instance, stop_instance
+from .views import hello_world, create_instance, stop_instance, cancel_job, pool_stats, lifecycle_stats, ssh_pool_stats, prometheus_metrics, session_owner
 from . import consumers
 
 urlpatterns = [
     path('hello/', hello_world),
+    path('metrics/', prometheus_metrics, name='metrics'),
     path('create-instance/', create_instance, name='create_instance'),
     path('shutdown-instance/', stop_instance, name='stop_instance'),
+    path('cancel-job/', cancel_job, name='cancel_job'),
+    path('pool-stats/', pool_stats, name='pool_stats'),
+    path('lifecycle-stats/', lifecycle_stats, name='lifecycle_stats'),
+    path('ssh-pool-stats/', ssh_pool_stats, name='ssh_pool_stats'),
+    path('session-owner/<str:container_id>/', session_owner, name='session_owner'),
 ]
\ No newline at end of file
@@ -1,41 +1,225 @@
-import asyncio
-import threading
-from asgiref.sync import async_to_sync
-from django.http import JsonResponse
+import functools
+import logging
+import time
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-import docker
-from channels.layers import get_channel_layer
+from . import docker_control, jobs, lifecycle, metrics, package_cache, registry, workers
+from .container_index import get_index
+from .image_cache import BUILDER_LABEL, ImageCache
+from .job_status import publish
+from .pool import ContainerPool
+from .progress import ProgressReporter
 
-# Initialize Docker client globally
-client = docker.from_env()
+logger = logging.getLogger(__name__)
+
+# Docker client shared with the consumers, request-path calls go through docker_control.run_sync
+client = docker_control.get_client()
+
+# Docker images offered for each selectable system
+IMAGE_MAP = {
+    1: 'debian:latest',
+    2: 'ubuntu:latest',
+    3: 'alpine:latest',
+}
+
+# Warm pool of pre-started containers, started with the ASGI application
+pool_settings = getattr(settings, 'CONTAINER_POOL', {})
+container_pool = ContainerPool(
+    client,
+    set(IMAGE_MAP.values()),
+    min_size=pool_settings.get('MIN_SIZE', 1),
+    max_size=pool_settings.get('MAX_SIZE', 3),
+    idle_timeout=pool_settings.get('IDLE_TIMEOUT', 600),
+    refill_interval=pool_settings.get('REFILL_INTERVAL', 5),
+    volumes={image: package_cache.volumes_for(system) for system, image in IMAGE_MAP.items()},
+) if pool_settings.get('ENABLED', False) else None
+
+# Provisioned images keyed by (system, package set)
+image_cache_settings = getattr(settings, 'IMAGE_CACHE', {})
+image_cache = ImageCache(
+    client,
+    disk_budget=image_cache_settings.get('DISK_BUDGET', 10 * 1024 ** 3),
+) if image_cache_settings.get('ENABLED', False) else None
+
+CONTAINER_CREATE = metrics.Histogram('container_create_seconds', 'Time to hand out a container, warm from the pool or cold', labelnames=('source',))
+CREATE_FROM_POOL, CREATE_COLD = CONTAINER_CREATE.labels('pool'), CONTAINER_CREATE.labels('cold')
+CONTAINER_STOP = metrics.Histogram('container_stop_seconds', 'Time for a stop job to stop its container')
+
+if container_pool:
+    workers.STATS['pool'] = container_pool.stats
+    metrics.Counter('container_pool_hits_total', 'Creates served from the warm pool', function=lambda: container_pool.hits)
+    metrics.Counter('container_pool_misses_total', 'Creates that found the warm pool empty', function=lambda: container_pool.misses)
+    metrics.Gauge(
+        'container_pool_idle', 'Warm containers waiting per image', labelnames=('image',),
+        function=lambda: {(image,): count for image, count in container_pool.stats()['idle'].items()},
+    )
 
 # General utility function to send JSON response
 def hello_world(request):
     return JsonResponse({'message': 'Hello, world!'})
 
-# Utility function to run tasks in the background using threads
-def run_in_background(container, command=None, callback=None, job=None):
-    asyncio.run(execute_and_callback(container, command, callback, job))
+# Pool hit rate and create latency with and without the warm pool, hits
+# and misses totalled over the runworkers workers
+def pool_stats(request):
+    if container_pool is None:
+        return JsonResponse({'enabled': False})
+    stats = workers.combined('pool', totals=('hits', 'misses'))
+    requests = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / requests if requests else None
+    return JsonResponse({'enabled': True, **stats})
 
-# Asynchronous function to execute Docker commands and handle completion callbacks
-async def execute_and_callback(container, command, callback, job):
-    if job == "exec" and command:
-        await _run_command(container, command)
-    elif job == "stop":
-        container.stop()
+# Prometheus scrape endpoint. Under runworkers it serves every worker's
+# metrics, labelled with the worker, whichever worker takes the scrape.
+def prometheus_metrics(request):
+    if workers.GROUP:
+        body = metrics.render_families({worker_id: report['metrics'] for worker_id, report in workers.reports().items()})
+    else:
+        body = metrics.render()
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Node holding the attach stream of a container, so clients or a load
+# balancer can connect there rather than be relayed
+async def session_owner(request, container_id):
+    if not registry.ENABLED:
+        return JsonResponse({'enabled': False})
+    current = await registry.owner(container_id)
+    return JsonResponse({'enabled': True, 'containerId': container_id, 'node': current['node'] if current else None})
+
+# Idle pause/resume thresholds and counts from the process running the
+# checks, resumes totalled over the runworkers workers
+def lifecycle_stats(request):
+    if lifecycle.manager is None:
+        return JsonResponse({'enabled': False})
+    return JsonResponse({'enabled': True, **workers.combined('lifecycle', totals=('tracked', 'resumed_total'))})
+
+# SSH connection reuse and session-open latency, cold and pooled, totalled over the runworkers workers
+def ssh_pool_stats(request):
+    stats = workers.combined('ssh_pool', totals=('transports', 'channels', 'hits', 'misses'))
+    opens = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / opens if opens else None
+    return JsonResponse(stats)
+
+# Container a job was submitted for, without a daemon round trip
+def _job_container(job):
+    return client.containers.prepare_model({'Id': job.container_id})
+
+# Asynchronous function to execute Docker commands and notify job-status subscribers, run as an engine job
+@jobs.task
+async def execute_and_callback(job, command, job_name):
+    container = _job_container(job)
+    if job_name == "exec" and command:
+        await _run_command(container, command, job)
+    elif job_name == "stop":
+        started = time.monotonic()
+        await docker_control.run(container.stop)
+        CONTAINER_STOP.observe(time.monotonic() - started)
     else:
         print("No valid job to run")
 
-    if callback:
-        await callback(container, job)
+    if not job.cancelled:
+        await update_status_on_completion(container, job_name)
+
+# Provisioning sequence for a new container: preconfigure, update, install, cache the result, notify.
+# Output and phase changes are streamed to job-status subscribers as it goes.
+@jobs.task
+async def provision_container(job, system, packages, image_name):
+    container = _job_container(job)
+    install_command = _get_install_command(system, packages)
+    if not install_command:
+        await update_status_on_completion(container, "run")
+        return
+
+    progress = ProgressReporter(container.id, job.id)
+    steps = [
+        ("preconfigure", _get_preconfigure_command(system)),
+        ("preconfigure", package_cache.setup_command(system)),
+        ("update", _get_update_command(system)),
+        ("install", install_command),
+    ]
+    exit_code = 0
+    for phase, command in steps:
+        if not command:
+            continue
+        if phase != progress.phase_name:
+            await progress.phase(phase)
+        exit_code = await _run_command(container, command, job, progress)
+        if job.cancelled:
+            await progress.phase("cancelled")
+            return
+        if phase != "preconfigure" and exit_code != 0:
+            break
+
+    # Trim the shared package cache back under its size cap
+    evict_command = package_cache.evict_command(system)
+    if exit_code == 0 and evict_command:
+        await _run_command(container, evict_command)
+
+    # The package set installs cleanly, build its cached image apart from this container
+    if exit_code == 0 and image_cache and packages and await docker_control.run(image_cache.begin_build, system, packages):
+        jobs.engine.submit(
+            "cache",
+            functools.partial(build_cached_image, system=system, packages=packages, image_name=image_name),
+        )
+
+    await progress.phase("done" if exit_code == 0 else "failed")
+    await update_status_on_completion(container, "exec")
+
+# Install the package set in a builder container no session ever attaches
+# to, and commit that as the cached image for the combination
+@jobs.task
+async def build_cached_image(job, system, packages, image_name):
+    builder = None
+    try:
+        builder = _create_container(image_name, system, labels={BUILDER_LABEL: image_name})
+        steps = [
+            (_get_preconfigure_command(system), False),
+            (package_cache.setup_command(system), False),
+            (_get_update_command(system), True),
+            (_get_install_command(system, packages), True),
+        ]
+        for command, required in steps:
+            if not command:
+                continue
+            exit_code = await _run_command(builder, command, job)
+            if job.cancelled:
+                return
+            if required and exit_code != 0:
+                logger.warning(f"Not caching {system}/{packages}: {command} exited with {exit_code}")
+                return
+        await docker_control.run(image_cache.store, system, packages, image_name, builder)
+    except Exception as e:
+        logger.error(f"Error caching provisioned image: {e}")
+    finally:
+        image_cache.end_build(system, packages)
+        if builder is not None:
+            try:
+                await docker_control.run(builder.remove, force=True)
+            except Exception as e:
+                logger.error(f"Error removing image builder {builder.id[:12]}: {e}")
 
-# Utility function to run a command inside a Docker container
-async def _run_command(container, command):
-    result = container.exec_run(command, tty=True, stream=True, environment={"DEBIAN_FRONTEND": "noninteractive"})
-    for line in result.output:
-        print(line.decode().strip())
+# Utility function to run a command inside a Docker container, stops streaming once the job is cancelled.
+# Every daemon call goes through docker_control, reads of the output stream on its stream pool.
+async def _run_command(container, command, job=None, progress=None):
+    exec_id = (await docker_control.run(
+        client.api.exec_create, container.id, command, tty=True, environment={"DEBIAN_FRONTEND": "noninteractive"},
+    ))['Id']
+    output = await docker_control.run(client.api.exec_start, exec_id, tty=True, stream=True)
+    while True:
+        chunk = await docker_control.stream(next, output, None)
+        if chunk is None:
+            break
+        if progress:
+            await progress.feed(chunk)
+        else:
+            print(chunk.decode().strip())
+        if job and job.cancelled:
+            # Stop reading; the command itself runs on in the container
+            await docker_control.run(output.close)
+            return None
+    return (await docker_control.run(client.api.exec_inspect, exec_id))['ExitCode']
 
 async def update_status_on_completion(container, job = None):
     # This function is called when the job is done
@@ -43,7 +227,6 @@ async def update_status_on_completion(container, job = None):
 
 # Asynchronous function to notify the client about the completion of a job
 async def notify_client_on_completion(container_id, job):
-    channel_layer = get_channel_layer()
     job_status_messages = {
         "exec": f"Command execution on container {container_id} completed.",
         "stop": f"Container {container_id} stopped successfully."
@@ -52,8 +235,8 @@ async def notify_client_on_completion(container_id, job):
     
     print(job_status)
     
-    await channel_layer.group_send(
-        'status_job_status',
+    await publish(
+        container_id,
         {
             'type': 'job_status_update',
             'containerId': container_id,
@@ -68,47 +251,91 @@ def create_docker_container(system, packages):
         return Response({'error': 'System and packages must be selected.'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        running_containers = client.containers.list(filters={"name": f"instance_{system}", "status": "running"})
-        if running_containers:
-            return Response({'containerId': running_containers[0].id}, status=status.HTTP_200_OK)
+        index = get_index()
+        if index and index.ready:
+            running = index.find_running(f"instance_{system}")
+            if running:
+                return Response({'containerId': running['id']}, status=status.HTTP_200_OK)
+        else:
+            running_containers = docker_control.run_sync(client.containers.list, filters={"name": f"instance_{system}", "status": "running"})
+            if running_containers:
+                return Response({'containerId': running_containers[0].id}, status=status.HTTP_200_OK)
 
         image_name = _get_image_name(system)
-        container = _create_container(image_name)
-
-        if not packages:
-            threading.Thread(target=run_in_background, args=(container, None, update_status_on_completion, "run")).start()
-            return Response({'containerId': container.id}, status=status.HTTP_201_CREATED)
 
-        install_command = _get_install_command(system, packages, container)
-        if install_command:
-            threading.Thread(target=run_in_background, args=(container, install_command, update_status_on_completion, "exec")).start()
+        # Start straight from a previously provisioned image for this package set
+        # lookup lists, inspects and may remove images, so it runs on the control pool
+        cached_image = docker_control.run_sync(image_cache.lookup, system, packages, image_name) if image_cache and packages else None
+        container = _acquire_container(cached_image or image_name, system)
 
-        return Response({'containerId': container.id}, status=status.HTTP_201_CREATED)
+        # Everything after handing out the container runs on the job engine
+        if cached_image:
+            job = jobs.submit("provision", "notify_job", container.id, job_name="run")
+        else:
+            job = jobs.submit(
+                "provision", "provision_container", container.id,
+                system=system, packages=packages or [], image_name=image_name,
+            )
+        return Response({'containerId': container.id, 'jobId': job.id}, status=status.HTTP_201_CREATED)
 
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@jobs.task
+async def notify_job(job, job_name):
+    await update_status_on_completion(_job_container(job), job_name)
+
 # Helper function to get the appropriate Docker image based on the system
 def _get_image_name(system):
-    image_map = {
-        1: 'debian:latest',
-        2: 'ubuntu:latest',
-        3: 'alpine:latest',
-    }
-    return image_map.get(system, 'debian:latest')
+    return IMAGE_MAP.get(system, 'debian:latest')
+
+# Helper function to take a warm container from the pool, falling back to a cold start
+def _acquire_container(image_name, system):
+    started = time.monotonic()
+    container = container_pool.acquire(image_name) if container_pool else None
+    from_pool = container is not None
+    if not from_pool:
+        container = _create_container(image_name, system)
+    elapsed = time.monotonic() - started
+    (CREATE_FROM_POOL if from_pool else CREATE_COLD).observe(elapsed)
+    if container_pool:
+        container_pool.record_create(elapsed, from_pool)
+    return container
 
-# Helper function to create a Docker container
-def _create_container(image_name):
-    return client.containers.run(
+# Helper function to create a Docker container, with the system's shared package cache mounted
+def _create_container(image_name, system, labels=None):
+    return docker_control.run_sync(
+        client.containers.run,
         image=image_name,
         entrypoint="/bin/sh",
         detach=True,
         stdin_open=True,
-        tty=True
+        tty=True,
+        volumes=package_cache.volumes_for(system) or None,
+        labels=labels,
     )
 
+# Helper function to generate the debconf answers needed before installing on Debian and Ubuntu
+def _get_preconfigure_command(system):
+    if system in [1, 2]:
+        return (
+            '/bin/bash -c "'
+            "echo 'tzdata tzdata/Areas select Africa' | debconf-set-selections && "
+            "echo 'tzdata tzdata/Zones/Africa select Asmara' | debconf-set-selections"
+            '"'
+        )
+    return None
+
+# Helper function to generate the package index refresh for the system
+def _get_update_command(system):
+    if package_cache.uses_apt(system):
+        return package_cache.update_command()
+    if system in [1, 2]:
+        return "/bin/bash -c 'apt-get update'"
+    return None
+
 # Helper function to generate the install command based on the selected system and packages
-def _get_install_command(system, packages, container):
+def _get_install_command(system, packages):
     packages_map = {
         1: 'python3',
         2: 'anaconda',
@@ -116,16 +343,11 @@ def _get_install_command(system, packages, container):
     }
     selected_packages = [packages_map.get(package_id) for package_id in packages]
 
-    if system in [1, 2]:  # Specific handling for Debian and Ubuntu
-        preconfigure_cmd = (
-            "/bin/bash -c "
-            "echo 'tzdata tzdata/Areas select Africa' | debconf-set-selections && "
-            "echo 'tzdata tzdata/Zones/Africa select Asmara' | debconf-set-selections"
-        )
-        container.exec_run(preconfigure_cmd, tty=True, stream=True, environment={"DEBIAN_FRONTEND": "noninteractive"})
+    if selected_packages and package_cache.uses_apt(system):
+        return package_cache.install_command(selected_packages)
+    if selected_packages and system in [1, 2]:  # Specific handling for Debian and Ubuntu
+        return f"/bin/bash -c 'apt-get install -y {' '.join(selected_packages)}'"
 
-        return f"/bin/bash -c 'apt-get update && apt-get install -y {' '.join(selected_packages)}'"
-    
     return None
 
 # API view to create a Docker instance
@@ -142,8 +364,22 @@ def stop_instance(request):
     data = request.data
     container_id = data.get('containerId')
     try:
-        container = client.containers.get(container_id)
-        threading.Thread(target=run_in_background, args=(container, None, update_status_on_completion, "stop")).start()
-        return Response({'message': 'Container stopped successfully.'}, status=status.HTTP_200_OK)
+        container = docker_control.run_sync(client.containers.get, container_id)
+        # Pending installs for the container are pointless once it is stopping
+        jobs.cancel_container(container.id, kinds=("provision", "exec"))
+        job = jobs.submit("stop", "execute_and_callback", container.id, command=None, job_name="stop")
+        return Response({'message': 'Container stopped successfully.', 'jobId': job.id}, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# API view to cancel a queued or running job
+@api_view(['POST'])
+def cancel_job(request):
+    job_id = request.data.get('jobId')
+    try:
+        state = jobs.cancel(job_id)
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if state is None:
+        return Response({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response({'jobId': job_id, 'status': state}, status=status.HTTP_200_OK)
@@ -0,0 +1,86 @@
+import logging
+import os
+
+from django.core.cache import cache
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Set by runworkers for each worker process it starts. A process started
+# any other way (runserver, a bare daphne) is a group of one and its own
+# primary.
+GROUP = os.environ.get('TERMINAL_WORKER_GROUP', '')
+WORKER_ID = os.environ.get('TERMINAL_WORKER_ID', str(os.getpid()))
+# Only the primary worker of a group runs the process-wide background
+# work: the warm pool refill, the job engine, the container index and the
+# idle checks. runworkers makes the first worker of each generation the
+# primary, and an old primary steps down when it starts draining.
+PRIMARY = os.environ.get('TERMINAL_WORKER_PRIMARY', '1') == '1'
+
+# Stats endpoints' data reported by each worker alongside its metrics: {name: function}
+STATS = {}
+
+
+def reports_key(group):
+    return f"workers:reports:{group}"
+
+
+# What a worker reports to runworkers, which publishes the reports of the
+# whole group to the shared cache
+def report(with_metrics=True):
+    stats = {}
+    for name, function in STATS.items():
+        try:
+            stats[name] = function()
+        except Exception as e:
+            logger.error(f"Collecting {name} stats failed: {e}")
+    return {'primary': PRIMARY, 'metrics': metrics.families() if with_metrics else [], 'stats': stats}
+
+
+# {worker id: report} for every worker of the group as last published,
+# with this worker's own report taken now
+def reports(with_metrics=True):
+    published = {}
+    if GROUP:
+        try:
+            published = cache.get(reports_key(GROUP)) or {}
+        except Exception as e:
+            logger.error(f"Reading worker reports failed: {e}")
+    published[WORKER_ID] = report(with_metrics)
+    return published
+
+
+# The primary's stats under name, with totals across workers for the keys
+# in totals and each worker's own stats under 'workers'
+def combined(name, totals=()):
+    by_worker = {}
+    primary = None
+    for worker_id, worker_report in sorted(reports(with_metrics=False).items()):
+        stats = worker_report.get('stats', {}).get(name)
+        if stats is None:
+            continue
+        by_worker[worker_id] = stats
+        if worker_report.get('primary') and (primary is None or worker_id == WORKER_ID):
+            primary = stats
+    result = dict(primary or by_worker.get(WORKER_ID) or {})
+    for key in totals:
+        result[key] = sum(stats.get(key) or 0 for stats in by_worker.values())
+    result['workers'] = by_worker
+    return result
+
+
+# Stop the primary's background work, which the next generation's primary
+# has taken over by now. Jobs already on the engine run to the end.
+def step_down():
+    global PRIMARY
+    if not PRIMARY:
+        return
+    PRIMARY = False
+    from . import container_index, jobs
+    from .views import container_pool
+    container_index.stop_index()
+    if container_pool:
+        container_pool.stop()
+    jobs.receiver.stop()
+    logger.info(f"Worker {WORKER_ID} stepped down as primary.")
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import styled from 'styled-components';
 import { FaTrashAlt } from 'react-icons/fa';
 import axios from 'axios';
@@ -84,13 +84,35 @@ const ConnectionStatus = {
 };
 const ConnectionList = ({ connections, onDelete, onConnect, onDisconnect, onTerminal }) => {
   const [updatedConnections, setUpdatedConnections] = useState(connections);
-  
+  const socketRef = useRef(null);
+  const connectionsRef = useRef(connections);
+
+  // Job events are only delivered for containers this client subscribes to
+  const subscribe = (conns) => {
+    const socket = socketRef.current;
+    const containerIds = conns
+      .map((connection) => connection.selectedSystem.containerId)
+      .filter(Boolean);
+    if (socket && socket.readyState === WebSocket.OPEN && containerIds.length > 0) {
+      socket.send(JSON.stringify({ action: 'subscribe', containerIds }));
+    }
+  };
+
   useEffect(() => {
     // Establish WebSocket connection
     const socket = new WebSocket('ws://localhost:8001/ws/job-status/');
+    socketRef.current = socket;
+
+    socket.onopen = function () {
+      subscribe(connectionsRef.current);
+    };
 
     socket.onmessage = function (e) {
       const data = JSON.parse(e.data);
+      if (data.v !== undefined) {
+        // Install progress batch, not a status change
+        return;
+      }
       console.log('Job Status: ', data.message);
       console.log('container ID: ', data.containerId);
       console.log('Job Status: ', data.status);
@@ -134,6 +156,8 @@ const ConnectionList = ({ connections, onDelete, onConnect, onDisconnect, onTerm
 
   useEffect(() => {
     console.log('Initial connections:', connections);
+    connectionsRef.current = connections;
+    subscribe(connections);
     setUpdatedConnections(connections);
   }, [connections]);
 
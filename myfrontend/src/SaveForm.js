@@ -154,10 +154,11 @@ const SaveForm = ({ onSave }) => {
 
   };
 
-  const handleSubmit = (e) => {
+  const handleSubmit = async (e) => {
     e.preventDefault();
     if (selectedSystem && selectedPackages) {
-      handleCreateInstance(selectedSystem.id, selectedPackages);
+      // Wait for the container id so the connection list can subscribe to its job status
+      await handleCreateInstance(selectedSystem.id, selectedPackages);
       console.log('Selected System:', selectedSystem);
       onSave({ selectedSystem, selectedPackages });
     } else {
@@ -26,23 +26,35 @@ const Terminal = ({ connection, onDisconnect, activeTerminals }) => {
 // }
   useEffect(() => {
     if (connection) {
-      const socket = new WebSocket(`ws://localhost:8001/ws/terminal/${connection.selectedSystem.containerId}/`);
+      const socket = new WebSocket(`ws://localhost:8001/ws/terminal/${connection.selectedSystem.containerId}/?mode=binary`);
+      socket.binaryType = 'arraybuffer'; // Raw terminal bytes, decoded by xterm
       socketRef.current = socket;
 
       socket.onopen = () => {
         console.log('WebSocket connection established');
         setConnectionStatus('connected');
-        // Optionally send a message to the server here if needed
+        sendResize(terminalInstance.current.rows, terminalInstance.current.cols);
       };
 
       socket.onmessage = (event) => {
         // console.log('WebSocket message received:', event.data);
         // const data = JSON.parse(event.data);
         // if (data.stdout) {
-          terminalInstance.current.write(event.data);  // Write the data to the terminal
+          // Binary frames are terminal output, text frames are JSON control messages
+          if (typeof event.data === 'string') {
+            console.log('Terminal control message:', event.data);
+            return;
+          }
+          terminalInstance.current.write(new Uint8Array(event.data));  // Write the data to the terminal
         // }
       };
 
+      const sendResize = (rows, cols) => {
+        if (socketRef.current && socketRef.current.readyState === WebSocket.OPEN) {
+          socketRef.current.send(JSON.stringify({ resize: { rows, cols } }));
+        }
+      };
+
       socket.onclose = () => {
         // setConnectionStatus('disconnected');
         console.log('WebSocket connection closed');
@@ -77,11 +89,15 @@ const Terminal = ({ connection, onDisconnect, activeTerminals }) => {
       // Fit terminal size to container
       fitAddon.current.fit();
 
-      // Handle data input from the terminal
+      // Keep the container's TTY the same size as the view
+      terminalInstance.current.onResize(({ rows, cols }) => sendResize(rows, cols));
+
+      // Handle data input from the terminal, sent as bytes since text frames are control messages
+      const encoder = new TextEncoder();
       terminalInstance.current.onData((data) => {
         console.log('Data from terminal:', data);
         if (socketRef.current && socketRef.current.readyState === WebSocket.OPEN) {
-          socketRef.current.send(data);
+          socketRef.current.send(encoder.encode(data));
         }
       });
 